@@ -9,9 +9,8 @@ import database as db
 def add_sample_users():
     """Add 2 admin users and 2 student users"""
     
-    # Ensure database exists
-    if not db.os.path.exists(db.DATABASE_NAME):
-        db.init_database()
+    # Create the database or bring its schema up to date
+    db.migrate()
     
     users_to_add = [
         # Admins
@@ -0,0 +1,169 @@
+"""
+Bounded database executor for the async API
+
+The functions in database.py block, so the async endpoints in asgi.py run
+them on a pool of DB_EXECUTOR_THREADS threads. Each thread keeps its own
+read-only connection per database file (see db.pin_read_connections), so the
+executor never competes with the WSGI threads for the read pools. At most
+PENDING_PER_THREAD calls per thread are running or queued; a call that finds
+them all taken gets DatabaseBusyError at once, and the endpoint answers 503
+instead of holding the request while the queue grows.
+
+When the client disconnects or the request task is cancelled, a call that
+has not started is cancelled, and one that is running has its queries
+interrupted, so an abandoned request stops using its connection.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import database as db
+
+DB_EXECUTOR_THREADS = 8
+PENDING_PER_THREAD = 8
+
+
+class DatabaseBusyError(RuntimeError):
+    """Raised when every executor slot is taken"""
+
+
+class ClientDisconnected(Exception):
+    """Raised when the client goes away before its database call finishes"""
+
+
+class _Call:
+    """A function call that can be interrupted from another thread while it runs"""
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.thread_id = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.thread_id = threading.get_ident()
+        try:
+            return self.function(*self.args)
+        finally:
+            with self._lock:
+                self.thread_id = None
+
+    def interrupt(self):
+        """Abort the queries of the running call; returns whether it was running"""
+        with self._lock:
+            if self.thread_id is None:
+                return False
+            db.interrupt_reads(self.thread_id)
+            return True
+
+
+async def _wait_for_disconnect(request):
+    while True:
+        message = await request.receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+
+
+class DatabaseExecutor:
+    """Bounded thread pool for blocking database calls, with per-thread connections"""
+
+    def __init__(self, threads=DB_EXECUTOR_THREADS, max_pending=None):
+        self.threads = threads
+        self.max_pending = max_pending or threads * PENDING_PER_THREAD
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.counts = {'calls': 0, 'busy': 0, 'dropped': 0, 'interrupted': 0, 'failed': 0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='db',
+                                                    initializer=db.pin_read_connections)
+            return self._executor
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    async def run(self, function, *args, request=None):
+        """Run a blocking function on a pool thread; with a request, give up when its client disconnects
+
+        Raises DatabaseBusyError when no slot is free and ClientDisconnected
+        when the client has gone away.
+        """
+        if not self._slots.acquire(blocking=False):
+            self._count('busy')
+            raise DatabaseBusyError('The server is busy, please try again in a moment.')
+        call = _Call(function, args)
+        try:
+            with self._lock:
+                self.pending += 1
+                self.counts['calls'] += 1
+            future = self._get_executor().submit(call)
+            future.add_done_callback(self._release)
+        except BaseException:
+            self._release(None)
+            raise
+        result = asyncio.wrap_future(future)
+        watcher = asyncio.ensure_future(_wait_for_disconnect(request)) if request is not None else None
+        try:
+            if watcher is None:
+                return await result
+            done, _ = await asyncio.wait((result, watcher), return_when=asyncio.FIRST_COMPLETED)
+            if result in done:
+                return result.result()
+            watcher.result()
+        except (ClientDisconnected, asyncio.CancelledError):
+            self._abandon(future, result, call)
+            raise
+        except Exception:
+            if result.done():
+                self._count('failed')
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+    def _release(self, future):
+        with self._lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def _abandon(self, future, result, call):
+        if future.cancel():
+            self._count('dropped')
+        elif call.interrupt():
+            self._count('interrupted')
+        # Nobody awaits the call any more, so its error must not be reported as unretrieved
+        result.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def shutdown(self):
+        """Cancel the calls that have not started and wait for the running ones"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        """Get pool size, queue depth and call counts"""
+        with self._lock:
+            return {
+                'threads': self.threads,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                **self.counts
+            }
+
+
+executor = DatabaseExecutor()
+
+
+def configure(threads):
+    """Replace the executor with one of a different size, before it is first used"""
+    global executor
+    if threads != executor.threads:
+        executor = DatabaseExecutor(threads)
+    return executor
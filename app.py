@@ -3,76 +3,109 @@
 Flask application for Laboratory Chemical Management System
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+from flask import Flask, Blueprint, render_template, request, jsonify, redirect, url_for, session, flash
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import date
 import database as db
 import auth
+import jobs
+import audit
+import archive
+import fragments
+import suggest
+import formula
+import reorder
+import valuation
+import passwords
+import ratelimit
+import taskqueue
+import tasks
+from config import Config
+from segregation import SegregationError
+from limits import QuantityLimitError
+from cas import DuplicateCASError
+from similarity import SimilarChemicalError
 import os
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
-CORS(app)
+# Every view is on this blueprint, which create_app registers on each app
+bp = Blueprint('main', __name__)
 
-# Ensure database exists
-if not os.path.exists(db.DATABASE_NAME):
-    db.init_database()
+# Admit search and write API requests through per-user token buckets
+def limit_request_rate():
+    """Return 429 with Retry-After when a user's bucket for the endpoint class is empty"""
+    endpoint_class = ratelimit.endpoint_class(request.endpoint, request.method, request.path)
+    if endpoint_class is None:
+        return None
+    client = f"user:{session['user_id']}" if 'user_id' in session else f'ip:{request.remote_addr}'
+    try:
+        ratelimit.limiter.acquire(endpoint_class, client)
+    except ratelimit.RateLimited as e:
+        response = jsonify({'success': False, 'error': str(e)})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    return None
 
-# Context processor to inject current user into all templates
-@app.context_processor
+# Context processor to inject current user into all templates; the session
+# claims are enough for the navigation, so no page reads the users table for it
 def inject_user():
     """Make current user available to all templates"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     unread_count = 0
     if current_user:
         unread_count = db.get_unread_count(current_user['id'])
     return dict(current_user=current_user, unread_count=unread_count)
 
 # Authentication routes
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Login page and handler"""
     if 'user_id' in session:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
         remember = request.form.get('remember')
         
-        # Try to find user by username or email
-        user = db.get_user_by_username(username)
-        if not user:
-            user = db.get_user_by_email(username)
+        # Find the user by username or email, then check the password off the request thread
+        user = db.get_user_for_login(username)
+        valid, upgraded_hash = False, None
+        if user:
+            try:
+                valid, upgraded_hash = passwords.verify_password(user['password_hash'], password)
+            except passwords.HashQueueFullError as e:
+                flash(str(e), 'warning')
+                return render_template('login.html'), 503
+        passwords.pool.record_login(valid and bool(user['is_active']))
         
-        if user and check_password_hash(user['password_hash'], password):
+        if valid:
             if user['is_active']:
-                session['user_id'] = user['id']
-                session['username'] = user['username']
-                session['role'] = user['role']
+                auth.start_session(user)
                 
                 if remember:
                     session.permanent = True
                 
-                # Update last login
-                db.update_last_login(user['id'])
+                # Update last login, storing the hash upgraded to the current parameters
+                db.update_last_login(user['id'], upgraded_hash, user['password_hash'])
+                audit.log_event(user['id'], 'login', 'user', user['id'])
                 
                 flash(f'Welcome back, {user["full_name"]}!', 'success')
-                return redirect(url_for('index'))
+                return redirect(url_for('main.index'))
             else:
                 flash('Your account has been deactivated. Please contact an administrator.', 'danger')
         else:
+            audit.log_event(user['id'] if user else None, 'login_failed', 'user',
+                            user['id'] if user else None, f'Failed login for {username}')
             flash('Invalid username or password.', 'danger')
     
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     """Student registration page and handler"""
     if 'user_id' in session:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     if request.method == 'POST':
         username = request.form.get('username')
@@ -104,7 +137,7 @@ def register():
         
         # Create user
         try:
-            password_hash = generate_password_hash(password)
+            password_hash = passwords.hash_password(password)
             user_id = db.create_user(
                 username=username,
                 email=email,
@@ -117,43 +150,43 @@ def register():
             )
             
             flash('Registration successful! Please login.', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         except Exception as e:
             flash(f'Registration failed: {str(e)}', 'danger')
     
     return render_template('register.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Logout user"""
+    if 'user_id' in session:
+        audit.log_event(session['user_id'], 'logout', 'user', session['user_id'])
     session.clear()
     flash('You have been logged out successfully.', 'success')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/')
+@bp.route('/')
 @auth.login_required
 def index():
     """Home page with dashboard"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     summary = db.get_inventory_summary()
-    recent_chemicals = db.get_all_chemicals()[:5]  # Get 5 most recent
+    recent_chemicals = db.get_inventory_page(sort='id', direction='desc', per_page=5)['rows']  # Get 5 most recent
     
     # Add role-specific data
     if current_user['role'] == 'admin':
         pending_requests = db.get_all_requests('pending')
         borrowed_items = db.get_borrowed_items()
-        
-        # Count overdue items
-        overdue_count = sum(1 for item in borrowed_items 
-                          if item['expected_return_date'] and 
-                          datetime.strptime(item['expected_return_date'], '%Y-%m-%d').date() < datetime.now().date())
+        overdue_count = db.get_overdue_count()
         
         return render_template('index.html', 
                              summary=summary, 
                              recent_chemicals=recent_chemicals,
                              pending_requests_count=len(pending_requests),
                              active_borrows_count=len(borrowed_items),
-                             overdue_count=overdue_count)
+                             overdue_count=overdue_count,
+                             reorder_suggestions=db.get_reorder_suggestions(limit=10),
+                             reorder_lead_time=reorder.LEAD_TIME_DAYS)
     else:
         # Student dashboard
         my_requests = db.get_requests_by_student(current_user['id'])
@@ -167,28 +200,61 @@ def index():
                              my_borrowed_count=len(my_borrowed),
                              pending_count=pending_count)
 
-@app.route('/inventory')
+@bp.route('/inventory')
 @auth.login_required
 def inventory():
-    """Inventory page showing all chemicals"""
-    chemicals = db.get_all_chemicals()
-    return render_template('inventory.html', chemicals=chemicals)
+    """Inventory page showing one filtered, sorted page of chemicals"""
+    filters = {
+        'q': request.args.get('q', '').strip(),
+        'elements': formula.element_symbols(request.args.get('elements')),
+        'min_weight': request.args.get('min_weight', type=float),
+        'max_weight': request.args.get('max_weight', type=float),
+        'hazard_category_id': request.args.get('hazard', type=int),
+        'supplier': request.args.get('supplier', '').strip(),
+        'storage_location_id': request.args.get('location', type=int),
+        'expiring_within': request.args.get('expiring', type=int),
+        'low_stock': request.args.get('low_stock') == '1'
+    }
+    if filters['expiring_within'] is not None and filters['expiring_within'] < 0:
+        return "Invalid expiry window", 400
+    sort = request.args.get('sort', 'name')
+    direction = request.args.get('dir', 'asc')
+    page = fragments.Lazy(db.get_inventory_page, filters, sort, direction,
+                          request.args.get('page', 1, type=int))
+    # Current filters without the page number, for sort and pagination links
+    query_args = {key: value for key, value in request.args.items() if key != 'page' and value}
+    fragment_key = tuple(sorted(request.args.items()))
+    if filters['expiring_within'] is not None:
+        # The expiry filter compares against today, which no version stamp tracks
+        fragment_key += (('today', date.today().isoformat()),)
+    return render_template('inventory.html',
+                         page=page,
+                         filters=filters,
+                         sort=sort,
+                         direction=direction,
+                         query_args=query_args,
+                         fragment_key=fragment_key,
+                         hazard_categories=db.get_all_hazard_categories(),
+                         suppliers=db.get_suppliers(),
+                         storage_locations=db.get_all_storage_locations(),
+                         versions=db.get_cache_versions('chemicals', 'inventory'))
 
-@app.route('/chemical/<int:chemical_id>')
+@bp.route('/chemical/<int:chemical_id>')
 @auth.login_required
 def chemical_detail(chemical_id):
     """Chemical detail page"""
     chemical = db.get_chemical_by_id(chemical_id)
     if not chemical:
         return "Chemical not found", 404
-    inventory_items = db.get_inventory_for_chemical(chemical_id)
+    inventory_items = fragments.Lazy(db.get_inventory_for_chemical, chemical_id)
     available = db.get_available_quantity(chemical_id)
     return render_template('chemical_detail.html', 
                          chemical=chemical, 
                          inventory_items=inventory_items,
-                         available=available)
+                         available=available,
+                         versions=db.get_cache_versions(f'chemical:{chemical_id}'))
 
-@app.route('/add-chemical')
+@bp.route('/add-chemical')
 @auth.admin_required
 def add_chemical_page():
     """Add chemical page - Admin only"""
@@ -198,7 +264,7 @@ def add_chemical_page():
                          hazard_categories=hazard_categories, 
                          storage_locations=storage_locations)
 
-@app.route('/edit-chemical/<int:chemical_id>')
+@bp.route('/edit-chemical/<int:chemical_id>')
 @auth.admin_required
 def edit_chemical_page(chemical_id):
     """Edit chemical page - Admin only"""
@@ -209,18 +275,19 @@ def edit_chemical_page(chemical_id):
     storage_locations = db.get_all_storage_locations()
     return render_template('edit_chemical.html', 
                          chemical=chemical,
+                         synonyms=db.get_synonyms(chemical_id),
                          hazard_categories=hazard_categories, 
                          storage_locations=storage_locations)
 
 # API Endpoints
 
-@app.route('/api/chemicals', methods=['GET'])
+@bp.route('/api/chemicals', methods=['GET'])
 def api_get_chemicals():
     """Get all chemicals"""
     chemicals = db.get_all_chemicals()
     return jsonify([dict(c) for c in chemicals])
 
-@app.route('/api/chemicals/<int:chemical_id>', methods=['GET'])
+@bp.route('/api/chemicals/<int:chemical_id>', methods=['GET'])
 def api_get_chemical(chemical_id):
     """Get a specific chemical"""
     chemical = db.get_chemical_by_id(chemical_id)
@@ -228,95 +295,336 @@ def api_get_chemical(chemical_id):
         return jsonify({'error': 'Chemical not found'}), 404
     return jsonify(dict(chemical))
 
-@app.route('/api/chemicals', methods=['POST'])
+@bp.route('/api/chemicals', methods=['POST'])
 @auth.admin_required
 def api_add_chemical():
     """Add a new chemical - Admin only"""
     data = request.json
     try:
         chemical_id = db.add_chemical(data)
-        return jsonify({'success': True, 'id': chemical_id, 'message': 'Chemical added successfully'}), 201
+        audit.log_event(session.get('user_id'), 'chemical.create', 'chemical', chemical_id, data.get('name'))
+        # Close names that could not be confirmed by formula are only reported
+        similar = db.find_similar_chemicals(data.get('name'), data.get('synonyms'), chemical_id,
+                                            chemical_formula=data.get('chemical_formula'))
+        return jsonify({'success': True, 'id': chemical_id, 'message': 'Chemical added successfully',
+                        'similar': similar}), 201
+    except DuplicateCASError as e:
+        return jsonify({'success': False, 'error': str(e)}), 409
+    except SimilarChemicalError as e:
+        return jsonify({'success': False, 'error': str(e), 'similar': e.matches}), 409
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/chemicals/<int:chemical_id>', methods=['PUT'])
+@bp.route('/api/chemicals/<int:chemical_id>', methods=['PUT'])
 @auth.admin_required
 def api_update_chemical(chemical_id):
     """Update a chemical - Admin only"""
     data = request.json
     try:
         db.update_chemical(chemical_id, data)
+        audit.log_event(session.get('user_id'), 'chemical.update', 'chemical', chemical_id, data.get('name'))
         return jsonify({'success': True, 'message': 'Chemical updated successfully'})
+    except (DuplicateCASError, SegregationError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 409
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/chemicals/<int:chemical_id>', methods=['DELETE'])
+@bp.route('/api/chemicals/<int:chemical_id>', methods=['DELETE'])
 @auth.admin_required
 def api_delete_chemical(chemical_id):
     """Delete a chemical - Admin only"""
     try:
         db.delete_chemical(chemical_id)
+        audit.log_event(session.get('user_id'), 'chemical.delete', 'chemical', chemical_id)
         return jsonify({'success': True, 'message': 'Chemical deleted successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/inventory', methods=['GET'])
+@bp.route('/api/inventory', methods=['GET'])
 def api_get_inventory():
     """Get inventory summary"""
     summary = db.get_inventory_summary()
     return jsonify(dict(summary))
 
-@app.route('/api/inventory/<int:chemical_id>', methods=['GET'])
+@bp.route('/api/inventory/<int:chemical_id>', methods=['GET'])
 def api_get_chemical_inventory(chemical_id):
     """Get inventory for a specific chemical"""
     inventory = db.get_inventory_for_chemical(chemical_id)
     return jsonify([dict(i) for i in inventory])
 
-@app.route('/api/inventory', methods=['POST'])
+@bp.route('/api/inventory', methods=['POST'])
 @auth.admin_required
 def api_add_inventory():
     """Add inventory item - Admin only"""
     data = request.json
     try:
         item_id = db.add_inventory_item(data)
+        audit.log_event(session.get('user_id'), 'inventory.create', 'inventory', item_id,
+                        f"{data.get('quantity')} {data.get('unit')} of chemical {data.get('chemical_id')}")
         return jsonify({'success': True, 'id': item_id, 'message': 'Inventory item added successfully'}), 201
+    except (SegregationError, QuantityLimitError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 409
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/inventory/<int:inventory_id>', methods=['PUT'])
+@bp.route('/api/inventory/<int:inventory_id>', methods=['PUT'])
 @auth.admin_required
 def api_update_inventory(inventory_id):
     """Update inventory quantity - Admin only"""
     data = request.json
     try:
         db.update_inventory_quantity(inventory_id, data.get('quantity'))
+        audit.log_event(session.get('user_id'), 'inventory.update', 'inventory', inventory_id,
+                        f"Quantity set to {data.get('quantity')}")
         return jsonify({'success': True, 'message': 'Inventory updated successfully'})
+    except QuantityLimitError as e:
+        return jsonify({'success': False, 'error': str(e)}), 409
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/inventory/<int:inventory_id>', methods=['DELETE'])
+@bp.route('/api/inventory/<int:inventory_id>/transfer', methods=['PUT'])
+@auth.admin_required
+def api_transfer_inventory(inventory_id):
+    """Move inventory item to another storage location - Admin only"""
+    data = request.json
+    try:
+        db.transfer_inventory_item(inventory_id, data.get('storage_location_id'))
+        audit.log_event(session.get('user_id'), 'inventory.transfer', 'inventory', inventory_id,
+                        f"Moved to location {data.get('storage_location_id')}")
+        return jsonify({'success': True, 'message': 'Inventory item moved successfully'})
+    except (SegregationError, QuantityLimitError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 409
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.route('/api/inventory/<int:inventory_id>', methods=['DELETE'])
 @auth.admin_required
 def api_delete_inventory(inventory_id):
     """Delete inventory item - Admin only"""
     try:
         db.delete_inventory_item(inventory_id)
+        audit.log_event(session.get('user_id'), 'inventory.delete', 'inventory', inventory_id)
         return jsonify({'success': True, 'message': 'Inventory item deleted successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/locations', methods=['GET'])
+@bp.route('/api/locations', methods=['GET'])
 def api_get_locations():
     """Get all storage locations"""
     locations = db.get_all_storage_locations()
     return jsonify([dict(l) for l in locations])
 
-@app.route('/api/hazards', methods=['GET'])
+@bp.route('/api/hazards', methods=['GET'])
 def api_get_hazards():
     """Get all hazard categories"""
     hazards = db.get_all_hazard_categories()
     return jsonify([dict(h) for h in hazards])
 
-@app.route('/api/search', methods=['GET'])
+@bp.route('/api/admin/segregation-audit', methods=['GET'])
+@auth.admin_required
+def api_segregation_audit():
+    """List incompatible hazard classes stored together - Admin only"""
+    violations = db.get_segregation_violations()
+    return jsonify({'count': len(violations), 'violations': violations})
+
+@bp.route('/api/inventory/limit-check', methods=['GET'])
+@auth.admin_required
+def api_check_quantity_limits():
+    """Check whether a receipt would exceed a quantity limit - Admin only"""
+    exceeded = db.check_quantity_limits(
+        chemical_id=request.args.get('chemical_id', type=int),
+        storage_location_id=request.args.get('storage_location_id', type=int),
+        quantity=request.args.get('quantity', type=float),
+        unit=request.args.get('unit')
+    )
+    return jsonify({'allowed': not exceeded, 'exceeded': exceeded})
+
+@bp.route('/api/admin/quantity-report', methods=['GET'])
+@auth.admin_required
+def api_quantity_report():
+    """Get hazard-class totals per building and room against their limits - Admin only"""
+    return jsonify(db.get_quantity_report())
+
+@bp.route('/api/admin/quantity-limits', methods=['GET'])
+@auth.admin_required
+def api_get_quantity_limits():
+    """Get configured quantity limits - Admin only"""
+    return jsonify([dict(l) for l in db.get_quantity_limits()])
+
+@bp.route('/api/admin/quantity-limits', methods=['PUT'])
+@auth.admin_required
+def api_set_quantity_limit():
+    """Create or update a quantity limit - Admin only"""
+    data = request.json
+    try:
+        db.set_quantity_limit(
+            building=data['building'],
+            room=data.get('room'),
+            hazard_category_id=data['hazard_category_id'],
+            unit=data['unit'],
+            max_quantity=data['max_quantity']
+        )
+        return jsonify({'success': True, 'message': 'Quantity limit saved successfully'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.route('/api/admin/quantity-limits/<int:limit_id>', methods=['DELETE'])
+@auth.admin_required
+def api_delete_quantity_limit(limit_id):
+    """Delete a quantity limit - Admin only"""
+    try:
+        db.delete_quantity_limit(limit_id)
+        return jsonify({'success': True, 'message': 'Quantity limit deleted successfully'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.route('/api/admin/jobs', methods=['GET'])
+@auth.admin_required
+def api_get_jobs():
+    """Get background job run times and row counts, from whichever process ran them - Admin only"""
+    return jsonify({'running': jobs.scheduler.is_running(), 'jobs': db.get_job_runs()})
+
+@bp.route('/api/admin/jobs/<name>/run', methods=['POST'])
+@auth.admin_required
+def api_run_job(name):
+    """Queue a background job to run on a task worker now - Admin only"""
+    try:
+        task_id = tasks.run_job_later(name)
+    except KeyError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    return jsonify({'success': True, 'task_id': task_id}), 202
+
+@bp.route('/api/admin/tasks', methods=['GET'])
+@auth.admin_required
+def api_get_tasks():
+    """Task queue counts and the latest tasks, optionally with one status (e.g. dead) - Admin only"""
+    return jsonify({
+        **taskqueue.get_stats(),
+        'recent': taskqueue.get_tasks(request.args.get('status'), request.args.get('limit', 50, type=int))
+    })
+
+@bp.route('/api/admin/tasks/<int:task_id>/retry', methods=['POST'])
+@auth.admin_required
+def api_retry_task(task_id):
+    """Queue a dead-lettered task again - Admin only"""
+    if not taskqueue.retry(task_id):
+        return jsonify({'success': False, 'error': 'Task not found or not dead-lettered'}), 404
+    audit.log_event(session.get('user_id'), 'task.retry', 'task', task_id)
+    return jsonify({'success': True})
+
+@bp.route('/api/admin/activity', methods=['GET'])
+@auth.admin_required
+def api_get_activity():
+    """Query the audit trail by user, entity and time range, optionally including archived entries - Admin only"""
+    get_entries = archive.get_full_activity_log if request.args.get('include_archived') == '1' else db.get_activity_log
+    entries = get_entries(
+        user_id=request.args.get('user_id', type=int),
+        entity_type=request.args.get('entity_type'),
+        entity_id=request.args.get('entity_id', type=int),
+        since=request.args.get('since'),
+        until=request.args.get('until'),
+        limit=min(request.args.get('limit', 100, type=int), 1000)
+    )
+    return jsonify([dict(e) for e in entries])
+
+@bp.route('/api/admin/activity/stats', methods=['GET'])
+@auth.admin_required
+def api_get_activity_stats():
+    """Get audit queue depth and drop counters - Admin only"""
+    return jsonify(audit.get_stats())
+
+@bp.route('/api/admin/db-stats', methods=['GET'])
+@auth.admin_required
+def api_get_db_stats():
+    """Get read pool and writer lock statistics - Admin only"""
+    return jsonify(db.get_connection_stats())
+
+@bp.route('/api/admin/fragment-cache', methods=['GET'])
+@auth.admin_required
+def api_get_fragment_cache_stats():
+    """Get rendered fragment cache hit rate and size - Admin only"""
+    return jsonify(fragments.cache.stats())
+
+@bp.route('/api/admin/login-stats', methods=['GET'])
+@auth.admin_required
+def api_get_login_stats():
+    """Get login rates, password hashing times and hash pool queue depth - Admin only"""
+    return jsonify(passwords.pool.stats())
+
+@bp.route('/api/admin/rate-limits', methods=['GET'])
+@auth.admin_required
+def api_get_rate_limits():
+    """Get token bucket limits with allowed, throttled and rejected counts - Admin only"""
+    return jsonify(ratelimit.limiter.stats())
+
+@bp.route('/api/admin/formula-mismatches', methods=['GET'])
+@auth.admin_required
+def api_get_formula_mismatches():
+    """Chemicals whose molecular weight disagrees with their formula - Admin only"""
+    return jsonify([dict(c) for c in db.get_weight_mismatches()])
+
+@bp.route('/api/admin/duplicate-groups', methods=['GET'])
+@auth.admin_required
+def api_get_duplicate_groups():
+    """Candidate merge groups from the last duplicate scan - Admin only"""
+    return jsonify(db.get_duplicate_groups())
+
+@bp.route('/api/admin/reorder-suggestions', methods=['GET'])
+@auth.admin_required
+def api_get_reorder_suggestions():
+    """Chemicals at or below their forecast reorder point - Admin only"""
+    limit = request.args.get('limit', type=int)
+    return jsonify([dict(s) for s in db.get_reorder_suggestions(limit)])
+
+@bp.route('/api/admin/suggest-index', methods=['GET'])
+@auth.admin_required
+def api_get_suggest_index_stats():
+    """Get typeahead index size and prefix cache statistics - Admin only"""
+    return jsonify(suggest.index.stats())
+
+@bp.route('/api/admin/shards', methods=['GET'])
+@auth.admin_required
+def api_get_shards():
+    """Get record counts for the main database and every department shard - Admin only"""
+    return jsonify({'enabled': db.SHARDING_ENABLED, 'shards': db.get_shard_stats()})
+
+@bp.route('/api/analytics/consumption', methods=['GET'])
+@auth.admin_required
+def api_get_consumption():
+    """Borrowed quantities per chemical, department and unit over a date range - Admin only"""
+    today = date.today()
+    group_by = request.args.get('group_by', 'chemical,department')
+    try:
+        rows = db.get_consumption(
+            start=request.args.get('start') or today.replace(month=1, day=1).isoformat(),
+            end=request.args.get('end') or today.isoformat(),
+            chemical_id=request.args.get('chemical_id', type=int),
+            department=request.args.get('department'),
+            unit=request.args.get('unit'),
+            interval=request.args.get('interval') or None,
+            group_by=[column for column in group_by.split(',') if column]
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify(rows)
+
+@bp.route('/api/reports/valuation', methods=['GET'])
+@auth.admin_required
+def api_get_valuation():
+    """Stock value by location, hazard class, supplier and expiry bucket - Admin only"""
+    return jsonify(valuation.get_valuation())
+
+@bp.route('/api/reports/department-costs', methods=['GET'])
+@auth.admin_required
+def api_get_department_costs():
+    """Cost of borrowed stock per department over an optional date range - Admin only"""
+    try:
+        costs = valuation.get_department_costs(request.args.get('start'), request.args.get('end'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify(costs)
+
+@bp.route('/api/search', methods=['GET'])
 def api_search():
     """Search chemicals"""
     query = request.args.get('q', '')
@@ -325,15 +633,42 @@ def api_search():
     chemicals = db.search_chemicals(query)
     return jsonify([dict(c) for c in chemicals])
 
+@bp.route('/api/chemicals/similar', methods=['GET'])
+@auth.admin_required
+def api_similar_chemicals():
+    """Existing chemicals whose name or synonyms are close to name and synonyms - Admin only"""
+    name = request.args.get('name', '').strip()
+    if not name:
+        return jsonify([])
+    return jsonify(db.find_similar_chemicals(name, request.args.get('synonyms', ''),
+                                             request.args.get('exclude', type=int),
+                                             chemical_formula=request.args.get('formula')))
+
+@bp.route('/api/chemicals/composition', methods=['GET'])
+def api_search_composition():
+    """Chemicals containing every listed element, optionally within a formula weight range"""
+    chemicals = db.search_by_composition(formula.element_symbols(request.args.get('elements')),
+                                         request.args.get('min_weight', type=float),
+                                         request.args.get('max_weight', type=float),
+                                         request.args.get('limit', 100, type=int))
+    return jsonify([dict(c) for c in chemicals])
+
+@bp.route('/api/suggest', methods=['GET'])
+def api_suggest():
+    """Typeahead suggestions for a name, synonym, formula or CAS number prefix"""
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', suggest.MAX_SUGGESTIONS, type=int)
+    return jsonify(db.suggest_chemicals(query, limit))
+
 # Student routes
-@app.route('/student/request-chemical/<int:chemical_id>', methods=['GET', 'POST'])
+@bp.route('/student/request-chemical/<int:chemical_id>', methods=['GET', 'POST'])
 @auth.student_required
 def request_chemical(chemical_id):
     """Student request chemical page"""
     chemical = db.get_chemical_by_id(chemical_id)
     if not chemical:
         flash('Chemical not found', 'danger')
-        return redirect(url_for('inventory'))
+        return redirect(url_for('main.inventory'))
     
     if request.method == 'POST':
         current_user = auth.get_current_user()
@@ -359,21 +694,20 @@ def request_chemical(chemical_id):
                 required_date=required_date,
                 expected_return_date=expected_return_date
             )
+            audit.log_event(current_user['id'], 'request.create', 'request', request_id,
+                            f'{quantity} {unit} of {chemical["name"]}')
             
             # Notify admins
-            admins = [u for u in db.get_all_users() if u['role'] == 'admin']
-            for admin in admins:
-                db.create_notification(
-                    user_id=admin['id'],
-                    title='New Chemical Request',
-                    message=f'{current_user["full_name"]} requested {quantity} {unit} of {chemical["name"]}',
-                    notification_type='request',
-                    related_entity_type='request',
-                    related_entity_id=request_id
-                )
+            tasks.notify_admins(
+                title='New Chemical Request',
+                message=f'{current_user["full_name"]} requested {quantity} {unit} of {chemical["name"]}',
+                notification_type='request',
+                related_entity_type='request',
+                related_entity_id=request_id
+            )
             
             flash('Request submitted successfully!', 'success')
-            return redirect(url_for('my_requests'))
+            return redirect(url_for('main.my_requests'))
         except Exception as e:
             flash(f'Error submitting request: {str(e)}', 'danger')
     
@@ -384,24 +718,24 @@ def request_chemical(chemical_id):
                          available=available,
                          inventory_items=inventory_items)
 
-@app.route('/student/my-requests')
+@bp.route('/student/my-requests')
 @auth.student_required
 def my_requests():
     """Student view their requests"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     requests = db.get_requests_by_student(current_user['id'])
     return render_template('student_requests.html', requests=requests)
 
-@app.route('/student/my-borrowed')
+@bp.route('/student/my-borrowed')
 @auth.student_required
 def my_borrowed():
     """Student view their borrowed items"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     borrowed_items = db.get_borrowed_items(current_user['id'])
     return render_template('student_borrowed.html', borrowed_items=borrowed_items)
 
 # Admin routes
-@app.route('/admin/requests')
+@bp.route('/admin/requests')
 @auth.admin_required
 def admin_requests():
     """Admin view all requests"""
@@ -409,21 +743,57 @@ def admin_requests():
     requests = db.get_all_requests(status_filter if status_filter != 'all' else None)
     return render_template('admin_requests.html', requests=requests, status_filter=status_filter)
 
-@app.route('/admin/borrowed')
+@bp.route('/admin/borrowed')
 @auth.admin_required
 def admin_borrowed():
     """Admin view all borrowed items"""
     borrowed_items = db.get_borrowed_items()
     return render_template('admin_borrowed.html', borrowed_items=borrowed_items)
 
-@app.route('/admin/users')
+@bp.route('/admin/users')
 @auth.admin_required
 def admin_users():
     """Admin view all users"""
     users = db.get_all_users()
     return render_template('admin_users.html', users=users)
 
-@app.route('/profile', methods=['GET', 'POST'])
+@bp.route('/api/users/<int:user_id>/status', methods=['PUT'])
+@auth.admin_required
+def api_set_user_status(user_id):
+    """Activate or deactivate a user, signing out a deactivated user's sessions - Admin only"""
+    if user_id == session['user_id']:
+        return jsonify({'success': False, 'message': 'You cannot change your own status'}), 400
+    if not db.get_user_by_id(user_id):
+        return jsonify({'success': False, 'message': 'User not found'}), 404
+    
+    if request.json.get('is_active'):
+        db.activate_user(user_id)
+        audit.log_event(session['user_id'], 'user.activate', 'user', user_id)
+    else:
+        db.deactivate_user(user_id)
+        auth.versions.expire()
+        audit.log_event(session['user_id'], 'user.deactivate', 'user', user_id)
+    return jsonify({'success': True, 'message': 'User status updated successfully'})
+
+@bp.route('/api/users/<int:user_id>/role', methods=['PUT'])
+@auth.admin_required
+def api_set_user_role(user_id):
+    """Change a user's role, signing out their sessions - Admin only"""
+    if user_id == session['user_id']:
+        return jsonify({'success': False, 'message': 'You cannot change your own role'}), 400
+    if not db.get_user_by_id(user_id):
+        return jsonify({'success': False, 'message': 'User not found'}), 404
+    
+    role = request.json.get('role')
+    try:
+        db.set_user_role(user_id, role)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    auth.versions.expire()
+    audit.log_event(session['user_id'], 'user.role', 'user', user_id, role)
+    return jsonify({'success': True, 'message': 'User role updated successfully'})
+
+@bp.route('/profile', methods=['GET', 'POST'])
 @auth.login_required
 def profile():
     """User profile page"""
@@ -440,26 +810,31 @@ def profile():
         try:
             db.update_user(current_user['id'], data)
             flash('Profile updated successfully!', 'success')
-            return redirect(url_for('profile'))
+            return redirect(url_for('main.profile'))
         except Exception as e:
             flash(f'Error updating profile: {str(e)}', 'danger')
     
     return render_template('profile.html', user=current_user)
 
-@app.route('/notifications')
+@bp.route('/notifications')
 @auth.login_required
 def notifications():
-    """View notifications"""
-    current_user = auth.get_current_user()
-    user_notifications = db.get_user_notifications(current_user['id'])
-    return render_template('notifications.html', notifications=user_notifications)
+    """View notifications, including archived ones with include_archived=1"""
+    current_user = auth.get_session_user()
+    include_archived = request.args.get('include_archived') == '1'
+    if include_archived:
+        user_notifications = archive.get_full_notifications(current_user['id'])
+    else:
+        user_notifications = db.get_user_notifications(current_user['id'])
+    return render_template('notifications.html', notifications=user_notifications,
+                           include_archived=include_archived)
 
 # API endpoints for requests
-@app.route('/api/requests', methods=['POST'])
+@bp.route('/api/requests', methods=['POST'])
 @auth.student_required
 def api_create_request():
     """Create new chemical request"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     data = request.json
     
     try:
@@ -477,16 +852,18 @@ def api_create_request():
             required_date=data['required_date'],
             expected_return_date=data['expected_return_date']
         )
+        audit.log_event(current_user['id'], 'request.create', 'request', request_id,
+                        f"{data['quantity_requested']} {data['unit']} of chemical {data['chemical_id']}")
         
         return jsonify({'success': True, 'id': request_id, 'message': 'Request created successfully'}), 201
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/requests', methods=['GET'])
+@bp.route('/api/requests', methods=['GET'])
 @auth.login_required
 def api_get_requests():
     """Get requests (all for admin, own for student)"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     
     if current_user['role'] == 'admin':
         status = request.args.get('status')
@@ -496,7 +873,7 @@ def api_get_requests():
     
     return jsonify([dict(r) for r in requests])
 
-@app.route('/api/requests/<int:request_id>', methods=['GET'])
+@bp.route('/api/requests/<int:request_id>', methods=['GET'])
 @auth.login_required
 def api_get_request(request_id):
     """Get request details"""
@@ -505,20 +882,21 @@ def api_get_request(request_id):
         return jsonify({'error': 'Request not found'}), 404
     return jsonify(dict(req))
 
-@app.route('/api/requests/<int:request_id>/approve', methods=['PUT'])
+@bp.route('/api/requests/<int:request_id>/approve', methods=['PUT'])
 @auth.admin_required
 def api_approve_request(request_id):
     """Approve a request"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     data = request.json
     
     try:
         db.approve_request(request_id, current_user['id'], data.get('admin_notes'))
+        audit.log_event(current_user['id'], 'request.approve', 'request', request_id)
         
         # Notify student
         req = db.get_request_by_id(request_id)
-        db.create_notification(
-            user_id=req['student_id'],
+        tasks.notify(
+            [req['student_id']],
             title='Request Approved',
             message=f'Your request for {req["chemical_name"]} has been approved',
             notification_type='approval',
@@ -530,20 +908,21 @@ def api_approve_request(request_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/requests/<int:request_id>/reject', methods=['PUT'])
+@bp.route('/api/requests/<int:request_id>/reject', methods=['PUT'])
 @auth.admin_required
 def api_reject_request(request_id):
     """Reject a request"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     data = request.json
     
     try:
         db.reject_request(request_id, current_user['id'], data.get('rejection_reason', 'No reason provided'))
+        audit.log_event(current_user['id'], 'request.reject', 'request', request_id, data.get('rejection_reason'))
         
         # Notify student
         req = db.get_request_by_id(request_id)
-        db.create_notification(
-            user_id=req['student_id'],
+        tasks.notify(
+            [req['student_id']],
             title='Request Rejected',
             message=f'Your request for {req["chemical_name"]} has been rejected',
             notification_type='rejection',
@@ -555,7 +934,7 @@ def api_reject_request(request_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/requests/<int:request_id>/mark-borrowed', methods=['PUT'])
+@bp.route('/api/requests/<int:request_id>/mark-borrowed', methods=['PUT'])
 @auth.admin_required
 def api_mark_borrowed(request_id):
     """Mark request as borrowed"""
@@ -568,11 +947,12 @@ def api_mark_borrowed(request_id):
             condition_at_borrow=data.get('condition_at_borrow', 'Good'),
             notes=data.get('notes')
         )
+        audit.log_event(session.get('user_id'), 'request.borrow', 'request', request_id)
         
         # Notify student
         req = db.get_request_by_id(request_id)
-        db.create_notification(
-            user_id=req['student_id'],
+        tasks.notify(
+            [req['student_id']],
             title='Item Ready for Pickup',
             message=f'{req["chemical_name"]} is ready for pickup',
             notification_type='borrow',
@@ -584,7 +964,7 @@ def api_mark_borrowed(request_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/requests/<int:request_id>/mark-returned', methods=['PUT'])
+@bp.route('/api/requests/<int:request_id>/mark-returned', methods=['PUT'])
 @auth.admin_required
 def api_mark_returned(request_id):
     """Mark borrowed item as returned"""
@@ -596,11 +976,12 @@ def api_mark_returned(request_id):
             condition_at_return=data.get('condition_at_return', 'Good'),
             notes=data.get('notes')
         )
+        audit.log_event(session.get('user_id'), 'request.return', 'request', request_id)
         
         # Notify student
         req = db.get_request_by_id(request_id)
-        db.create_notification(
-            user_id=req['student_id'],
+        tasks.notify(
+            [req['student_id']],
             title='Return Confirmed',
             message=f'Return of {req["chemical_name"]} has been confirmed',
             notification_type='return',
@@ -612,11 +993,11 @@ def api_mark_returned(request_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/borrowed', methods=['GET'])
+@bp.route('/api/borrowed', methods=['GET'])
 @auth.login_required
 def api_get_borrowed():
     """Get borrowed items"""
-    current_user = auth.get_current_user()
+    current_user = auth.get_session_user()
     
     if current_user['role'] == 'admin':
         items = db.get_borrowed_items()
@@ -625,7 +1006,21 @@ def api_get_borrowed():
     
     return jsonify([dict(i) for i in items])
 
-@app.route('/api/notifications/<int:notification_id>/read', methods=['PUT'])
+@bp.route('/api/borrow-history', methods=['GET'])
+@auth.login_required
+def api_get_borrow_history():
+    """Get borrow history (all for admin, own for student), optionally including archived records"""
+    current_user = auth.get_session_user()
+    student_id = None if current_user['role'] == 'admin' else current_user['id']
+    
+    if request.args.get('include_archived') == '1':
+        history = archive.get_full_borrow_history(student_id)
+    else:
+        history = db.get_borrow_history(student_id)
+    
+    return jsonify([dict(h) for h in history])
+
+@bp.route('/api/notifications/<int:notification_id>/read', methods=['PUT'])
 @auth.login_required
 def api_mark_notification_read(notification_id):
     """Mark notification as read"""
@@ -635,7 +1030,45 @@ def api_mark_notification_read(notification_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
+def create_app(config=None):
+    """Create the Flask application
+    
+    Settings come from config.Config, overridden by a config object or
+    mapping. The app sizes this process's read pools, fragment cache and
+    hashing pool from its settings, migrates the database to the latest
+    schema version and builds the name indexes. Under gunicorn with preload_app this runs
+    once in the master process and the workers inherit it when they fork.
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError('SECRET_KEY is not set')
+    
+    app.register_blueprint(bp)
+    app.before_request(limit_request_rate)
+    app.context_processor(inject_user)
+    CORS(app)
+    fragments.init_app(app)
+    
+    db.READ_POOL_SIZE = app.config['READ_POOL_SIZE']
+    fragments.cache.max_bytes = app.config['FRAGMENT_CACHE_BYTES']
+    passwords.configure(app.config['HASH_WORKERS'])
+    
+    # Create the database or bring its schema up to date; gunicorn does this
+    # once in the master, and other processes find it current
+    db.migrate()
+    
+    # Build the typeahead and near-duplicate name indexes before the first request
+    db.load_suggestions()
+    db.load_name_index()
+    return app
+
 if __name__ == '__main__':
+    app = create_app()
     print("\n" + "="*60)
     print("Laboratory Chemical Management System")
     print("="*60)
@@ -643,4 +1076,8 @@ if __name__ == '__main__':
     print("Access the application at: http://localhost:5000")
     print("\nPress Ctrl+C to stop the server")
     print("="*60 + "\n")
+    # The debug reloader imports the app twice; only the serving child runs jobs and tasks
+    if app.config['SCHEDULER_ENABLED'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        jobs.start_scheduler()
+        taskqueue.Worker().start()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Archival of old history records for the Chemical Management System
+
+Closed records older than a cutoff are moved out of the main database and
+any department shards into one SQLite file per year (archive/chemical_management_<year>.db) using ATTACH,
+a batch at a time, so the hot database only holds recent activity. Reads that
+need the full history go through get_history_connection(), which attaches the
+archives and exposes <table>_all UNION ALL views.
+
+    python archive.py                 # archive records older than 365 days
+    python archive.py --days 730      # use a different cutoff
+    python archive.py --vacuum        # also shrink the main database file
+"""
+
+import argparse
+import glob
+import os
+import re
+from datetime import date, timedelta
+import database as db
+
+ARCHIVE_AFTER_DAYS = 365
+BATCH_SIZE = 500
+
+# SQLite allows 10 attached databases by default; keep one slot spare
+MAX_ATTACHED_ARCHIVES = 9
+
+# Table -> (date column, condition for a record to be closed)
+ARCHIVED_TABLES = {
+    'notifications': ('created_at', 'is_read = 1'),
+    'chemical_requests': ('created_at', "status IN ('returned', 'rejected')"),
+    'borrow_history': ('borrow_date', 'actual_return_date IS NOT NULL'),
+    'activity_log': ('timestamp', '1 = 1'),
+}
+
+# Indexes created in each archive file to keep history lookups cheap
+ARCHIVE_INDEXES = {
+    'notifications': ['user_id', 'created_at'],
+    'chemical_requests': ['student_id', 'created_at'],
+    'borrow_history': ['student_id', 'borrow_date'],
+    'activity_log': ['user_id', 'timestamp'],
+}
+
+
+def get_archive_dir():
+    """Get the directory holding the yearly archive files"""
+    return os.path.join(os.path.dirname(os.path.abspath(db.DATABASE_NAME)), 'archive')
+
+
+def get_archive_path(year):
+    """Get the archive file for a year"""
+    return os.path.join(get_archive_dir(), f'chemical_management_{year}.db')
+
+
+def list_archive_years():
+    """Get the years that have an archive file, oldest first"""
+    years = []
+    for path in glob.glob(os.path.join(get_archive_dir(), 'chemical_management_*.db')):
+        match = re.search(r'_(\d{4})\.db$', path)
+        if match:
+            years.append(int(match.group(1)))
+    return sorted(years)
+
+
+def _columns(conn, schema, table):
+    """Get (name, declared type) for each column of a table"""
+    return [(row['name'], row['type']) for row in conn.execute(f'PRAGMA {schema}.table_info({table})')]
+
+
+def _ensure_archive_table(conn, schema, table):
+    """Create or extend the archive copy of a table to match the main table"""
+    main_columns = _columns(conn, 'main', table)
+    existing = {name for name, _ in _columns(conn, schema, table)}
+    if not existing:
+        definitions = ', '.join(
+            f'{name} INTEGER PRIMARY KEY' if name == 'id' else f'{name} {col_type}'
+            for name, col_type in main_columns
+        )
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {schema}.{table} ({definitions})')
+        for column in ARCHIVE_INDEXES.get(table, []):
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_{table}_{column} ON {table}({column})')
+    else:
+        for name, col_type in main_columns:
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {schema}.{table} ADD COLUMN {name} {col_type}')
+
+
+def _archive_table(conn, table, cutoff, batch_size):
+    """Move closed rows of one table older than cutoff into the yearly archives"""
+    date_column, closed = ARCHIVED_TABLES[table]
+    column_list = ', '.join(name for name, _ in _columns(conn, 'main', table))
+    years = [row[0] for row in conn.execute(f'''
+        SELECT DISTINCT strftime('%Y', {date_column}) FROM {table}
+        WHERE {date_column} < ? AND {closed}
+    ''', (cutoff,)) if row[0]]
+    moved = 0
+    for year in years:
+        os.makedirs(get_archive_dir(), exist_ok=True)
+        conn.execute('ATTACH DATABASE ? AS arc', (get_archive_path(year),))
+        try:
+            _ensure_archive_table(conn, 'arc', table)
+            conn.commit()
+            while True:
+                ids = [row[0] for row in conn.execute(f'''
+                    SELECT id FROM main.{table}
+                    WHERE {date_column} < ? AND strftime('%Y', {date_column}) = ? AND {closed}
+                    ORDER BY id LIMIT ?
+                ''', (cutoff, year, batch_size))]
+                if not ids:
+                    break
+                placeholders = ', '.join('?' * len(ids))
+                # SQLite does not commit across attached WAL files atomically, so the
+                # copy is committed before the delete; after a crash between the two,
+                # the next run copies the rows again (ignored) and deletes them
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO arc.{table} ({column_list})
+                    SELECT {column_list} FROM main.{table} WHERE id IN ({placeholders})
+                ''', ids)
+                conn.commit()
+                conn.execute(f'DELETE FROM main.{table} WHERE id IN ({placeholders})', ids)
+                conn.commit()
+                moved += len(ids)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute('DETACH DATABASE arc')
+    return moved
+
+
+def _upgrade_archives(conn):
+    """Add the columns the main tables have gained to the tables of every archive file"""
+    for year in list_archive_years():
+        conn.execute('ATTACH DATABASE ? AS arc', (get_archive_path(year),))
+        try:
+            for table in ARCHIVED_TABLES:
+                if _columns(conn, 'arc', table) and _columns(conn, 'main', table):
+                    _ensure_archive_table(conn, 'arc', table)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute('DETACH DATABASE arc')
+
+
+def archive_history(days=ARCHIVE_AFTER_DAYS, batch_size=BATCH_SIZE, vacuum=False):
+    """Move closed history records older than days from the main database and every shard into yearly archive files
+    
+    Archive files are only written here, so this is also where their tables
+    are brought up to the main schema.
+    """
+    cutoff = (date.today() - timedelta(days=days)).isoformat()
+    result = {table: 0 for table in ARCHIVED_TABLES}
+    for path in db.get_database_paths():
+        conn = db.get_db_connection(path)
+        try:
+            if path == db.DATABASE_NAME:
+                _upgrade_archives(conn)
+            for table in ARCHIVED_TABLES:
+                if _columns(conn, 'main', table):
+                    result[table] += _archive_table(conn, table, cutoff, batch_size)
+            if vacuum:
+                conn.execute('VACUUM')
+        finally:
+            conn.close()
+    result['cutoff'] = cutoff
+    return result
+
+
+def get_history_connection(years=None, path=None, hot=True):
+    """Open a connection with archives attached and <table>_all views over hot and archived rows
+    
+    path selects a shard instead of the main database; pass years=[] to read
+    only its hot rows, or hot=False for only the archived ones. Raises
+    ValueError for more than MAX_ATTACHED_ARCHIVES years, including when
+    years is None and more archive files exist; _query_history() reads them
+    in batches.
+    """
+    if years is None:
+        years = list_archive_years()
+    if len(years) > MAX_ATTACHED_ARCHIVES:
+        raise ValueError(f'At most {MAX_ATTACHED_ARCHIVES} archive years can be read at once, not {len(years)}')
+    conn = db.get_db_connection(path)
+    schemas = []
+    for year in years:
+        archive_path = get_archive_path(year)
+        if os.path.exists(archive_path):
+            schema = f'arc_{year}'
+            conn.execute(f'ATTACH DATABASE ? AS {schema}', (archive_path,))
+            schemas.append(schema)
+    for table in ARCHIVED_TABLES:
+        columns = [name for name, _ in _columns(conn, 'main', table)]
+        if not columns:
+            continue
+        column_list = ', '.join(columns)
+        selects = [f'SELECT {column_list} FROM main.{table}'] if hot else []
+        for schema in schemas:
+            archived = {name for name, _ in _columns(conn, schema, table)}
+            if archived:
+                # Archive files gain new columns when archiving next runs; until then they read as NULL
+                select_list = ', '.join(name if name in archived else f'NULL AS {name}' for name in columns)
+                selects.append(f'SELECT {select_list} FROM {schema}.{table}')
+        if not selects:
+            selects = [f'SELECT {column_list} FROM main.{table} WHERE 0']
+        conn.execute(f'CREATE TEMP VIEW {table}_all AS ' + ' UNION ALL '.join(selects))
+    return conn
+
+
+def _query_history(path, years, sql, params=()):
+    """Run a query against the <table>_all views, MAX_ATTACHED_ARCHIVES archive years at a time
+    
+    The hot rows are read with the first batch; the caller orders the merged rows.
+    """
+    if years is None:
+        years = list_archive_years()
+    batches = [years[index:index + MAX_ATTACHED_ARCHIVES] for index in range(0, len(years), MAX_ATTACHED_ARCHIVES)]
+    rows = []
+    for index, batch in enumerate(batches or [[]]):
+        conn = get_history_connection(batch, path, hot=index == 0)
+        try:
+            rows.extend(conn.execute(sql, params).fetchall())
+        finally:
+            conn.close()
+    return rows
+
+
+def get_full_borrow_history(student_id=None):
+    """Get borrow history including archived records"""
+    if student_id:
+        history = _query_history(db.get_user_database(student_id), None, '''
+            SELECT bh.*,
+                   c.name as chemical_name, c.chemical_formula
+            FROM borrow_history_all bh
+            LEFT JOIN chemicals c ON bh.chemical_id = c.id
+            WHERE bh.student_id = ?
+        ''', (student_id,))
+    else:
+        history = []
+        for path in db.get_database_paths():
+            # Archived rows are read once, through the main database
+            years = None if path == db.DATABASE_NAME else []
+            history.extend(_query_history(path, years, '''
+                SELECT bh.*,
+                       u.username, u.full_name, u.student_id as requester_student_id,
+                       c.name as chemical_name, c.chemical_formula
+                FROM borrow_history_all bh
+                LEFT JOIN users u ON bh.student_id = u.id
+                LEFT JOIN chemicals c ON bh.chemical_id = c.id
+            '''))
+    history.sort(key=lambda row: row['borrow_date'] or '', reverse=True)
+    return history
+
+
+def get_full_notifications(user_id):
+    """Get a user's notifications including archived (read) ones, newest first"""
+    notifications = _query_history(db.get_user_database(user_id), None, '''
+        SELECT * FROM notifications_all WHERE user_id = ?
+    ''', (user_id,))
+    notifications.sort(key=lambda row: row['created_at'] or '', reverse=True)
+    return notifications
+
+
+def get_full_activity_log(user_id=None, entity_type=None, entity_id=None, since=None, until=None, limit=100):
+    """Get activity log entries like database.get_activity_log, including archived ones"""
+    sql, params = db.activity_log_query(user_id, entity_type, entity_id, since, until, limit,
+                                        table='activity_log_all')
+    entries = _query_history(db.DATABASE_NAME, None, sql, params)
+    entries.sort(key=lambda row: (row['timestamp'] or '', row['id']), reverse=True)
+    return entries[:limit]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Archive old history records into yearly files')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                        help='archive closed records older than this many days')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--vacuum', action='store_true', help='shrink the main database file afterwards')
+    args = parser.parse_args()
+    result = archive_history(args.days, args.batch_size, args.vacuum)
+    print(f"Archived records older than {result.pop('cutoff')}:")
+    for table, moved in result.items():
+        print(f'  {table}: {moved}')
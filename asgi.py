@@ -0,0 +1,376 @@
+"""
+ASGI server for the Chemical Management System
+
+The read-only JSON API is served by async endpoints. They decode the Flask
+session cookie themselves and run their database.py calls on the bounded
+executor in aiodb.py, so a request thread is never held waiting on SQLite.
+A call that has not started is dropped, and a running one is interrupted,
+when its client disconnects. /api/notifications/stream pushes the unread
+notification count as server-sent events; an idle stream is just a waiting
+task, so thousands of them fit next to the API in one process.
+
+Everything else, including every write, goes to the Flask app mounted
+under the async routes and run on WSGI_THREADS threads:
+
+    SECRET_KEY=... uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from a2wsgi import WSGIMiddleware
+import database as db
+import aiodb
+import archive
+import auth
+import formula
+import passwords
+import ratelimit
+import suggest
+import valuation
+from app import create_app
+from config import ProductionConfig
+
+# Seconds between checks for new notifications, and at most between
+# heartbeats (and session re-checks) on a stream with nothing new; heartbeats
+# are spread over the last half of the interval so streams opened together
+# do not all take executor slots at once
+NOTIFICATION_POLL_INTERVAL = 2
+STREAM_HEARTBEAT_INTERVAL = 30
+
+
+class NotificationHub:
+    """Wakes the streams of users who got new notifications, from one polling task per process"""
+
+    def __init__(self, interval=NOTIFICATION_POLL_INTERVAL):
+        self.interval = interval
+        self.subscribers = 0
+        self._events = {}
+        self._since = {}
+        self._task = None
+
+    async def wait(self, user_id, timeout):
+        """Wait up to timeout seconds for a user's next notification; returns whether one came"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._poll())
+        event = self._events.setdefault(user_id, asyncio.Event())
+        self.subscribers += 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.subscribers -= 1
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.subscribers:
+                continue
+            try:
+                users, self._since = await aiodb.executor.run(db.get_notified_users, self._since)
+            except aiodb.DatabaseBusyError:
+                continue
+            for user_id in users:
+                event = self._events.pop(user_id, None)
+                if event is not None:
+                    event.set()
+
+    def close(self):
+        """Stop polling"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def _json(request, data, status_code=200):
+    """Encode data the way the Flask views' jsonify does"""
+    flask_app = request.app.state.flask_app
+    return Response(flask_app.json.dumps(data), status_code=status_code, media_type='application/json')
+
+
+def _arg(request, name, default=None, type=None):
+    """Get a query parameter like Flask's request.args.get, falling back to default when it does not convert"""
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    if type is None:
+        return value
+    try:
+        return type(value)
+    except ValueError:
+        return default
+
+
+def _session_data(request):
+    """Decode the signed Flask session cookie, or get {} if it is missing or invalid"""
+    flask_app = request.app.state.flask_app
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+async def _authorize(request, role=None):
+    """Get the signed-in user's (ID, role), raising 401 without a valid session and 403 without the role"""
+    data = _session_data(request)
+    current_role = await aiodb.executor.run(auth.get_claimed_role, data, request=request)
+    if current_role is None:
+        raise HTTPException(401, 'Please login to access this page.')
+    if role is not None and current_role != role:
+        raise HTTPException(403, 'You do not have permission to access this page.')
+    return data['user_id'], current_role
+
+
+async def _limit_search_rate(request):
+    """Take a search token for the client, waiting for it without holding a thread"""
+    data = _session_data(request)
+    client = f"user:{data['user_id']}" if 'user_id' in data else f'ip:{request.client.host}'
+    delay = await aiodb.executor.run(ratelimit.limiter.take, 'search', client, request=request)
+    if delay:
+        await asyncio.sleep(delay)
+
+
+async def api_get_chemicals(request):
+    """Get all chemicals"""
+    chemicals = await aiodb.executor.run(db.get_all_chemicals, request=request)
+    return _json(request, [dict(c) for c in chemicals])
+
+
+async def api_get_chemical(request):
+    """Get a specific chemical"""
+    chemical = await aiodb.executor.run(db.get_chemical_by_id, request.path_params['chemical_id'], request=request)
+    if not chemical:
+        return _json(request, {'error': 'Chemical not found'}, 404)
+    return _json(request, dict(chemical))
+
+
+async def api_get_inventory(request):
+    """Get inventory summary"""
+    summary = await aiodb.executor.run(db.get_inventory_summary, request=request)
+    return _json(request, dict(summary))
+
+
+async def api_get_chemical_inventory(request):
+    """Get inventory for a specific chemical"""
+    inventory = await aiodb.executor.run(db.get_inventory_for_chemical, request.path_params['chemical_id'],
+                                         request=request)
+    return _json(request, [dict(i) for i in inventory])
+
+
+async def api_get_locations(request):
+    """Get all storage locations"""
+    locations = await aiodb.executor.run(db.get_all_storage_locations, request=request)
+    return _json(request, [dict(l) for l in locations])
+
+
+async def api_get_hazards(request):
+    """Get all hazard categories"""
+    hazards = await aiodb.executor.run(db.get_all_hazard_categories, request=request)
+    return _json(request, [dict(h) for h in hazards])
+
+
+async def api_search(request):
+    """Search chemicals"""
+    await _limit_search_rate(request)
+    query = _arg(request, 'q', '')
+    if not query:
+        return _json(request, [])
+    chemicals = await aiodb.executor.run(db.search_chemicals, query, request=request)
+    return _json(request, [dict(c) for c in chemicals])
+
+
+async def api_search_composition(request):
+    """Chemicals containing every listed element, optionally within a formula weight range"""
+    await _limit_search_rate(request)
+    chemicals = await aiodb.executor.run(db.search_by_composition,
+                                         formula.element_symbols(_arg(request, 'elements')),
+                                         _arg(request, 'min_weight', type=float),
+                                         _arg(request, 'max_weight', type=float),
+                                         _arg(request, 'limit', 100, type=int), request=request)
+    return _json(request, [dict(c) for c in chemicals])
+
+
+async def api_suggest(request):
+    """Typeahead suggestions for a name, synonym, formula or CAS number prefix"""
+    await _limit_search_rate(request)
+    suggestions = await aiodb.executor.run(db.suggest_chemicals, _arg(request, 'q', ''),
+                                           _arg(request, 'limit', suggest.MAX_SUGGESTIONS, type=int),
+                                           request=request)
+    return _json(request, suggestions)
+
+
+async def api_get_requests(request):
+    """Get requests (all for admin, own for student)"""
+    user_id, role = await _authorize(request)
+    if role == 'admin':
+        requests = await aiodb.executor.run(db.get_all_requests, _arg(request, 'status'), request=request)
+    else:
+        requests = await aiodb.executor.run(db.get_requests_by_student, user_id, request=request)
+    return _json(request, [dict(r) for r in requests])
+
+
+async def api_get_request(request):
+    """Get request details"""
+    await _authorize(request)
+    req = await aiodb.executor.run(db.get_request_by_id, request.path_params['request_id'], request=request)
+    if not req:
+        return _json(request, {'error': 'Request not found'}, 404)
+    return _json(request, dict(req))
+
+
+async def api_get_borrowed(request):
+    """Get borrowed items"""
+    user_id, role = await _authorize(request)
+    items = await aiodb.executor.run(db.get_borrowed_items, None if role == 'admin' else user_id, request=request)
+    return _json(request, [dict(i) for i in items])
+
+
+async def api_get_borrow_history(request):
+    """Get borrow history (all for admin, own for student), optionally including archived records"""
+    user_id, role = await _authorize(request)
+    student_id = None if role == 'admin' else user_id
+    if _arg(request, 'include_archived') == '1':
+        history = await aiodb.executor.run(archive.get_full_borrow_history, student_id, request=request)
+    else:
+        history = await aiodb.executor.run(db.get_borrow_history, student_id, request=request)
+    return _json(request, [dict(h) for h in history])
+
+
+async def api_get_valuation(request):
+    """Stock value by location, hazard class, supplier and expiry bucket - Admin only"""
+    await _authorize(request, 'admin')
+    return _json(request, await aiodb.executor.run(valuation.get_valuation, request=request))
+
+
+async def api_get_department_costs(request):
+    """Cost of borrowed stock per department over an optional date range - Admin only"""
+    await _authorize(request, 'admin')
+    try:
+        costs = await aiodb.executor.run(valuation.get_department_costs, _arg(request, 'start'),
+                                         _arg(request, 'end'), request=request)
+    except ValueError as e:
+        return _json(request, {'success': False, 'error': str(e)}, 400)
+    return _json(request, costs)
+
+
+async def api_get_db_executor_stats(request):
+    """Async API executor size, queue depth and call counts - Admin only"""
+    await _authorize(request, 'admin')
+    return _json(request, {**aiodb.executor.stats(),
+                           'streams': request.app.state.notifications.subscribers})
+
+
+def _stream_state(data, user_id):
+    """Get a stream user's unread count, or None if their session claims no longer hold"""
+    if auth.get_claimed_role(data) is None:
+        return None
+    return db.get_unread_count(user_id)
+
+
+async def api_notification_stream(request):
+    """Server-sent events with the signed-in user's unread notification count whenever it changes"""
+    data = _session_data(request)
+    user_id = data.get('user_id')
+    count = await aiodb.executor.run(_stream_state, data, user_id, request=request) if user_id else None
+    if count is None:
+        raise HTTPException(401, 'Please login to access this page.')
+    hub = request.app.state.notifications
+
+    async def events():
+        last_count = count
+        yield f'event: unread\ndata: {count}\n\n'
+        while True:
+            await hub.wait(user_id, STREAM_HEARTBEAT_INTERVAL * random.uniform(0.5, 1))
+            try:
+                # Revoked sessions are noticed here, at least every heartbeat
+                current = await aiodb.executor.run(_stream_state, data, user_id)
+            except aiodb.DatabaseBusyError:
+                current = last_count
+            if current is None:
+                return
+            if current != last_count:
+                last_count = current
+                yield f'event: unread\ndata: {current}\n\n'
+            else:
+                yield ': keepalive\n\n'
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def _http_error(request, exc):
+    return _json(request, {'success': False, 'error': exc.detail}, exc.status_code)
+
+
+async def _database_busy(request, exc):
+    return _json(request, {'success': False, 'error': str(exc)}, 503)
+
+
+async def _rate_limited(request, exc):
+    response = _json(request, {'success': False, 'error': str(exc)}, 429)
+    response.headers['Retry-After'] = str(exc.retry_after)
+    return response
+
+
+async def _client_disconnected(request, exc):
+    # Nobody is left to read the response
+    return Response(status_code=499)
+
+
+def create_asgi_app(config=None):
+    """Create the ASGI application: the async API in front of the Flask app from create_app(config)"""
+    flask_app = create_app(config)
+    aiodb.configure(flask_app.config['DB_EXECUTOR_THREADS'])
+    notifications = NotificationHub()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        notifications.close()
+        aiodb.executor.shutdown()
+        passwords.pool.shutdown()
+
+    routes = [
+        Route('/api/chemicals', api_get_chemicals),
+        Route('/api/chemicals/composition', api_search_composition),
+        Route('/api/chemicals/{chemical_id:int}', api_get_chemical),
+        Route('/api/inventory', api_get_inventory),
+        Route('/api/inventory/{chemical_id:int}', api_get_chemical_inventory),
+        Route('/api/locations', api_get_locations),
+        Route('/api/hazards', api_get_hazards),
+        Route('/api/search', api_search),
+        Route('/api/suggest', api_suggest),
+        Route('/api/requests', api_get_requests),
+        Route('/api/requests/{request_id:int}', api_get_request),
+        Route('/api/borrowed', api_get_borrowed),
+        Route('/api/borrow-history', api_get_borrow_history),
+        Route('/api/reports/valuation', api_get_valuation),
+        Route('/api/reports/department-costs', api_get_department_costs),
+        Route('/api/admin/db-executor', api_get_db_executor_stats),
+        Route('/api/notifications/stream', api_notification_stream),
+        # Other methods on these paths, and every other URL, are served by Flask
+        Mount('/', WSGIMiddleware(flask_app, workers=flask_app.config['WSGI_THREADS'])),
+    ]
+    app = Starlette(routes=routes, lifespan=lifespan, exception_handlers={
+        HTTPException: _http_error,
+        aiodb.DatabaseBusyError: _database_busy,
+        aiodb.ClientDisconnected: _client_disconnected,
+        ratelimit.RateLimited: _rate_limited,
+    })
+    app.state.flask_app = flask_app
+    app.state.notifications = notifications
+    return app
+
+
+app = create_asgi_app(ProductionConfig)
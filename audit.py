@@ -0,0 +1,166 @@
+"""
+Buffered audit logging for the Chemical Management System
+
+Routes call log_event(), which only puts the event on a bounded in-memory
+queue. A background thread writes queued events to activity_log in batches,
+either when BATCH_SIZE events are waiting or FLUSH_INTERVAL seconds after the
+first one arrived. When the queue is full, events are dropped and counted
+rather than slowing the request down. A batch that cannot be written because
+the database is busy or locked is retried with a growing delay, while new
+events keep queueing, and is only dropped once its attempts run out.
+"""
+
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+import database as db
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 2.0
+# Attempts at writing a batch when the database is busy or locked, the first
+# retry RETRY_DELAY seconds after a failure and each further one twice as long
+WRITE_ATTEMPTS = 5
+RETRY_DELAY = 0.5
+
+
+class AuditWriter:
+    """Bounded queue of audit events flushed by a background thread"""
+
+    def __init__(self, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 write_attempts=WRITE_ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_attempts = write_attempts
+        self.retry_delay = retry_delay
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.retries = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_ms = None
+        self._counter_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def log(self, user_id, action, entity_type=None, entity_id=None, description=None):
+        """Queue an event without blocking, returning False if it was dropped"""
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            self.queue.put_nowait((user_id, action, entity_type, entity_id, description, timestamp))
+        except queue.Full:
+            with self._counter_lock:
+                self.dropped += 1
+            return False
+        with self._counter_lock:
+            self.enqueued += 1
+        self.start()
+        return True
+
+    def start(self):
+        """Start the flush thread if it is not already running"""
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the flush thread after writing everything still queued"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self.flush()
+
+    def flush(self):
+        """Write everything currently queued"""
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def stats(self):
+        """Get queue depth and write counters"""
+        with self._counter_lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queue_capacity': self.queue.maxsize,
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'dropped': self.dropped,
+                'retries': self.retries,
+                'failed': self.failed,
+                'flushes': self.flushes,
+                'last_flush_ms': self.last_flush_ms,
+                'running': bool(self._thread and self._thread.is_alive())
+            }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop.is_set():
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        for attempt in range(self.write_attempts):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                with self._counter_lock:
+                    self.retries += 1
+            started = time.perf_counter()
+            try:
+                db.insert_activity_log(batch)
+            except sqlite3.OperationalError:
+                # Busy or locked; the batch waits here while new events wait in the queue
+                continue
+            except Exception:
+                break
+            with self._counter_lock:
+                self.written += len(batch)
+                self.flushes += 1
+                self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+            return
+        with self._counter_lock:
+            self.failed += len(batch)
+
+
+writer = AuditWriter()
+atexit.register(writer.stop)
+
+
+def log_event(user_id, action, entity_type=None, entity_id=None, description=None):
+    """Queue an audit event on the shared writer"""
+    return writer.log(user_id, action, entity_type, entity_id, description)
+
+
+def get_stats():
+    """Get statistics for the shared writer"""
+    return writer.stats()
@@ -1,12 +1,24 @@
 """
 Authentication utilities and decorators for the Chemical Management System
+
+login() stores the user's role and auth_version in the signed session, and
+the decorators trust them without reading the users table. Deactivating a
+user or changing their role bumps their auth_version, so their sessions stop
+matching. Each process keeps the versions of users whose sessions were ever
+revoked and re-reads them when the 'auth' cache version changes, checking at
+most every AUTH_CHECK_INTERVAL seconds.
 """
 
+import threading
+import time
 from functools import wraps
 from flask import session, redirect, url_for, flash
 from flask_login import UserMixin
 import database as db
 
+# Seconds a revocation made by another process can take to apply here
+AUTH_CHECK_INTERVAL = 5
+
 class User(UserMixin):
     """User class for Flask-Login"""
     
@@ -43,50 +55,107 @@ class User(UserMixin):
             )
         return None
 
-def login_required(f):
-    """Decorator to require login for a route"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Please login to access this page.', 'warning')
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+class AuthVersions:
+    """In-process copy of users' auth_version, re-read when the 'auth' cache version changes"""
+    
+    def __init__(self, interval=AUTH_CHECK_INTERVAL):
+        self.interval = interval
+        self.version = None
+        self._versions = {}
+        self._checked_at = None
+        self._lock = threading.Lock()
+    
+    def get(self, user_id):
+        """Get a user's current auth_version"""
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.interval:
+            with self._lock:
+                if self._checked_at is None or now - self._checked_at >= self.interval:
+                    if db.get_cache_versions('auth')[0] != self.version:
+                        self.version, self._versions = db.get_auth_versions()
+                    self._checked_at = now
+        return self._versions.get(user_id, 0)
+    
+    def expire(self):
+        """Check for changed versions on the next lookup, after a revocation in this process"""
+        self._checked_at = None
 
-def admin_required(f):
-    """Decorator to require admin role for a route"""
+versions = AuthVersions()
+
+def start_session(user):
+    """Store a user's identity and authorization claims in the session"""
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    session['role'] = user['role']
+    session['auth_version'] = user['auth_version']
+
+def _session_role():
+    """Get the role of the signed-in user, or None if there is none or their session was revoked"""
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    if 'auth_version' not in session:
+        # Sessions from before claims were stored are checked against the database once
+        user = db.get_user_by_id(user_id)
+        if not user or not user['is_active']:
+            session.clear()
+            return None
+        start_session(user)
+    if session['auth_version'] != versions.get(user_id):
+        session.clear()
+        return None
+    return session.get('role')
+
+def get_claimed_role(data):
+    """Get the role claimed by decoded session data if its claims still hold, for callers outside Flask"""
+    user_id = data.get('user_id')
+    if user_id is None:
+        return None
+    if 'auth_version' not in data:
+        user = db.get_user_by_id(user_id)
+        if not user or not user['is_active']:
+            return None
+        return user['role'] if user['auth_version'] == versions.get(user_id) else None
+    if data['auth_version'] != versions.get(user_id):
+        return None
+    return data.get('role')
+
+def _authorize(f, role=None):
+    """Wrap a route to require a signed-in user, with a role if given"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        current_role = _session_role()
+        if current_role is None:
             flash('Please login to access this page.', 'warning')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         
-        user = db.get_user_by_id(session['user_id'])
-        if not user or user['role'] != 'admin':
+        if role is not None and current_role != role:
             flash('You do not have permission to access this page.', 'danger')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         
         return f(*args, **kwargs)
     return decorated_function
 
+def login_required(f):
+    """Decorator to require login for a route"""
+    return _authorize(f)
+
+def admin_required(f):
+    """Decorator to require admin role for a route"""
+    return _authorize(f, 'admin')
+
 def student_required(f):
     """Decorator to require student role for a route"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Please login to access this page.', 'warning')
-            return redirect(url_for('login'))
-        
-        user = db.get_user_by_id(session['user_id'])
-        if not user or user['role'] != 'student':
-            flash('You do not have permission to access this page.', 'danger')
-            return redirect(url_for('index'))
-        
-        return f(*args, **kwargs)
-    return decorated_function
+    return _authorize(f, 'student')
+
+def get_session_user():
+    """Get the signed-in user's id, username and role from the session, without reading the database"""
+    if _session_role() is not None:
+        return {'id': session['user_id'], 'username': session.get('username'), 'role': session['role']}
+    return None
 
 def get_current_user():
-    """Get the currently logged in user"""
-    if 'user_id' in session:
+    """Get the currently logged in user's full row, for views that need more than get_session_user"""
+    if _session_role() is not None:
         return db.get_user_by_id(session['user_id'])
     return None
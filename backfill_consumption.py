@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Rebuild the consumption rollups of the Chemical Management System
+
+Recomputes consumption_daily and consumption_monthly in the main database and
+every department shard from borrow history, including archived records.
+Borrows and returns keep the rollups current; run this once after upgrading
+and whenever borrow history has been edited directly in the database, or
+queue it for a task worker with python worker.py enqueue rebuild-rollups.
+"""
+
+import archive
+import database as db
+
+
+def backfill():
+    """Rebuild the rollups of every database file, returning {path: daily rollup rows}"""
+    db.migrate()
+    result = {}
+    for path in db.get_database_paths():
+        # Archived rows are counted once, in the main database's rollups
+        years = None if path == db.DATABASE_NAME else []
+        conn = archive.get_history_connection(years, path)
+        try:
+            result[path] = db.rebuild_consumption(conn, 'borrow_history_all')
+            conn.commit()
+        finally:
+            conn.close()
+    return result
+
+
+if __name__ == '__main__':
+    for path, rows in backfill().items():
+        print(f'{path}: {rows} daily rollup rows')
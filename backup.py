@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Online backups for the Chemical Management System
+
+Snapshots are taken with sqlite3.Connection.backup a few pages at a time, so
+the server keeps running and writers are only held up for one short step.
+Each backup reports its throughput and the longest time a lock was held.
+Department shard files are snapshotted alongside the main database.
+
+    python backup.py snapshot          # take a snapshot and prune old ones
+    python backup.py list              # list snapshots
+    python backup.py verify PATH       # run an integrity check on a snapshot
+    python backup.py restore PATH      # restore the database and shards from a snapshot set
+"""
+
+import argparse
+import glob
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+import database as db
+
+PAGES_PER_STEP = 256
+STEP_PAUSE = 0.005
+RETENTION = 14
+
+
+def get_backup_dir():
+    """Get the directory holding snapshots"""
+    return os.path.join(os.path.dirname(os.path.abspath(db.DATABASE_NAME)), 'backups')
+
+
+def _snapshot_name(database_path):
+    """Get the snapshot file prefix for a database file"""
+    return os.path.splitext(os.path.basename(database_path))[0]
+
+
+def _copy(source, target, pages_per_step=PAGES_PER_STEP, pause=STEP_PAUSE):
+    """Copy source into target page by page, returning timing statistics"""
+    steps = []
+    state = {'step_started': time.perf_counter()}
+
+    def progress(status, remaining, total):
+        steps.append(time.perf_counter() - state['step_started'])
+        state['total_pages'] = total
+        if remaining and pause:
+            time.sleep(pause)
+        state['step_started'] = time.perf_counter()
+
+    started = time.perf_counter()
+    source.backup(target, pages=pages_per_step, progress=progress)
+    elapsed = time.perf_counter() - started
+
+    page_size = source.execute('PRAGMA page_size').fetchone()[0]
+    size_mb = state.get('total_pages', 0) * page_size / (1024 * 1024)
+    return {
+        'size_mb': round(size_mb, 3),
+        'seconds': round(elapsed, 3),
+        'throughput_mb_s': round(size_mb / elapsed, 2) if elapsed else None,
+        'steps': len(steps),
+        'max_lock_ms': round(max(steps) * 1000, 3) if steps else 0,
+        'total_lock_ms': round(sum(steps) * 1000, 3)
+    }
+
+
+def backup_to(path, pages_per_step=PAGES_PER_STEP, pause=STEP_PAUSE, database_path=None):
+    """Back up the live database, or one shard file, to path"""
+    source = db.get_db_connection(database_path)
+    target = sqlite3.connect(path)
+    try:
+        stats = _copy(source, target, pages_per_step, pause)
+    finally:
+        target.close()
+        source.close()
+    stats['path'] = path
+    return stats
+
+
+def verify(path):
+    """Run an integrity check on a backup file, returning True if it is sound"""
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        conn.close()
+    return result == 'ok'
+
+
+def list_snapshots(database_path=None):
+    """Get snapshot paths of the main database or a shard file, newest first"""
+    name = _snapshot_name(database_path or db.DATABASE_NAME)
+    return sorted(glob.glob(os.path.join(get_backup_dir(), f'{glob.escape(name)}-*.db')), reverse=True)
+
+
+def prune(retention=RETENTION, database_path=None):
+    """Delete all but the newest retention snapshots, returning the deleted paths"""
+    removed = list_snapshots(database_path)[retention:]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def _snapshot_file(database_path, stamp, retention):
+    path = os.path.join(get_backup_dir(), f'{_snapshot_name(database_path)}-{stamp}.db')
+    stats = backup_to(path, database_path=database_path)
+    stats['verified'] = verify(path)
+    if not stats['verified']:
+        os.remove(path)
+        raise RuntimeError(f'Snapshot failed integrity check: {path}')
+    stats['pruned'] = len(prune(retention, database_path))
+    return stats
+
+
+def snapshot(retention=RETENTION):
+    """Take verified snapshots of the live database and its shards and apply retention"""
+    os.makedirs(get_backup_dir(), exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    paths = db.get_database_paths()
+    stats = _snapshot_file(paths[0], stamp, retention)
+    stats['shards'] = [_snapshot_file(path, stamp, retention) for path in paths[1:]]
+    return stats
+
+
+def _snapshot_set(path):
+    """Get the (snapshot, database file) pairs taken together with a snapshot, main database first"""
+    match = re.search(r'-(\d{8}-\d{6})\.db$', os.path.basename(path))
+    if not match:
+        raise RuntimeError(f'Not a snapshot file: {path}')
+    directory = os.path.dirname(path)
+    main_snapshot = os.path.join(directory, f'{_snapshot_name(db.DATABASE_NAME)}-{match.group(1)}.db')
+    if not os.path.exists(main_snapshot):
+        raise RuntimeError(f'No main database snapshot taken with {path}')
+    conn = sqlite3.connect(f'file:{main_snapshot}?mode=ro', uri=True)
+    try:
+        shard_paths = [row[0] for row in conn.execute('SELECT path FROM shards ORDER BY id')]
+    finally:
+        conn.close()
+    pairs = [(main_snapshot, db.DATABASE_NAME)] + [
+        (os.path.join(directory, f'{_snapshot_name(shard_path)}-{match.group(1)}.db'), shard_path)
+        for shard_path in shard_paths
+    ]
+    missing = [snapshot_path for snapshot_path, _ in pairs if not os.path.exists(snapshot_path)]
+    if missing:
+        raise RuntimeError(f"Snapshot set is incomplete, missing: {', '.join(missing)}")
+    return pairs
+
+
+def _restore_file(snapshot_path, database_path):
+    source = sqlite3.connect(f'file:{snapshot_path}?mode=ro', uri=True)
+    target = db.get_db_connection(database_path)
+    try:
+        stats = _copy(source, target, pages_per_step=-1, pause=0)
+    finally:
+        target.close()
+        source.close()
+    stats['path'] = snapshot_path
+    return stats
+
+
+def restore(path):
+    """Restore the main database and every shard from the snapshot set path belongs to
+    
+    Every file is checked before any is replaced. Afterwards every cache
+    version and auth_version is moved past its value before the restore, so
+    a server left running drops its cached fragments, name indexes and
+    sessions instead of serving content from after the snapshot.
+    """
+    pairs = _snapshot_set(path)
+    for snapshot_path, _ in pairs:
+        if not verify(snapshot_path):
+            raise RuntimeError(f'Snapshot failed integrity check: {snapshot_path}')
+    stamps = db.get_version_stamps()
+    db.close_connections()
+    stats = _restore_file(*pairs[0])
+    stats['shards'] = [_restore_file(snapshot_path, database_path) for snapshot_path, database_path in pairs[1:]]
+    db.advance_version_stamps(stamps)
+    return stats
+
+
+def _print_stats(stats):
+    print(f"  File:        {stats['path']}")
+    print(f"  Size:        {stats['size_mb']} MB in {stats['seconds']} s ({stats['throughput_mb_s']} MB/s)")
+    print(f"  Lock held:   {stats['max_lock_ms']} ms max, {stats['total_lock_ms']} ms total over {stats['steps']} steps")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Back up and restore the chemical management database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    snapshot_parser = subparsers.add_parser('snapshot', help='take a snapshot and prune old ones')
+    snapshot_parser.add_argument('--retention', type=int, default=RETENTION)
+    subparsers.add_parser('list', help='list snapshots')
+    verify_parser = subparsers.add_parser('verify', help='check a snapshot')
+    verify_parser.add_argument('path')
+    restore_parser = subparsers.add_parser('restore', help='restore the database from a snapshot')
+    restore_parser.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'snapshot':
+        stats = snapshot(args.retention)
+        print("✓ Snapshot taken")
+        for file_stats in [stats] + stats['shards']:
+            _print_stats(file_stats)
+            print(f"  Pruned:      {file_stats['pruned']} old snapshot(s)")
+    elif args.command == 'list':
+        for database_path in db.get_database_paths():
+            for path in list_snapshots(database_path):
+                print(f"{path}  ({os.path.getsize(path) / (1024 * 1024):.2f} MB)")
+    elif args.command == 'verify':
+        if verify(args.path):
+            print(f"✓ {args.path} passed the integrity check")
+        else:
+            print(f"✗ {args.path} failed the integrity check")
+            exit(1)
+    elif args.command == 'restore':
+        print("Stop the web server, task workers and jobs before restoring; everyone will have to sign in again.")
+        targets = ', '.join(database_path for _, database_path in _snapshot_set(args.path))
+        response = input(f"Replace {targets} with the snapshots taken with {args.path}? (yes/no): ")
+        if response.lower() == 'yes':
+            stats = restore(args.path)
+            print("✓ Database restored")
+            for file_stats in [stats] + stats['shards']:
+                _print_stats(file_stats)
+        else:
+            print("\nOperation cancelled.")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for a running Chemical Management System server
+
+Each client signs in as the given user and requests the pages and API
+endpoints in PATHS in turn for the given number of seconds, then the
+requests per second and latency percentiles are printed, overall and per
+path. Search and typeahead are left out because their rate limits would
+measure ratelimit.LIMITS rather than the server.
+
+    python benchmark.py --url http://localhost:8000 --clients 16 --seconds 30
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, build_opener
+
+PATHS = (
+    '/',
+    '/inventory',
+    '/chemical/{chemical_id}',
+    '/api/chemicals',
+    '/api/chemicals/{chemical_id}',
+    '/api/inventory',
+    '/api/inventory/{chemical_id}',
+    '/api/locations',
+)
+
+
+def sign_in(url, username, password):
+    """Get an opener holding a signed-in session cookie"""
+    opener = build_opener(HTTPCookieProcessor(CookieJar()))
+    opener.open(f'{url}/login', urlencode({'username': username, 'password': password}).encode()).read()
+    if '/login' in opener.open(f'{url}/').geturl():
+        raise SystemExit(f'Could not sign in as {username}')
+    return opener
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 1)
+
+
+def _summary(timings, errors, seconds):
+    ordered = sorted(timings)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'per_second': round(len(ordered) / seconds, 1),
+        'p50_ms': _percentile(ordered, 0.5),
+        'p95_ms': _percentile(ordered, 0.95),
+        'p99_ms': _percentile(ordered, 0.99)
+    }
+
+
+def run(url, username, password, clients, seconds):
+    """Run the benchmark and return the overall and per-path results"""
+    openers = [sign_in(url, username, password) for _ in range(clients)]
+    chemical_ids = [chemical['id'] for chemical in json.load(openers[0].open(f'{url}/api/chemicals'))]
+    if not chemical_ids:
+        raise SystemExit('The database has no chemicals to request')
+    timings = {path: [] for path in PATHS}
+    errors = {path: 0 for path in PATHS}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(number, opener):
+        request = number
+        while time.perf_counter() < deadline:
+            path = PATHS[request % len(PATHS)]
+            target = url + path.format(chemical_id=chemical_ids[request % len(chemical_ids)])
+            request += 1
+            started = time.perf_counter()
+            try:
+                with opener.open(target) as response:
+                    response.read()
+                    failed = response.status != 200
+            except (HTTPError, OSError):
+                failed = True
+            elapsed = time.perf_counter() - started
+            with lock:
+                timings[path].append(elapsed)
+                errors[path] += failed
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(number, opener)) for number, opener in enumerate(openers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'clients': clients,
+        'seconds': round(elapsed, 1),
+        'total': _summary([t for path in PATHS for t in timings[path]], sum(errors.values()), elapsed),
+        'paths': {path: _summary(timings[path], errors[path], elapsed) for path in PATHS}
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--username', default='admin1')
+    parser.add_argument('--password', default='Admin123!')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=30)
+    args = parser.parse_args()
+    print(json.dumps(run(args.url.rstrip('/'), args.username, args.password, args.clients, args.seconds), indent=2))
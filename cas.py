@@ -0,0 +1,100 @@
+"""
+CAS registry numbers for the Chemical Management System
+
+A CAS number is 2-7 digits, 2 digits and a check digit, written with hyphens
+(7647-01-0). The check digit is the sum of the other digits, each multiplied
+by its position counted from the right, modulo 10. Numbers are stored in
+canonical hyphenated form together with an integer key made of their digits
+(7647010), so exact lookups and duplicate checks compare integers.
+"""
+
+import re
+
+# Hyphens, dashes and spaces people type between the groups
+_SEPARATORS = re.compile(r'[\s\-‐-―]+')
+# A search string shaped like a CAS number: groups of 2-7, 2 and 1 digits
+_CAS_LIKE = re.compile(r'\s*\d{2,7}\s*[\-‐-―]\s*\d{2}\s*[\-‐-―]\s*\d\s*')
+
+
+class CASError(ValueError):
+    """Raised when a CAS number is malformed or fails its check digit"""
+
+
+class DuplicateCASError(CASError):
+    """Raised when a CAS number is already registered to another chemical"""
+
+
+def _check_digit(digits):
+    """Compute the check digit for the digits before it"""
+    total = 0
+    for position, digit in enumerate(reversed(digits), 1):
+        total += position * (ord(digit) - 48)
+    return total % 10
+
+
+def parse(text):
+    """Validate a CAS number, returning its integer key
+
+    Accepts hyphenated, dash- or space-separated and bare-digit forms.
+    """
+    text = str(text)
+    digits = text.replace('-', '')
+    if not (digits.isascii() and digits.isdigit()):
+        digits = _SEPARATORS.sub('', text)
+    digits = digits.lstrip('0')
+    if not (5 <= len(digits) <= 10 and digits.isascii() and digits.isdigit()):
+        raise CASError(f'"{text}" is not a CAS number (expected e.g. 7647-01-0)')
+    if _check_digit(digits[:-1]) != ord(digits[-1]) - 48:
+        raise CASError(f'CAS number "{text}" fails its check digit')
+    return int(digits)
+
+
+def format_key(key):
+    """Format an integer key as a hyphenated CAS number"""
+    digits = str(key)
+    return f'{digits[:-3]}-{digits[-3:-1]}-{digits[-1]}'
+
+
+def normalize(text):
+    """Get the (canonical CAS number, integer key) for text, or (None, None) when blank"""
+    if text is None or not str(text).strip():
+        return None, None
+    key = parse(text)
+    return format_key(key), key
+
+
+def looks_like(text):
+    """Whether a search string is shaped like a hyphenated CAS number"""
+    return bool(text) and _CAS_LIKE.fullmatch(text) is not None
+
+
+def validate_many(values, seen=None, start=0):
+    """Validate CAS numbers in bulk
+
+    Returns (keys, errors, duplicates): the integer key of each value (None
+    when blank or invalid), (index, message) for invalid values and
+    (index, first index) for repeats. Pass the same seen dict to successive
+    calls, with start set to the index of their first value, to check a large
+    file in chunks.
+    """
+    seen = {} if seen is None else seen
+    keys = []
+    errors = []
+    duplicates = []
+    for index, value in enumerate(values, start):
+        if value is None or not str(value).strip():
+            keys.append(None)
+            continue
+        try:
+            key = parse(value)
+        except CASError as e:
+            keys.append(None)
+            errors.append((index, str(e)))
+            continue
+        first = seen.setdefault(key, index)
+        if first != index:
+            keys.append(None)
+            duplicates.append((index, first))
+        else:
+            keys.append(key)
+    return keys, errors, duplicates
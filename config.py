@@ -0,0 +1,51 @@
+"""
+Configuration for the Chemical Management System
+
+create_app() in app.py loads Config and then the object or mapping passed to
+it. ProductionConfig is used by wsgi.py under gunicorn (see gunicorn.conf.py)
+and by asgi.py under uvicorn; its per-process settings are sized for WORKERS processes of THREADS threads
+each, so that together they fit one SQLite database and one machine.
+"""
+
+import os
+from datetime import timedelta
+
+CPU_COUNT = os.cpu_count() or 1
+# gunicorn worker processes and request threads per worker
+WORKERS = int(os.environ.get('WEB_CONCURRENCY', CPU_COUNT))
+THREADS = int(os.environ.get('WEB_THREADS', 4))
+# Memory for rendered fragments, shared out between the workers
+FRAGMENT_CACHE_BUDGET = 256 * 1024 * 1024
+
+
+class Config:
+    """Development server settings"""
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
+    PERMANENT_SESSION_LIFETIME = timedelta(hours=24)
+    # Run the background jobs and a task queue worker in the web process
+    SCHEDULER_ENABLED = True
+    # Read-only connections per database file in each process
+    READ_POOL_SIZE = 8
+    FRAGMENT_CACHE_BYTES = 64 * 1024 * 1024
+    # Password hashing processes per web process
+    HASH_WORKERS = CPU_COUNT
+    # asgi.py: threads running the async API's queries, each with its own
+    # read connections, and threads running the Flask views it mounts
+    DB_EXECUTOR_THREADS = 8
+    WSGI_THREADS = 8
+
+
+class ProductionConfig(Config):
+    """Settings for each gunicorn worker"""
+    # Must be set in the environment; create_app refuses to start without it
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    # Jobs run once per site, so they run in their own process (python jobs.py),
+    # and queued tasks in python worker.py
+    SCHEDULER_ENABLED = False
+    # A thread holds at most one read connection, and SQLite gains nothing
+    # from more readers than there are threads to use them
+    READ_POOL_SIZE = THREADS
+    FRAGMENT_CACHE_BYTES = FRAGMENT_CACHE_BUDGET // WORKERS
+    # Hashing is CPU-bound, so all workers together use one process per CPU
+    HASH_WORKERS = max(1, CPU_COUNT // WORKERS)
+    WSGI_THREADS = THREADS
@@ -1,22 +1,577 @@
 import sqlite3
+import json
 import os
-from datetime import datetime
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from urllib.parse import quote
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import segregation
+import limits
+import suggest
+import cas
+import formula
+import similarity
 
 DATABASE_NAME = 'chemical_management.db'
 
-def get_db_connection():
-    """Create a database connection"""
-    conn = sqlite3.connect(DATABASE_NAME)
+# Read-only connections kept open per database file
+READ_POOL_SIZE = 8
+# Seconds SQLite waits for a lock held by another process before giving up
+BUSY_TIMEOUT = 10.0
+
+# Per-department sharding: requests, borrow history and notifications of users
+# with a department live in shards/<nn>-<department>.db, while the catalogue,
+# inventory and users stay in DATABASE_NAME. Set CHEMICAL_SHARDING=1 to enable
+# it and run "python shards.py migrate" once to move existing records.
+SHARDING_ENABLED = os.environ.get('CHEMICAL_SHARDING') == '1'
+SHARD_DIR = 'shards'
+# Record IDs in shard n start at n * SHARD_ID_SPAN, so an ID identifies its shard
+SHARD_ID_SPAN = 10 ** 9
+SHARDED_TABLES = ('chemical_requests', 'borrow_history', 'notifications')
+
+# Tables holding per-department records; with sharding enabled each department
+# gets its own file with these tables, otherwise they live in the main database
+SHARD_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS chemical_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER NOT NULL,
+        chemical_id INTEGER NOT NULL,
+        quantity_requested REAL NOT NULL,
+        unit TEXT NOT NULL,
+        purpose TEXT NOT NULL,
+        request_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        required_date DATE NOT NULL,
+        expected_return_date DATE NOT NULL,
+        actual_return_date DATE,
+        status TEXT NOT NULL DEFAULT 'pending',
+        approved_by INTEGER,
+        approval_date TIMESTAMP,
+        rejection_reason TEXT,
+        admin_notes TEXT,
+        overdue_since DATE,
+        reminder_level INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (student_id) REFERENCES users(id),
+        FOREIGN KEY (chemical_id) REFERENCES chemicals(id),
+        FOREIGN KEY (approved_by) REFERENCES users(id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS borrow_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        request_id INTEGER NOT NULL,
+        student_id INTEGER NOT NULL,
+        chemical_id INTEGER NOT NULL,
+        quantity_borrowed REAL NOT NULL,
+        unit TEXT NOT NULL,
+        borrow_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        expected_return_date DATE NOT NULL,
+        actual_return_date TIMESTAMP,
+        condition_at_borrow TEXT,
+        condition_at_return TEXT,
+        inventory_id INTEGER,
+        notes TEXT,
+        FOREIGN KEY (request_id) REFERENCES chemical_requests(id),
+        FOREIGN KEY (student_id) REFERENCES users(id),
+        FOREIGN KEY (chemical_id) REFERENCES chemicals(id),
+        FOREIGN KEY (inventory_id) REFERENCES inventory(id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        message TEXT NOT NULL,
+        type TEXT NOT NULL,
+        related_entity_type TEXT,
+        related_entity_id INTEGER,
+        is_read INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        dedupe_key TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_requests_status_return ON chemical_requests(status, expected_return_date)',
+    'CREATE INDEX IF NOT EXISTS idx_borrow_history_request ON borrow_history(request_id)',
+    'CREATE INDEX IF NOT EXISTS idx_notifications_created ON notifications(created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_requests_created ON chemical_requests(created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_borrow_history_date ON borrow_history(borrow_date)',
+    '''
+    CREATE TABLE IF NOT EXISTS consumption_daily (
+        period TEXT NOT NULL,
+        chemical_id INTEGER NOT NULL,
+        department TEXT NOT NULL DEFAULT '',
+        unit TEXT NOT NULL,
+        borrows INTEGER NOT NULL DEFAULT 0,
+        quantity REAL NOT NULL DEFAULT 0,
+        returns INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (period, chemical_id, department, unit)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS consumption_monthly (
+        period TEXT NOT NULL,
+        chemical_id INTEGER NOT NULL,
+        department TEXT NOT NULL DEFAULT '',
+        unit TEXT NOT NULL,
+        borrows INTEGER NOT NULL DEFAULT 0,
+        quantity REAL NOT NULL DEFAULT 0,
+        returns INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (period, chemical_id, department, unit)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_consumption_daily_chemical ON consumption_daily(chemical_id, period)',
+]
+
+# Consumption rollup table -> strftime format of its period ('' department = none)
+CONSUMPTION_ROLLUPS = {'consumption_daily': '%Y-%m-%d', 'consumption_monthly': '%Y-%m'}
+
+def _file_uri(path, mode=None):
+    uri = f'file:{quote(os.path.abspath(path))}'
+    return f'{uri}?mode={mode}' if mode else uri
+
+def get_db_connection(path=None):
+    """Create a read-write database connection
+    
+    A shard connection has the main database attached as common, so queries
+    can join shard tables against users and chemicals without a prefix.
+    """
+    path = path or DATABASE_NAME
+    conn = sqlite3.connect(_file_uri(path), uri=True, timeout=BUSY_TIMEOUT)
     conn.row_factory = sqlite3.Row
+    if path != DATABASE_NAME:
+        conn.execute('ATTACH DATABASE ? AS common', (_file_uri(DATABASE_NAME),))
     return conn
 
-def init_database():
-    """Initialize the database with required tables"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _open_read_only(path, attach=None):
+    """Open a read-only (mode=ro, query_only) connection, attaching the main database to a shard"""
+    conn = sqlite3.connect(_file_uri(path, 'ro'), uri=True, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    if attach:
+        conn.execute('ATTACH DATABASE ? AS common', (_file_uri(attach, 'ro'),))
+    conn.execute('PRAGMA query_only = 1')
+    return conn
+
+class ReadPool:
+    """Pool of read-only connections to one database file"""
+    
+    def __init__(self, path, size=READ_POOL_SIZE, attach=None):
+        self.path = path
+        self.size = size
+        self.attach = attach
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+    
+    def _connect(self):
+        return _open_read_only(self.path, self.attach)
+    
+    def acquire(self):
+        """Take an idle connection, opening one or waiting if none is free"""
+        conn = None
+        if not self.waiting:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                pass
+        if conn is None:
+            with self._lock:
+                if self.created < self.size:
+                    self.created += 1
+                    conn = self._connect()
+        if conn is None:
+            started = time.perf_counter()
+            with self._lock:
+                self.waiting += 1
+            try:
+                conn = self._idle.get()
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+                    self.waits += 1
+                    self.wait_seconds += time.perf_counter() - started
+        with self._lock:
+            self.in_use += 1
+        return conn
+    
+    def release(self, conn):
+        """Return a connection to the pool"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(conn)
+    
+    def close(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self.created = self.in_use
+    
+    def stats(self):
+        """Get pool usage counters"""
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self.created,
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'waits': self.waits,
+                'wait_ms_total': round(self.wait_seconds * 1000, 3)
+            }
+
+class Writer:
+    """Single read-write connection to one database file, used by one thread at a time
+    
+    Each write runs in a BEGIN IMMEDIATE transaction, so the SQLite write lock is
+    taken up front and writes from this process queue on an in-process lock
+    instead of retrying on SQLITE_BUSY. A shard writer attaches the main
+    database read-only, so its transactions never take the main write lock.
+    """
+    
+    def __init__(self, path, attach=None):
+        self.path = path
+        self.attach = attach
+        self._lock = threading.Lock()
+        self._conn = None
+        self.writes = 0
+        self.failures = 0
+        self.busy_errors = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.hold_seconds = 0.0
+        self.max_hold_seconds = 0.0
+    
+    def _connect(self):
+        conn = sqlite3.connect(_file_uri(self.path), uri=True, timeout=BUSY_TIMEOUT,
+                               check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA synchronous = NORMAL')
+        if self.attach:
+            conn.execute('ATTACH DATABASE ? AS common', (_file_uri(self.attach, 'ro'),))
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Hold the writer for one transaction, committing on success"""
+        requested = time.perf_counter()
+        with self._lock:
+            acquired = time.perf_counter()
+            if self._conn is None:
+                self._conn = self._connect()
+            conn = self._conn
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                yield conn
+                conn.execute('COMMIT')
+                self.writes += 1
+            except BaseException as e:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                self.failures += 1
+                if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                    self.busy_errors += 1
+                raise
+            finally:
+                released = time.perf_counter()
+                waited = acquired - requested
+                held = released - acquired
+                self.wait_seconds += waited
+                self.hold_seconds += held
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                self.max_hold_seconds = max(self.max_hold_seconds, held)
+    
+    def close(self):
+        """Close the writer connection"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def stats(self):
+        """Get write counters and lock wait/hold times"""
+        count = self.writes + self.failures
+        return {
+            'writes': self.writes,
+            'failures': self.failures,
+            'busy_errors': self.busy_errors,
+            'lock_wait_ms_total': round(self.wait_seconds * 1000, 3),
+            'lock_wait_ms_avg': round(self.wait_seconds * 1000 / count, 3) if count else 0,
+            'lock_wait_ms_max': round(self.max_wait_seconds * 1000, 3),
+            'lock_hold_ms_avg': round(self.hold_seconds * 1000 / count, 3) if count else 0,
+            'lock_hold_ms_max': round(self.max_hold_seconds * 1000, 3)
+        }
+
+_read_pools = {}
+_writers = {}
+_registry_lock = threading.Lock()
+# Threads of the async API's database executor (aiodb.py) each keep read
+# connections of their own instead of borrowing from the pools: thread ID ->
+# {path: connection}
+_pinned_connections = {}
+_pinned = threading.local()
+
+def _common_attachment(path):
+    return None if path == DATABASE_NAME else DATABASE_NAME
+
+def _get_read_pool(path):
+    pool = _read_pools.get(path)
+    if pool is None:
+        with _registry_lock:
+            pool = _read_pools.setdefault(path, ReadPool(path, READ_POOL_SIZE, _common_attachment(path)))
+    return pool
+
+def _get_writer(path):
+    writer = _writers.get(path)
+    if writer is None:
+        with _registry_lock:
+            writer = _writers.setdefault(path, Writer(path, attach=_common_attachment(path)))
+    return writer
+
+def pin_read_connections():
+    """Give the calling thread read connections of its own, opened on first use"""
+    with _registry_lock:
+        _pinned.connections = _pinned_connections.setdefault(threading.get_ident(), {})
+
+def interrupt_reads(thread_id):
+    """Abort the queries running on a thread's own read connections"""
+    for conn in list(_pinned_connections.get(thread_id, {}).values()):
+        conn.interrupt()
+
+@contextmanager
+def read_connection(path=None):
+    """Borrow a pooled read-only connection to the main database or a shard"""
+    path = path or DATABASE_NAME
+    pinned = getattr(_pinned, 'connections', None)
+    if pinned is not None:
+        conn = pinned.get(path)
+        if conn is None:
+            conn = pinned[path] = _open_read_only(path, _common_attachment(path))
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+        return
+    pool = _get_read_pool(path)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def write_connection(path=None):
+    """Hold the serialized writer connection of the main database or a shard for one transaction"""
+    return _get_writer(path or DATABASE_NAME).connection()
+
+def close_connections():
+    """Close pooled and writer connections, e.g. after forking a worker"""
+    with _registry_lock:
+        for pool in _read_pools.values():
+            pool.close()
+        for writer in _writers.values():
+            writer.close()
+        for connections in _pinned_connections.values():
+            for conn in connections.values():
+                conn.close()
+            connections.clear()
+        _read_pools.clear()
+        _writers.clear()
+        _shard_paths.clear()
+        _user_shards.clear()
+
+def get_connection_stats():
+    """Get read pool and writer statistics for every open database file"""
+    return {
+        'read_pools': {path: pool.stats() for path, pool in _read_pools.items()},
+        'writers': {path: writer.stats() for path, writer in _writers.items()},
+        'pinned_readers': sum(len(connections) for connections in _pinned_connections.values())
+    }
+
+# Shard routing
+_shard_paths = {}
+_user_shards = {}
+
+def get_shard_path(shard_id, department):
+    """Get the file for a department shard"""
+    slug = re.sub(r'[^a-z0-9]+', '-', department.lower()).strip('-') or 'department'
+    return os.path.join(os.path.dirname(DATABASE_NAME), SHARD_DIR, f'{shard_id:02d}-{slug}.db')
+
+def _add_shard_columns(conn):
+    """Add the columns added to SHARD_SCHEMA tables since a database or shard file was created"""
+    request_columns = [row[1] for row in conn.execute('PRAGMA table_info(chemical_requests)')]
+    for column in ('overdue_since DATE', 'reminder_level INTEGER NOT NULL DEFAULT 0'):
+        if column.split()[0] not in request_columns:
+            conn.execute(f'ALTER TABLE chemical_requests ADD COLUMN {column}')
+    notification_columns = [row[1] for row in conn.execute('PRAGMA table_info(notifications)')]
+    if 'dedupe_key' not in notification_columns:
+        conn.execute('ALTER TABLE notifications ADD COLUMN dedupe_key TEXT')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_dedupe ON notifications(dedupe_key) '
+                 'WHERE dedupe_key IS NOT NULL')
+
+def _create_shard(path, shard_id):
+    """Create a shard file with the department tables and its own ID range, or bring one up to date"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+        for statement in SHARD_SCHEMA:
+            conn.execute(statement)
+        _add_shard_columns(conn)
+        conn.executemany('''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+        ''', [(table, shard_id * SHARD_ID_SPAN, table) for table in SHARDED_TABLES])
+        conn.commit()
+    finally:
+        conn.close()
+
+def _assign_user_shard(user_id):
+    """Give a user a home shard based on their department, creating the shard if needed"""
+    with write_connection() as conn:
+        user = conn.execute('''
+            SELECT u.department, us.shard_id FROM users u
+            LEFT JOIN user_shards us ON us.user_id = u.id
+            WHERE u.id = ?
+        ''', (user_id,)).fetchone()
+        if user is None:
+            return 0
+        if user['shard_id'] is not None:
+            return user['shard_id']
+        shard_id = 0
+        if user['department']:
+            shard = conn.execute('SELECT id FROM shards WHERE department = ?', (user['department'],)).fetchone()
+            if shard:
+                shard_id = shard['id']
+            else:
+                shard_id = conn.execute('INSERT INTO shards (department, path) VALUES (?, ?)',
+                                        (user['department'], '')).lastrowid
+                path = get_shard_path(shard_id, user['department'])
+                conn.execute('UPDATE shards SET path = ? WHERE id = ?', (path, shard_id))
+                _create_shard(path, shard_id)
+        conn.execute('INSERT INTO user_shards (user_id, shard_id) VALUES (?, ?)', (user_id, shard_id))
+    return shard_id
+
+def get_shard_database(shard_id):
+    """Get the database file for a shard ID, 0 being the main database"""
+    if not shard_id:
+        return DATABASE_NAME
+    path = _shard_paths.get(shard_id)
+    if path is None:
+        with read_connection() as conn:
+            row = conn.execute('SELECT path FROM shards WHERE id = ?', (shard_id,)).fetchone()
+        if row is None:
+            return DATABASE_NAME
+        path = _shard_paths.setdefault(shard_id, row['path'])
+    return path
+
+def get_user_database(user_id):
+    """Get the database file holding a user's requests, borrows and notifications
+    
+    A user's home shard is fixed the first time it is looked up, so changing
+    department later does not strand their existing records.
+    """
+    if not SHARDING_ENABLED or user_id is None:
+        return DATABASE_NAME
+    shard_id = _user_shards.get(user_id)
+    if shard_id is None:
+        with read_connection() as conn:
+            row = conn.execute('SELECT shard_id FROM user_shards WHERE user_id = ?', (user_id,)).fetchone()
+        shard_id = row['shard_id'] if row else _assign_user_shard(user_id)
+        _user_shards[user_id] = shard_id
+    return get_shard_database(shard_id)
+
+def get_record_database(record_id):
+    """Get the database file holding a request, borrow or notification by its ID"""
+    if not SHARDING_ENABLED:
+        return DATABASE_NAME
+    return get_shard_database(int(record_id) // SHARD_ID_SPAN)
+
+def get_database_paths():
+    """Get the main database file followed by every shard file"""
+    with read_connection() as conn:
+        rows = conn.execute('SELECT path FROM shards ORDER BY id').fetchall()
+    return [DATABASE_NAME] + [row['path'] for row in rows]
+
+def _fan_out(sql, params=(), order_by=None, descending=False):
+    """Run a read query on the main database and every shard, merging the rows"""
+    paths = get_database_paths()
+    rows = []
+    for path in paths:
+        with read_connection(path) as conn:
+            rows.extend(conn.execute(sql, params).fetchall())
+    if order_by and len(paths) > 1:
+        rows.sort(key=lambda row: row[order_by] or '', reverse=descending)
+    return rows
+
+def _group_by_user_database(rows, user_paths=None):
+    """Group rows whose first column is a user ID by that user's database file"""
+    groups = {}
+    for row in rows:
+        path = (user_paths or {}).get(row[0]) or get_user_database(row[0])
+        groups.setdefault(path, []).append(row)
+    return groups
+
+def get_shard_stats():
+    """Get record counts and file size for the main database and every shard"""
+    with read_connection() as conn:
+        departments = {row['path']: row['department'] for row in conn.execute('SELECT path, department FROM shards')}
+    stats = []
+    for path in get_database_paths():
+        with read_connection(path) as conn:
+            counts = {table: conn.execute(f'SELECT COUNT(*) FROM main.{table}').fetchone()[0]
+                      for table in SHARDED_TABLES}
+        stats.append({
+            'path': path,
+            'department': departments.get(path),
+            'size_mb': round(os.path.getsize(path) / (1024 * 1024), 3) if os.path.exists(path) else 0,
+            **counts
+        })
+    return stats
+
+# Schema migrations. The schema version of the main database is its PRAGMA
+# user_version; migrate() applies each newer migration in MIGRATIONS in a
+# transaction that also sets the version. Migrations run under a file lock,
+# once per deployment, so they must not hold the write lock for long: add
+# columns with ALTER TABLE ... ADD COLUMN (instant for nullable columns and
+# constant defaults), never rebuild a large table, and fill new columns with
+# a backfill in BACKFILLS, which walks its table in short batches and resumes
+# where it stopped. Code must cope with rows a backfill has not reached yet.
+# A migration that changes shard tables also updates SHARD_SCHEMA and applies
+# the change to every file in get_database_paths().
+MIGRATION_LOCK_SUFFIX = '.migrate.lock'
+BACKFILL_BATCH_SIZE = 1000
+# Shortest pause between backfill batches, so requests waiting for the write lock get it
+BACKFILL_PAUSE = 0.01
+
+def _migration_1_baseline(conn):
+    """Create the schema as it was before versioning, or adopt a database created then
+    
+    Tables are created only if missing and columns added since are added, so
+    a database made by the former init_database() is brought up to the
+    baseline in place. Sample data goes into new databases only.
+    """
+    new_database = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chemicals'").fetchone() is None
     
     # Create hazard_categories table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS hazard_categories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL UNIQUE,
@@ -26,7 +581,7 @@ def init_database():
     ''')
     
     # Create storage_locations table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS storage_locations (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             location_name TEXT NOT NULL,
@@ -40,7 +595,7 @@ def init_database():
     ''')
     
     # Create chemicals table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS chemicals (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -52,12 +607,52 @@ def init_database():
             hazard_category_id INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            cas_key INTEGER,
+            formula_weight REAL,
             FOREIGN KEY (hazard_category_id) REFERENCES hazard_categories(id)
         )
     ''')
+    # Databases created before CAS keys and formula weights were added
+    chemical_columns = [row['name'] for row in conn.execute('PRAGMA table_info(chemicals)')]
+    for column in ('cas_key INTEGER', 'formula_weight REAL'):
+        if column.split()[0] not in chemical_columns:
+            conn.execute(f'ALTER TABLE chemicals ADD COLUMN {column}')
+    
+    # Create chemical_elements table (composition parsed from chemical_formula)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chemical_elements (
+            element TEXT NOT NULL,
+            chemical_id INTEGER NOT NULL,
+            count NUMERIC NOT NULL,
+            PRIMARY KEY (element, chemical_id),
+            FOREIGN KEY (chemical_id) REFERENCES chemicals(id)
+        ) WITHOUT ROWID
+    ''')
+    
+    # Create chemical_synonyms table (alternative names offered by typeahead)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chemical_synonyms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chemical_id INTEGER NOT NULL,
+            synonym TEXT NOT NULL,
+            UNIQUE (chemical_id, synonym),
+            FOREIGN KEY (chemical_id) REFERENCES chemicals(id)
+        )
+    ''')
+    
+    # Create duplicate_candidates table (near-duplicate name groups from the nightly clustering)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS duplicate_candidates (
+            group_id INTEGER NOT NULL,
+            chemical_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (group_id, chemical_id)
+        )
+    ''')
     
     # Create inventory table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS inventory (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chemical_id INTEGER NOT NULL,
@@ -75,7 +670,7 @@ def init_database():
     ''')
     
     # Create users table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT NOT NULL UNIQUE,
@@ -88,12 +683,16 @@ def init_database():
             phone_number TEXT,
             is_active INTEGER DEFAULT 1,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_login TIMESTAMP
+            last_login TIMESTAMP,
+            auth_version INTEGER NOT NULL DEFAULT 0
         )
     ''')
+    # Databases created before sessions carried an auth_version
+    if 'auth_version' not in [row['name'] for row in conn.execute('PRAGMA table_info(users)')]:
+        conn.execute('ALTER TABLE users ADD COLUMN auth_version INTEGER NOT NULL DEFAULT 0')
     
     # Create activity_log table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS activity_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -106,552 +705,1688 @@ def init_database():
         )
     ''')
     
-    # Create chemical_requests table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chemical_requests (
+    # Create chemical_requests, borrow_history, notifications and consumption rollup tables
+    for statement in SHARD_SCHEMA:
+        conn.execute(statement)
+    # Databases created before the overdue sweep's columns were added
+    _add_shard_columns(conn)
+    
+    # Create shards table (one row per department shard file)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS shards (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            student_id INTEGER NOT NULL,
-            chemical_id INTEGER NOT NULL,
-            quantity_requested REAL NOT NULL,
+            department TEXT NOT NULL UNIQUE,
+            path TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Create user_shards table (home shard of each user, 0 = main database)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_shards (
+            user_id INTEGER PRIMARY KEY,
+            shard_id INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    
+    # Create cache_versions table (version stamps for rendered template fragments)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            cache_key TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Create storage_area_totals table (running totals per control area)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS storage_area_totals (
+            building TEXT NOT NULL,
+            room TEXT NOT NULL,
+            hazard_category_id INTEGER NOT NULL,
             unit TEXT NOT NULL,
-            purpose TEXT NOT NULL,
-            request_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            required_date DATE NOT NULL,
-            expected_return_date DATE NOT NULL,
-            actual_return_date DATE,
-            status TEXT NOT NULL DEFAULT 'pending',
-            approved_by INTEGER,
-            approval_date TIMESTAMP,
-            rejection_reason TEXT,
-            admin_notes TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (student_id) REFERENCES users(id),
-            FOREIGN KEY (chemical_id) REFERENCES chemicals(id),
-            FOREIGN KEY (approved_by) REFERENCES users(id)
+            total_quantity REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (building, room, hazard_category_id, unit),
+            FOREIGN KEY (hazard_category_id) REFERENCES hazard_categories(id)
+        )
+    ''')
+    
+    # Create inventory value totals (running lot counts and quantity * cost per
+    # storage location, chemical and expiry date; location 0 and expiry '' for none)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS inventory_value_by_location (
+            storage_location_id INTEGER PRIMARY KEY,
+            lots INTEGER NOT NULL DEFAULT 0,
+            costed_lots INTEGER NOT NULL DEFAULT 0,
+            value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS inventory_value_by_chemical (
+            chemical_id INTEGER PRIMARY KEY,
+            lots INTEGER NOT NULL DEFAULT 0,
+            costed_lots INTEGER NOT NULL DEFAULT 0,
+            value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS inventory_value_by_expiry (
+            expiry_date TEXT PRIMARY KEY,
+            lots INTEGER NOT NULL DEFAULT 0,
+            costed_lots INTEGER NOT NULL DEFAULT 0,
+            value REAL NOT NULL DEFAULT 0
         )
     ''')
     
-    # Create borrow_history table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS borrow_history (
+    # Create quantity_limits table (room '' means the whole building)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS quantity_limits (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            request_id INTEGER NOT NULL,
-            student_id INTEGER NOT NULL,
+            building TEXT NOT NULL,
+            room TEXT NOT NULL DEFAULT '',
+            hazard_category_id INTEGER NOT NULL,
+            unit TEXT NOT NULL,
+            max_quantity REAL NOT NULL,
+            UNIQUE (building, room, hazard_category_id, unit),
+            FOREIGN KEY (hazard_category_id) REFERENCES hazard_categories(id)
+        )
+    ''')
+    
+    # Create reorder_suggestions table (nightly demand forecast per chemical and base unit)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reorder_suggestions (
             chemical_id INTEGER NOT NULL,
-            quantity_borrowed REAL NOT NULL,
             unit TEXT NOT NULL,
-            borrow_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            expected_return_date DATE NOT NULL,
-            actual_return_date TIMESTAMP,
-            condition_at_borrow TEXT,
-            condition_at_return TEXT,
-            inventory_id INTEGER,
-            notes TEXT,
-            FOREIGN KEY (request_id) REFERENCES chemical_requests(id),
-            FOREIGN KEY (student_id) REFERENCES users(id),
-            FOREIGN KEY (chemical_id) REFERENCES chemicals(id),
-            FOREIGN KEY (inventory_id) REFERENCES inventory(id)
+            available REAL NOT NULL,
+            daily_demand REAL NOT NULL,
+            seasonal_factor REAL NOT NULL,
+            safety_stock REAL NOT NULL,
+            reorder_point REAL NOT NULL,
+            order_quantity REAL NOT NULL,
+            days_of_stock REAL,
+            computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chemical_id, unit),
+            FOREIGN KEY (chemical_id) REFERENCES chemicals(id) ON DELETE CASCADE
         )
     ''')
     
-    # Create notifications table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notifications (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            message TEXT NOT NULL,
-            type TEXT NOT NULL,
-            related_entity_type TEXT,
-            related_entity_id INTEGER,
-            is_read INTEGER DEFAULT 0,
+    # Create expiry_alerts table (alerts already sent per inventory item)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS expiry_alerts (
+            inventory_id INTEGER NOT NULL,
+            alert_type TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
+            PRIMARY KEY (inventory_id, alert_type),
+            FOREIGN KEY (inventory_id) REFERENCES inventory(id) ON DELETE CASCADE
         )
     ''')
     
-    conn.commit()
+    # Indexes
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_inventory_location ON inventory(storage_location_id, chemical_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_inventory_expiry ON inventory(expiry_date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_inventory_chemical ON inventory(chemical_id, expiry_date, quantity)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chemicals_name ON chemicals(name)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_chemicals_cas_key ON chemicals(cas_key)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chemicals_formula_weight ON chemicals(formula_weight)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chemical_elements_chemical ON chemical_elements(chemical_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chemicals_supplier ON chemicals(supplier, name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chemicals_hazard ON chemicals(hazard_category_id, name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_user ON activity_log(user_id, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_entity ON activity_log(entity_type, entity_id, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_timestamp ON activity_log(timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reorder_due ON reorder_suggestions(days_of_stock) WHERE order_quantity > 0')
     
-    # Insert default hazard categories
-    try:
-        hazard_categories = [
-            ('Flammable', 'Easily ignitable substances', '#FF4444'),
-            ('Toxic', 'Poisonous substances', '#9B59B6'),
-            ('Corrosive', 'Substances that cause burns', '#F39C12'),
-            ('Oxidizing', 'Substances that may cause or intensify fire', '#E74C3C'),
-            ('Explosive', 'Substances that may explode', '#C0392B'),
-            ('Irritant', 'Substances causing irritation', '#3498DB'),
-            ('Carcinogenic', 'Cancer-causing substances', '#8E44AD'),
-            ('Environmental Hazard', 'Harmful to environment', '#27AE60')
-        ]
-        
-        cursor.executemany(
-            'INSERT OR IGNORE INTO hazard_categories (name, description, color_code) VALUES (?, ?, ?)',
-            hazard_categories
-        )
-        
-        # Insert default storage locations
-        storage_locations = [
-            ('Main Lab', 'Building A', 'Lab 101', 'Cabinet 1', 'Shelf A', 100.0),
-            ('Main Lab', 'Building A', 'Lab 101', 'Cabinet 1', 'Shelf B', 100.0),
-            ('Main Lab', 'Building A', 'Lab 101', 'Cabinet 2', 'Shelf A', 100.0),
-            ('Cold Storage', 'Building A', 'Lab 102', 'Refrigerator 1', 'Shelf 1', 50.0),
-            ('Acid Storage', 'Building A', 'Lab 103', 'Acid Cabinet', 'Shelf A', 75.0),
-            ('Flammable Storage', 'Building B', 'Storage Room', 'Flammable Cabinet', 'Shelf 1', 150.0)
-        ]
-        
-        cursor.executemany(
-            '''INSERT OR IGNORE INTO storage_locations 
-               (location_name, building, room, cabinet, shelf, capacity_liters) 
-               VALUES (?, ?, ?, ?, ?, ?)''',
-            storage_locations
+    # Create schema_backfills table (progress of each batched backfill)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_backfills (
+            name TEXT PRIMARY KEY,
+            last_rowid INTEGER NOT NULL DEFAULT 0,
+            completed_at TIMESTAMP
         )
-        
-        # Insert sample chemicals
-        sample_chemicals = [
-            ('Hydrochloric Acid', 'HCl', '7647-01-0', 36.46, 'Strong acid, corrosive', 'Sigma-Aldrich', 3),
-            ('Sodium Hydroxide', 'NaOH', '1310-73-2', 40.00, 'Strong base, corrosive', 'Fisher Scientific', 3),
-            ('Ethanol', 'C2H5OH', '64-17-5', 46.07, 'Flammable liquid', 'Merck', 1),
-            ('Acetone', 'C3H6O', '67-64-1', 58.08, 'Flammable solvent', 'Sigma-Aldrich', 1),
-            ('Sulfuric Acid', 'H2SO4', '7664-93-9', 98.08, 'Highly corrosive acid', 'Fisher Scientific', 3),
-            ('Sodium Chloride', 'NaCl', '7647-14-5', 58.44, 'Common salt', 'Merck', 6),
-            ('Methanol', 'CH3OH', '67-56-1', 32.04, 'Toxic flammable liquid', 'Sigma-Aldrich', 2),
-            ('Benzene', 'C6H6', '71-43-2', 78.11, 'Carcinogenic aromatic hydrocarbon', 'Merck', 7)
-        ]
-        
-        cursor.executemany(
-            '''INSERT OR IGNORE INTO chemicals 
-               (name, chemical_formula, cas_number, molecular_weight, description, supplier, hazard_category_id) 
-               VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            sample_chemicals
+    ''')
+    
+    if new_database:
+        _insert_sample_data(conn)
+    _rebuild_area_totals(conn)
+    if conn.execute('SELECT 1 FROM inventory_value_by_chemical LIMIT 1').fetchone() is None:
+        _rebuild_value_totals(conn)
+    
+    # Bring existing shard files up to the current schema
+    for shard in conn.execute('SELECT id, path FROM shards').fetchall():
+        _create_shard(shard['path'], shard['id'])
+
+def _insert_sample_data(conn):
+    """Insert the default hazard categories and storage locations and sample stock"""
+    hazard_categories = [
+        ('Flammable', 'Easily ignitable substances', '#FF4444'),
+        ('Toxic', 'Poisonous substances', '#9B59B6'),
+        ('Corrosive', 'Substances that cause burns', '#F39C12'),
+        ('Oxidizing', 'Substances that may cause or intensify fire', '#E74C3C'),
+        ('Explosive', 'Substances that may explode', '#C0392B'),
+        ('Irritant', 'Substances causing irritation', '#3498DB'),
+        ('Carcinogenic', 'Cancer-causing substances', '#8E44AD'),
+        ('Environmental Hazard', 'Harmful to environment', '#27AE60')
+    ]
+    
+    conn.executemany(
+        'INSERT INTO hazard_categories (name, description, color_code) VALUES (?, ?, ?)',
+        hazard_categories
+    )
+    
+    # Insert default storage locations
+    storage_locations = [
+        ('Main Lab', 'Building A', 'Lab 101', 'Cabinet 1', 'Shelf A', 100.0),
+        ('Main Lab', 'Building A', 'Lab 101', 'Cabinet 1', 'Shelf B', 100.0),
+        ('Main Lab', 'Building A', 'Lab 101', 'Cabinet 2', 'Shelf A', 100.0),
+        ('Cold Storage', 'Building A', 'Lab 102', 'Refrigerator 1', 'Shelf 1', 50.0),
+        ('Acid Storage', 'Building A', 'Lab 103', 'Acid Cabinet', 'Shelf A', 75.0),
+        ('Flammable Storage', 'Building B', 'Storage Room', 'Flammable Cabinet', 'Shelf 1', 150.0)
+    ]
+    
+    conn.executemany(
+        '''INSERT INTO storage_locations 
+           (location_name, building, room, cabinet, shelf, capacity_liters) 
+           VALUES (?, ?, ?, ?, ?, ?)''',
+        storage_locations
+    )
+    
+    # Insert sample chemicals
+    sample_chemicals = [
+        ('Hydrochloric Acid', 'HCl', '7647-01-0', 36.46, 'Strong acid, corrosive', 'Sigma-Aldrich', 3),
+        ('Sodium Hydroxide', 'NaOH', '1310-73-2', 40.00, 'Strong base, corrosive', 'Fisher Scientific', 3),
+        ('Ethanol', 'C2H5OH', '64-17-5', 46.07, 'Flammable liquid', 'Merck', 1),
+        ('Acetone', 'C3H6O', '67-64-1', 58.08, 'Flammable solvent', 'Sigma-Aldrich', 1),
+        ('Sulfuric Acid', 'H2SO4', '7664-93-9', 98.08, 'Highly corrosive acid', 'Fisher Scientific', 3),
+        ('Sodium Chloride', 'NaCl', '7647-14-5', 58.44, 'Common salt', 'Merck', 6),
+        ('Methanol', 'CH3OH', '67-56-1', 32.04, 'Toxic flammable liquid', 'Sigma-Aldrich', 2),
+        ('Benzene', 'C6H6', '71-43-2', 78.11, 'Carcinogenic aromatic hydrocarbon', 'Merck', 7)
+    ]
+    
+    conn.executemany(
+        '''INSERT INTO chemicals 
+           (name, chemical_formula, cas_number, molecular_weight, description, supplier, hazard_category_id) 
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        sample_chemicals
+    )
+    
+    # Insert sample inventory items
+    sample_inventory = [
+        (1, 2.5, 'L', 5, 'BATCH-HCL-001', '2025-12-31', '2024-01-15', 45.00, 'Handle with care'),
+        (2, 1.0, 'kg', 1, 'BATCH-NAOH-001', '2026-06-30', '2024-02-01', 30.00, 'Store in dry place'),
+        (3, 5.0, 'L', 1, 'BATCH-ETH-001', '2025-08-31', '2024-03-10', 75.00, 'Keep away from heat'),
+        (4, 2.5, 'L', 6, 'BATCH-ACE-001', '2025-10-31', '2024-03-15', 55.00, 'Flammable storage'),
+        (5, 1.0, 'L', 5, 'BATCH-H2SO4-001', '2026-12-31', '2024-01-20', 50.00, 'Extreme caution'),
+        (6, 5.0, 'kg', 1, 'BATCH-NACL-001', '2027-12-31', '2024-02-05', 15.00, 'General storage'),
+        (7, 1.0, 'L', 6, 'BATCH-METH-001', '2025-07-31', '2024-03-01', 40.00, 'Toxic - keep sealed'),
+        (8, 0.5, 'L', 6, 'BATCH-BEN-001', '2025-09-30', '2024-03-20', 65.00, 'Carcinogenic - special handling')
+    ]
+    
+    conn.executemany(
+        '''INSERT INTO inventory 
+           (chemical_id, quantity, unit, storage_location_id, batch_number, expiry_date, received_date, cost, notes) 
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        sample_inventory
+    )
+
+def _migration_2_task_queue(conn):
+    """Add the task_queue table of the background task queue (taskqueue.py)"""
+    # Times are Unix seconds, compared with time.time() when tasks are claimed
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS task_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'dead')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_after REAL NOT NULL,
+            lease_until REAL,
+            worker TEXT,
+            result TEXT,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            finished_at REAL
         )
-        
-        # Insert sample inventory items
-        sample_inventory = [
-            (1, 2.5, 'L', 5, 'BATCH-HCL-001', '2025-12-31', '2024-01-15', 45.00, 'Handle with care'),
-            (2, 1.0, 'kg', 1, 'BATCH-NAOH-001', '2026-06-30', '2024-02-01', 30.00, 'Store in dry place'),
-            (3, 5.0, 'L', 1, 'BATCH-ETH-001', '2025-08-31', '2024-03-10', 75.00, 'Keep away from heat'),
-            (4, 2.5, 'L', 6, 'BATCH-ACE-001', '2025-10-31', '2024-03-15', 55.00, 'Flammable storage'),
-            (5, 1.0, 'L', 5, 'BATCH-H2SO4-001', '2026-12-31', '2024-01-20', 50.00, 'Extreme caution'),
-            (6, 5.0, 'kg', 1, 'BATCH-NACL-001', '2027-12-31', '2024-02-05', 15.00, 'General storage'),
-            (7, 1.0, 'L', 6, 'BATCH-METH-001', '2025-07-31', '2024-03-01', 40.00, 'Toxic - keep sealed'),
-            (8, 0.5, 'L', 6, 'BATCH-BEN-001', '2025-09-30', '2024-03-20', 65.00, 'Carcinogenic - special handling')
-        ]
-        
-        cursor.executemany(
-            '''INSERT OR IGNORE INTO inventory 
-               (chemical_id, quantity, unit, storage_location_id, batch_number, expiry_date, received_date, cost, notes) 
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            sample_inventory
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_task_queue_ready ON task_queue(priority DESC, run_after) "
+                 "WHERE status = 'queued'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_task_queue_leases ON task_queue(lease_until) WHERE status = 'running'")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_task_queue_finished ON task_queue(status, finished_at)')
+
+def _migration_3_job_runs(conn):
+    """Add the job_runs table, where every process running scheduled jobs records their runs"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            name TEXT PRIMARY KEY,
+            interval_seconds INTEGER,
+            runs INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            last_run_at TIMESTAMP,
+            last_duration_ms REAL,
+            last_result TEXT,
+            last_error TEXT,
+            last_host TEXT
         )
-        
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass  # Data already exists
+    ''')
+
+def _migration_4_overdue_columns(conn):
+    """Add the overdue sweep's columns to databases adopted by a baseline that left them out"""
+    _add_shard_columns(conn)
+    for shard in conn.execute('SELECT id, path FROM shards').fetchall():
+        _create_shard(shard['path'], shard['id'])
+
+def _migration_5_dedupe_keys(conn):
+    """Add dedupe keys to task_queue and notifications, so a task run twice does not repeat its writes"""
+    if 'dedupe_key' not in [row[1] for row in conn.execute('PRAGMA table_info(task_queue)')]:
+        conn.execute('ALTER TABLE task_queue ADD COLUMN dedupe_key TEXT')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_task_queue_dedupe ON task_queue(dedupe_key) '
+                 'WHERE dedupe_key IS NOT NULL')
+    _add_shard_columns(conn)
+    for shard in conn.execute('SELECT id, path FROM shards').fetchall():
+        _create_shard(shard['path'], shard['id'])
+
+MIGRATIONS = [
+    (1, 'Baseline schema', _migration_1_baseline),
+    (2, 'Task queue', _migration_2_task_queue),
+    (3, 'Job runs', _migration_3_job_runs),
+    (4, 'Overdue columns on adopted databases', _migration_4_overdue_columns),
+    (5, 'Dedupe keys', _migration_5_dedupe_keys),
+]
+
+def _backfill_cas_keys(conn, rows):
+    """Normalize stored CAS numbers that have no key yet
     
-    conn.close()
-    print("Database initialized successfully!")
+    Numbers that fail validation or repeat another chemical's key keep their
+    text and no key, so they are still found by the text search.
+    """
+    for row in rows:
+        try:
+            cas_number, cas_key = cas.normalize(row['cas_number'])
+        except cas.CASError:
+            continue
+        if cas_key is None:
+            continue
+        # The unique index on cas_key makes this skip keys already taken
+        conn.execute('UPDATE OR IGNORE chemicals SET cas_number = ?, cas_key = ? WHERE id = ? AND cas_key IS NULL',
+                     (cas_number, cas_key, row['id']))
+    _bump_cache_versions(conn, 'chemicals')
+
+def _backfill_formula_index(conn, rows):
+    """Index the composition of chemicals whose formula has not been parsed yet"""
+    for row in rows:
+        _index_formula(conn, row['id'], row['chemical_formula'])
+    _bump_cache_versions(conn, 'chemicals')
+
+# Batched backfills: (schema version, name, table, columns, condition,
+# function(conn, rows)); each runs once the database is at its version
+BACKFILLS = [
+    (1, 'cas_keys', 'chemicals', 'id, cas_number', 'cas_key IS NULL AND cas_number IS NOT NULL',
+     _backfill_cas_keys),
+    (1, 'formula_index', 'chemicals', 'id, chemical_formula',
+     'formula_weight IS NULL AND chemical_formula IS NOT NULL', _backfill_formula_index),
+]
+
+def _get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def _completed_backfills(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_backfills'").fetchone() is None:
+        return set()
+    return {row['name'] for row in conn.execute('SELECT name FROM schema_backfills WHERE completed_at IS NOT NULL')}
+
+@contextmanager
+def _migration_lock():
+    """Hold an exclusive lock on a file next to the database, so one process migrates at a time"""
+    with open(DATABASE_NAME + MIGRATION_LOCK_SUFFIX, 'a') as lock_file:
+        # Without fcntl (Windows) each migration is still one write transaction
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def _run_backfill(name, table, columns, condition, function, batch_size):
+    """Run a backfill in rowid batches, each in its own write transaction with its progress"""
+    rows_done = 0
+    while True:
+        started = time.perf_counter()
+        with write_connection() as conn:
+            progress = conn.execute('SELECT last_rowid, completed_at FROM schema_backfills WHERE name = ?',
+                                    (name,)).fetchone()
+            if progress is None:
+                conn.execute('INSERT INTO schema_backfills (name) VALUES (?)', (name,))
+            elif progress['completed_at']:
+                return rows_done
+            rows = conn.execute(f'''
+                SELECT rowid AS backfill_rowid, {columns} FROM {table}
+                WHERE rowid > ? AND ({condition})
+                ORDER BY rowid LIMIT ?
+            ''', (progress['last_rowid'] if progress else 0, batch_size)).fetchall()
+            if not rows:
+                conn.execute('UPDATE schema_backfills SET completed_at = CURRENT_TIMESTAMP WHERE name = ?', (name,))
+                return rows_done
+            function(conn, rows)
+            conn.execute('UPDATE schema_backfills SET last_rowid = ? WHERE name = ?', (rows[-1]['backfill_rowid'], name))
+            rows_done += len(rows)
+        # SQLite's busy handler polls with growing sleeps, so other writers only
+        # get the lock reliably if the backfill pauses about as long as it held it
+        time.sleep(max(BACKFILL_PAUSE, time.perf_counter() - started))
+
+def migrate(batch_size=BACKFILL_BATCH_SIZE):
+    """Create the main database or bring it up to the latest schema version
+    
+    Applies pending migrations, then finishes pending backfills. A database
+    already up to date costs two small queries and no lock, so every process
+    can call this at startup; gunicorn runs it once in the master before
+    forking workers. Returns the versions migrated and rows backfilled.
+    """
+    latest = MIGRATIONS[-1][0]
+    conn = get_db_connection()
+    try:
+        if _get_schema_version(conn) == latest and _completed_backfills(conn) >= {b[1] for b in BACKFILLS}:
+            return {'version': latest, 'migrated': [], 'backfilled': {}}
+    finally:
+        conn.close()
+    
+    migrated = []
+    backfilled = {}
+    with _migration_lock():
+        conn = get_db_connection()
+        try:
+            # WAL lets the read-only pool keep reading while a write is in progress
+            conn.execute('PRAGMA journal_mode = WAL')
+        finally:
+            conn.close()
+        for version, description, function in MIGRATIONS:
+            with write_connection() as conn:
+                # Another process may have applied it while this one waited for the lock
+                if _get_schema_version(conn) >= version:
+                    continue
+                function(conn)
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+            migrated.append(version)
+        with read_connection() as conn:
+            version = _get_schema_version(conn)
+            completed = _completed_backfills(conn)
+        for backfill_version, name, table, columns, condition, function in BACKFILLS:
+            if backfill_version <= version and name not in completed:
+                backfilled[name] = _run_backfill(name, table, columns, condition, function, batch_size)
+    return {'version': version, 'migrated': migrated, 'backfilled': backfilled}
+
+def get_migration_status():
+    """Get the schema version, pending migrations and the progress of each backfill"""
+    conn = get_db_connection()
+    try:
+        version = _get_schema_version(conn)
+        progress = {}
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_backfills'").fetchone():
+            progress = {row['name']: dict(row) for row in conn.execute('SELECT * FROM schema_backfills')}
+    finally:
+        conn.close()
+    return {
+        'version': version,
+        'latest': MIGRATIONS[-1][0],
+        'pending': [{'version': v, 'description': d} for v, d, _ in MIGRATIONS if v > version],
+        'backfills': [{
+            'name': name,
+            'table': table,
+            'last_rowid': progress.get(name, {}).get('last_rowid', 0),
+            'completed_at': progress.get(name, {}).get('completed_at')
+        } for _, name, table, _, _, _ in BACKFILLS]
+    }
 
 # Database operation functions
+
+# Cache version stamps: write functions bump the keys whose rendered fragments
+# they change, inside the same transaction ('chemicals' for the catalogue list,
+# 'inventory' for any lot, 'chemical:<id>' for one chemical and its lots)
+def _bump_cache_versions(conn, *keys):
+    """Increment the version stamp of each cache key"""
+    conn.executemany('''
+        INSERT INTO cache_versions (cache_key, version) VALUES (?, 1)
+        ON CONFLICT(cache_key) DO UPDATE SET version = version + 1
+    ''', [(key,) for key in keys])
+
+def _get_cache_version(conn, key):
+    """Get the version stamp of one cache key on an open connection"""
+    row = conn.execute('SELECT version FROM cache_versions WHERE cache_key = ?', (key,)).fetchone()
+    return row['version'] if row else 0
+
+def get_version_stamps():
+    """Get every cache version and the auth_version of every user"""
+    with read_connection() as conn:
+        cache_versions = {row['cache_key']: row['version']
+                          for row in conn.execute('SELECT cache_key, version FROM cache_versions')}
+        auth_versions = {row['id']: row['auth_version'] for row in conn.execute('SELECT id, auth_version FROM users')}
+    return {'cache_versions': cache_versions, 'auth_versions': auth_versions}
+
+def advance_version_stamps(stamps):
+    """Move every cache version and auth_version past both its current value and its value in stamps
+    
+    Run after restoring a snapshot, so processes still running never mistake
+    content from after the snapshot for current, and every session is revoked.
+    """
+    with write_connection() as conn:
+        conn.execute('UPDATE cache_versions SET version = version + 1')
+        conn.executemany('''
+            INSERT INTO cache_versions (cache_key, version) VALUES (?, ?)
+            ON CONFLICT(cache_key) DO UPDATE SET version = MAX(version, excluded.version)
+        ''', [(key, version + 1) for key, version in {'auth': 0, **stamps['cache_versions']}.items()])
+        conn.execute('UPDATE users SET auth_version = auth_version + 1')
+        conn.executemany('UPDATE users SET auth_version = MAX(auth_version, ?) WHERE id = ?',
+                         [(version + 1, user_id) for user_id, version in stamps['auth_versions'].items()])
+
+def get_cache_versions(*keys):
+    """Get the version stamp of each cache key, 0 for keys never bumped"""
+    placeholders = ', '.join('?' * len(keys))
+    with read_connection() as conn:
+        rows = conn.execute(f'SELECT cache_key, version FROM cache_versions WHERE cache_key IN ({placeholders})',
+                            keys).fetchall()
+    versions = {row['cache_key']: row['version'] for row in rows}
+    return tuple(versions.get(key, 0) for key in keys)
+
+def _check_duplicate_cas(conn, cas_key, chemical_id=None):
+    """Raise DuplicateCASError if another chemical already has this CAS key"""
+    if cas_key is None:
+        return
+    existing = conn.execute('SELECT id, name FROM chemicals WHERE cas_key = ?', (cas_key,)).fetchone()
+    if existing is not None and existing['id'] != chemical_id:
+        raise cas.DuplicateCASError(
+            f"CAS number {cas.format_key(cas_key)} is already registered to {existing['name']} (#{existing['id']})")
+
 def get_all_chemicals():
     """Get all chemicals with their details"""
-    conn = get_db_connection()
-    chemicals = conn.execute('''
-        SELECT c.*, h.name as hazard_name, h.color_code
-        FROM chemicals c
-        LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
-        ORDER BY c.name
-    ''').fetchall()
-    conn.close()
+    with read_connection() as conn:
+        chemicals = conn.execute('''
+            SELECT c.*, h.name as hazard_name, h.color_code
+            FROM chemicals c
+            LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
+            ORDER BY c.name
+        ''').fetchall()
     return chemicals
 
+# Columns the inventory page can be sorted by
+INVENTORY_SORT_COLUMNS = {
+    'id': 'c.id',
+    'name': 'c.name',
+    'formula': 'c.chemical_formula',
+    'cas': 'c.cas_number',
+    'weight': 'c.molecular_weight',
+    'supplier': 'c.supplier',
+    'hazard': 'h.name'
+}
+INVENTORY_PAGE_SIZE = 50
+MAX_INVENTORY_PAGE_SIZE = 200
+# Chemicals whose lots add up to less than this (in the lots' own units) are low on stock
+LOW_STOCK_THRESHOLD = 1.0
+
+def _search_cas_key(query):
+    """Get the CAS key of a search string shaped like a valid CAS number, or None"""
+    if not cas.looks_like(query):
+        return None
+    try:
+        return cas.parse(query)
+    except cas.CASError:
+        return None
+
+def get_inventory_page(filters=None, sort='name', direction='asc', page=1, per_page=INVENTORY_PAGE_SIZE):
+    """Get one page of chemicals matching the inventory filters
+    
+    filters may hold q (name, formula or CAS number), elements (symbols that
+    must all be present), min_weight and max_weight (formula weight),
+    hazard_category_id, supplier, storage_location_id, expiring_within (days)
+    and low_stock.
+    """
+    filters = filters or {}
+    conditions = []
+    params = []
+    cas_key = _search_cas_key(filters.get('q'))
+    if cas_key is not None:
+        conditions.append('c.cas_key = ?')
+        params.append(cas_key)
+    elif filters.get('q'):
+        search_term = f"%{filters['q']}%"
+        conditions.append('(c.name LIKE ? OR c.chemical_formula LIKE ? OR c.cas_number LIKE ?)')
+        params.extend([search_term, search_term, search_term])
+    composition, composition_params = _composition_conditions(
+        filters.get('elements') or (), filters.get('min_weight'), filters.get('max_weight'))
+    conditions.extend(composition)
+    params.extend(composition_params)
+    if filters.get('hazard_category_id'):
+        conditions.append('c.hazard_category_id = ?')
+        params.append(filters['hazard_category_id'])
+    if filters.get('supplier'):
+        conditions.append('c.supplier = ?')
+        params.append(filters['supplier'])
+    if filters.get('storage_location_id'):
+        conditions.append('EXISTS (SELECT 1 FROM inventory i WHERE i.storage_location_id = ? AND i.chemical_id = c.id)')
+        params.append(filters['storage_location_id'])
+    if filters.get('expiring_within') is not None:
+        if filters['expiring_within'] < 0:
+            raise ValueError('expiring_within must not be negative')
+        conditions.append("EXISTS (SELECT 1 FROM inventory i WHERE i.chemical_id = c.id AND i.expiry_date <= date('now', ?))")
+        params.append(f"+{int(filters['expiring_within'])} days")
+    if filters.get('low_stock'):
+        conditions.append('(SELECT COALESCE(SUM(i.quantity), 0) FROM inventory i WHERE i.chemical_id = c.id) < ?')
+        params.append(LOW_STOCK_THRESHOLD)
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    column = INVENTORY_SORT_COLUMNS.get(sort, 'c.name')
+    order = 'DESC' if direction == 'desc' else 'ASC'
+    per_page = max(1, min(int(per_page), MAX_INVENTORY_PAGE_SIZE))
+    
+    with read_connection() as conn:
+        total = conn.execute(f'SELECT COUNT(*) FROM chemicals c {where}', params).fetchone()[0]
+        pages = max(1, -(-total // per_page))
+        page = max(1, min(int(page), pages))
+        chemicals = conn.execute(f'''
+            SELECT c.*, h.name as hazard_name, h.color_code
+            FROM chemicals c
+            LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
+            {where}
+            ORDER BY {column} {order}, c.id {order}
+            LIMIT ? OFFSET ?
+        ''', (*params, per_page, (page - 1) * per_page)).fetchall()
+    return {'rows': chemicals, 'total': total, 'page': page, 'pages': pages, 'per_page': per_page}
+
+def get_suppliers():
+    """Get the distinct suppliers in the catalogue"""
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT DISTINCT supplier FROM chemicals
+            WHERE supplier IS NOT NULL AND supplier != ''
+            ORDER BY supplier
+        ''').fetchall()
+    return [row['supplier'] for row in rows]
+
 def get_chemical_by_id(chemical_id):
     """Get a specific chemical by ID"""
-    conn = get_db_connection()
-    chemical = conn.execute('''
-        SELECT c.*, h.name as hazard_name, h.color_code, h.description as hazard_description
-        FROM chemicals c
-        LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
-        WHERE c.id = ?
-    ''', (chemical_id,)).fetchone()
-    conn.close()
+    with read_connection() as conn:
+        chemical = conn.execute('''
+            SELECT c.*, h.name as hazard_name, h.color_code, h.description as hazard_description
+            FROM chemicals c
+            LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
+            WHERE c.id = ?
+        ''', (chemical_id,)).fetchone()
+    return chemical
+
+def get_chemical_by_cas(cas_number):
+    """Get a chemical by CAS number in any accepted format, or None"""
+    try:
+        _, cas_key = cas.normalize(cas_number)
+    except cas.CASError:
+        return None
+    with read_connection() as conn:
+        chemical = conn.execute('''
+            SELECT c.*, h.name as hazard_name, h.color_code, h.description as hazard_description
+            FROM chemicals c
+            LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
+            WHERE c.cas_key = ?
+        ''', (cas_key,)).fetchone()
     return chemical
 
 def get_inventory_for_chemical(chemical_id):
     """Get inventory items for a specific chemical"""
-    conn = get_db_connection()
-    inventory = conn.execute('''
-        SELECT i.*, 
-               s.location_name, s.building, s.room, s.cabinet, s.shelf
-        FROM inventory i
-        LEFT JOIN storage_locations s ON i.storage_location_id = s.id
-        WHERE i.chemical_id = ?
-    ''', (chemical_id,)).fetchall()
-    conn.close()
+    with read_connection() as conn:
+        inventory = conn.execute('''
+            SELECT i.*, 
+                   s.location_name, s.building, s.room, s.cabinet, s.shelf
+            FROM inventory i
+            LEFT JOIN storage_locations s ON i.storage_location_id = s.id
+            WHERE i.chemical_id = ?
+        ''', (chemical_id,)).fetchall()
     return inventory
 
 def add_chemical(data):
-    """Add a new chemical"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO chemicals 
-        (name, chemical_formula, cas_number, molecular_weight, description, supplier, hazard_category_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        data.get('name'),
-        data.get('chemical_formula'),
-        data.get('cas_number'),
-        data.get('molecular_weight'),
-        data.get('description'),
-        data.get('supplier'),
-        data.get('hazard_category_id')
-    ))
-    chemical_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    """Add a new chemical
+
+    Raises SimilarChemicalError when the name or a synonym is close to an
+    existing chemical with the same composition, unless data has
+    allow_similar set. Close names without a comparable formula are left to
+    the caller to report.
+    """
+    cas_number, cas_key = cas.normalize(data.get('cas_number'))
+    if not data.get('allow_similar'):
+        matches = find_similar_chemicals(data.get('name'), data.get('synonyms'),
+                                         chemical_formula=data.get('chemical_formula'))
+        duplicates = [match for match in matches if match['same_composition']]
+        if duplicates:
+            raise similarity.SimilarChemicalError(duplicates)
+    with write_connection() as conn:
+        _check_duplicate_cas(conn, cas_key)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO chemicals 
+            (name, chemical_formula, cas_number, cas_key, molecular_weight, description, supplier, hazard_category_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            data.get('name'),
+            data.get('chemical_formula'),
+            cas_number,
+            cas_key,
+            data.get('molecular_weight'),
+            data.get('description'),
+            data.get('supplier'),
+            data.get('hazard_category_id')
+        ))
+        chemical_id = cursor.lastrowid
+        _set_synonyms(conn, chemical_id, data.get('synonyms'))
+        _index_formula(conn, chemical_id, data.get('chemical_formula'))
+        _bump_cache_versions(conn, 'chemicals')
+        version = _get_cache_version(conn, 'chemicals')
+    _update_name_indexes(chemical_id, version)
     return chemical_id
 
+def get_registered_cas_keys(cas_keys):
+    """Get the subset of CAS keys already registered to a chemical"""
+    cas_keys = list(cas_keys)
+    found = set()
+    with read_connection() as conn:
+        for start in range(0, len(cas_keys), 500):
+            chunk = cas_keys[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            found.update(row[0] for row in conn.execute(
+                f'SELECT cas_key FROM chemicals WHERE cas_key IN ({placeholders})', chunk))
+    return found
+
+def import_chemicals(rows):
+    """Insert pre-validated chemicals in one transaction, returning the number added
+
+    Each row is a dict like add_chemical's data, with cas_number already
+    normalized and its cas_key set. Rows whose key is already registered
+    are skipped.
+    """
+    added = 0
+    with write_connection() as conn:
+        for data in rows:
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO chemicals
+                (name, chemical_formula, cas_number, cas_key, molecular_weight, description, supplier, hazard_category_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                data.get('name'),
+                data.get('chemical_formula'),
+                data.get('cas_number'),
+                data.get('cas_key'),
+                data.get('molecular_weight'),
+                data.get('description'),
+                data.get('supplier'),
+                data.get('hazard_category_id')
+            ))
+            if cursor.rowcount:
+                added += 1
+                _set_synonyms(conn, cursor.lastrowid, data.get('synonyms'))
+                _index_formula(conn, cursor.lastrowid, data.get('chemical_formula'))
+        if added:
+            _bump_cache_versions(conn, 'chemicals')
+    return added
+
 def update_chemical(chemical_id, data):
     """Update an existing chemical"""
-    conn = get_db_connection()
-    conn.execute('''
-        UPDATE chemicals 
-        SET name = ?, chemical_formula = ?, cas_number = ?, 
-            molecular_weight = ?, description = ?, supplier = ?, 
-            hazard_category_id = ?, updated_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-    ''', (
-        data.get('name'),
-        data.get('chemical_formula'),
-        data.get('cas_number'),
-        data.get('molecular_weight'),
-        data.get('description'),
-        data.get('supplier'),
-        data.get('hazard_category_id'),
-        chemical_id
-    ))
-    conn.commit()
-    conn.close()
+    cas_number, cas_key = cas.normalize(data.get('cas_number'))
+    with write_connection() as conn:
+        _check_duplicate_cas(conn, cas_key, chemical_id)
+        current = conn.execute('SELECT hazard_category_id FROM chemicals WHERE id = ?', (chemical_id,)).fetchone()
+        hazard_changed = current is not None and current['hazard_category_id'] != data.get('hazard_category_id')
+        lots = _get_lots_for_chemical(conn, chemical_id) if hazard_changed else []
+        for lot in lots:
+            _adjust_area_totals(conn, lot['storage_location_id'], chemical_id, -lot['quantity'], lot['unit'])
+        conn.execute('''
+            UPDATE chemicals 
+            SET name = ?, chemical_formula = ?, cas_number = ?, cas_key = ?, 
+                molecular_weight = ?, description = ?, supplier = ?, 
+                hazard_category_id = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (
+            data.get('name'),
+            data.get('chemical_formula'),
+            cas_number,
+            cas_key,
+            data.get('molecular_weight'),
+            data.get('description'),
+            data.get('supplier'),
+            data.get('hazard_category_id'),
+            chemical_id
+        ))
+        for lot in lots:
+            _adjust_area_totals(conn, lot['storage_location_id'], chemical_id, lot['quantity'], lot['unit'])
+        # The stored lots now carry the new hazard class; a clash with their neighbours rolls the update back
+        for storage_location_id in sorted({lot['storage_location_id'] for lot in lots if lot['storage_location_id']}):
+            _check_placement(conn, chemical_id, storage_location_id)
+        if 'synonyms' in data:
+            conn.execute('DELETE FROM chemical_synonyms WHERE chemical_id = ?', (chemical_id,))
+            _set_synonyms(conn, chemical_id, data.get('synonyms'))
+        _index_formula(conn, chemical_id, data.get('chemical_formula'))
+        _bump_cache_versions(conn, 'chemicals', f'chemical:{chemical_id}')
+        version = _get_cache_version(conn, 'chemicals')
+    _update_name_indexes(chemical_id, version)
 
 def delete_chemical(chemical_id):
-    """Delete a chemical"""
-    conn = get_db_connection()
-    conn.execute('DELETE FROM chemicals WHERE id = ?', (chemical_id,))
-    conn.commit()
-    conn.close()
+    """Delete a chemical and its inventory items"""
+    with write_connection() as conn:
+        for lot in _get_lots_for_chemical(conn, chemical_id):
+            _adjust_area_totals(conn, lot['storage_location_id'], chemical_id, -lot['quantity'], lot['unit'])
+            _adjust_value_totals(conn, lot, -1, -lot['quantity'])
+        conn.execute('DELETE FROM expiry_alerts WHERE inventory_id IN (SELECT id FROM inventory WHERE chemical_id = ?)',
+                     (chemical_id,))
+        conn.execute('DELETE FROM inventory WHERE chemical_id = ?', (chemical_id,))
+        conn.execute('DELETE FROM chemical_synonyms WHERE chemical_id = ?', (chemical_id,))
+        conn.execute('DELETE FROM chemical_elements WHERE chemical_id = ?', (chemical_id,))
+        conn.execute('DELETE FROM chemicals WHERE id = ?', (chemical_id,))
+        _bump_cache_versions(conn, 'chemicals', 'inventory', f'chemical:{chemical_id}')
+        version = _get_cache_version(conn, 'chemicals')
+    _update_name_indexes(chemical_id, version)
 
 def get_all_storage_locations():
     """Get all storage locations"""
-    conn = get_db_connection()
-    locations = conn.execute('SELECT * FROM storage_locations ORDER BY location_name, cabinet, shelf').fetchall()
-    conn.close()
+    with read_connection() as conn:
+        locations = conn.execute('SELECT * FROM storage_locations ORDER BY location_name, cabinet, shelf').fetchall()
     return locations
 
 def get_all_hazard_categories():
     """Get all hazard categories"""
-    conn = get_db_connection()
-    categories = conn.execute('SELECT * FROM hazard_categories ORDER BY name').fetchall()
-    conn.close()
+    with read_connection() as conn:
+        categories = conn.execute('SELECT * FROM hazard_categories ORDER BY name').fetchall()
     return categories
 
 def get_inventory_summary():
     """Get inventory summary with totals"""
-    conn = get_db_connection()
-    summary = conn.execute('''
-        SELECT 
-            COUNT(DISTINCT c.id) as total_chemicals,
-            COUNT(i.id) as total_inventory_items,
-            SUM(CASE WHEN i.expiry_date < date('now') THEN 1 ELSE 0 END) as expired_items,
-            SUM(CASE WHEN i.expiry_date BETWEEN date('now') AND date('now', '+30 days') THEN 1 ELSE 0 END) as expiring_soon
-        FROM chemicals c
-        LEFT JOIN inventory i ON c.id = i.chemical_id
-    ''').fetchone()
-    conn.close()
+    with read_connection() as conn:
+        summary = conn.execute('''
+            SELECT 
+                COUNT(DISTINCT c.id) as total_chemicals,
+                COUNT(i.id) as total_inventory_items,
+                SUM(CASE WHEN i.expiry_date < date('now') THEN 1 ELSE 0 END) as expired_items,
+                SUM(CASE WHEN i.expiry_date BETWEEN date('now') AND date('now', '+30 days') THEN 1 ELSE 0 END) as expiring_soon
+            FROM chemicals c
+            LEFT JOIN inventory i ON c.id = i.chemical_id
+        ''').fetchone()
     return summary
 
+def _load_segregation_matrix(conn):
+    """Build the in-memory hazard compatibility matrix if needed"""
+    if not segregation.is_loaded():
+        segregation.build_matrix(conn.execute('SELECT id, name FROM hazard_categories').fetchall())
+
+def _check_placement(conn, chemical_id, storage_location_id, exclude_inventory_id=None):
+    """Raise SegregationError if the chemical clashes with what is stored at the location"""
+    if storage_location_id is None:
+        return
+    _load_segregation_matrix(conn)
+    chemical = conn.execute('SELECT hazard_category_id FROM chemicals WHERE id = ?', (chemical_id,)).fetchone()
+    if not chemical or chemical['hazard_category_id'] is None:
+        return
+    present = conn.execute('''
+        SELECT DISTINCT c.hazard_category_id
+        FROM inventory i
+        JOIN chemicals c ON i.chemical_id = c.id
+        WHERE i.storage_location_id = ? AND i.id != ? AND c.hazard_category_id IS NOT NULL
+    ''', (storage_location_id, exclude_inventory_id or -1)).fetchall()
+    segregation.check_placement(chemical['hazard_category_id'],
+                                [row['hazard_category_id'] for row in present],
+                                storage_location_id)
+
+def _control_area(conn, storage_location_id, chemical_id):
+    """Get the (building, room, hazard_category_id) a lot counts towards"""
+    if storage_location_id is None:
+        return None
+    row = conn.execute('''
+        SELECT s.building, s.room, c.hazard_category_id
+        FROM storage_locations s, chemicals c
+        WHERE s.id = ? AND c.id = ?
+    ''', (storage_location_id, chemical_id)).fetchone()
+    if not row or row['hazard_category_id'] is None:
+        return None
+    return row['building'] or '', row['room'] or '', row['hazard_category_id']
+
+def _adjust_area_totals(conn, storage_location_id, chemical_id, quantity, unit):
+    """Add a (possibly negative) quantity to the running control-area totals"""
+    amount, base_unit = limits.normalize_quantity(quantity, unit)
+    if not amount:
+        return
+    area = _control_area(conn, storage_location_id, chemical_id)
+    if area is None:
+        return
+    conn.execute('''
+        INSERT INTO storage_area_totals (building, room, hazard_category_id, unit, total_quantity)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (building, room, hazard_category_id, unit)
+        DO UPDATE SET total_quantity = total_quantity + excluded.total_quantity
+    ''', (*area, base_unit, amount))
+    if amount < 0:
+        conn.execute('''
+            DELETE FROM storage_area_totals
+            WHERE building = ? AND room = ? AND hazard_category_id = ? AND unit = ? AND total_quantity < 1e-9
+        ''', (*area, base_unit))
+
+def _get_lots_for_chemical(conn, chemical_id):
+    """Get the quantity, location, expiry date and cost of every lot of a chemical"""
+    return conn.execute('''
+        SELECT id, chemical_id, quantity, unit, storage_location_id, expiry_date, cost
+        FROM inventory WHERE chemical_id = ?
+    ''', (chemical_id,)).fetchall()
+
+def _find_exceeded_limits(conn, chemical_id, storage_location_id, quantity, unit):
+    """Get the limits a receipt of quantity at the location would exceed"""
+    amount, base_unit = limits.normalize_quantity(quantity, unit)
+    if not amount or amount <= 0:
+        return []
+    area = _control_area(conn, storage_location_id, chemical_id)
+    if area is None:
+        return []
+    building, room, hazard_category_id = area
+    applicable = conn.execute('''
+        SELECT * FROM quantity_limits
+        WHERE building = ? AND room IN (?, ?) AND hazard_category_id = ? AND unit = ?
+    ''', (building, room, limits.BUILDING_WIDE, hazard_category_id, base_unit)).fetchall()
+    if not applicable:
+        return []
+    totals = conn.execute('''
+        SELECT COALESCE(SUM(total_quantity), 0) as building_total,
+               COALESCE(SUM(CASE WHEN room = ? THEN total_quantity END), 0) as room_total
+        FROM storage_area_totals
+        WHERE building = ? AND hazard_category_id = ? AND unit = ?
+    ''', (room, building, hazard_category_id, base_unit)).fetchone()
+    return limits.find_exceeded(applicable, totals['room_total'], totals['building_total'], amount)
+
+def _check_quantity_limits(conn, chemical_id, storage_location_id, quantity, unit):
+    """Raise QuantityLimitError if a receipt would exceed a control-area limit"""
+    exceeded = _find_exceeded_limits(conn, chemical_id, storage_location_id, quantity, unit)
+    if exceeded:
+        raise limits.QuantityLimitError(limits.format_exceeded(exceeded))
+
+def check_quantity_limits(chemical_id, storage_location_id, quantity, unit):
+    """Check whether a receipt would exceed a limit, returning the exceeded limits"""
+    with read_connection() as conn:
+        exceeded = _find_exceeded_limits(conn, chemical_id, storage_location_id, quantity, unit)
+    return exceeded
+
 def add_inventory_item(data):
     """Add a new inventory item"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO inventory 
-        (chemical_id, quantity, unit, storage_location_id, batch_number, expiry_date, received_date, cost, notes)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        data.get('chemical_id'),
-        data.get('quantity'),
-        data.get('unit'),
-        data.get('storage_location_id'),
-        data.get('batch_number'),
-        data.get('expiry_date'),
-        data.get('received_date'),
-        data.get('cost'),
-        data.get('notes')
-    ))
-    item_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with write_connection() as conn:
+        _check_placement(conn, data.get('chemical_id'), data.get('storage_location_id'))
+        _check_quantity_limits(conn, data.get('chemical_id'), data.get('storage_location_id'),
+                               data.get('quantity'), data.get('unit'))
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO inventory 
+            (chemical_id, quantity, unit, storage_location_id, batch_number, expiry_date, received_date, cost, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            data.get('chemical_id'),
+            data.get('quantity'),
+            data.get('unit'),
+            data.get('storage_location_id'),
+            data.get('batch_number'),
+            data.get('expiry_date'),
+            data.get('received_date'),
+            data.get('cost'),
+            data.get('notes')
+        ))
+        item_id = cursor.lastrowid
+        _adjust_area_totals(conn, data.get('storage_location_id'), data.get('chemical_id'),
+                            data.get('quantity'), data.get('unit'))
+        item = conn.execute('SELECT * FROM inventory WHERE id = ?', (item_id,)).fetchone()
+        _adjust_value_totals(conn, item, 1, item['quantity'])
+        _bump_cache_versions(conn, 'inventory', f"chemical:{data.get('chemical_id')}")
     return item_id
 
 def update_inventory_quantity(inventory_id, new_quantity):
     """Update inventory quantity"""
-    conn = get_db_connection()
-    conn.execute('UPDATE inventory SET quantity = ? WHERE id = ?', (new_quantity, inventory_id))
-    conn.commit()
-    conn.close()
+    with write_connection() as conn:
+        item = conn.execute('SELECT * FROM inventory WHERE id = ?', (inventory_id,)).fetchone()
+        if not item:
+            raise ValueError('Inventory item not found')
+        delta = float(new_quantity) - item['quantity']
+        if delta > 0:
+            _check_quantity_limits(conn, item['chemical_id'], item['storage_location_id'], delta, item['unit'])
+        conn.execute('UPDATE inventory SET quantity = ? WHERE id = ?', (new_quantity, inventory_id))
+        _adjust_area_totals(conn, item['storage_location_id'], item['chemical_id'], delta, item['unit'])
+        _adjust_value_totals(conn, item, 0, delta)
+        _bump_cache_versions(conn, 'inventory', f"chemical:{item['chemical_id']}")
+
+def transfer_inventory_item(inventory_id, storage_location_id):
+    """Move an inventory item to another storage location"""
+    with write_connection() as conn:
+        item = conn.execute('SELECT * FROM inventory WHERE id = ?', (inventory_id,)).fetchone()
+        if not item:
+            raise ValueError('Inventory item not found')
+        _check_placement(conn, item['chemical_id'], storage_location_id, exclude_inventory_id=inventory_id)
+        source = _control_area(conn, item['storage_location_id'], item['chemical_id'])
+        target = _control_area(conn, storage_location_id, item['chemical_id'])
+        # Take the lot out of the totals first, so it is not counted twice against a limit its source and target share
+        _adjust_area_totals(conn, item['storage_location_id'], item['chemical_id'], -item['quantity'], item['unit'])
+        if target != source:
+            exceeded = _find_exceeded_limits(conn, item['chemical_id'], storage_location_id, item['quantity'],
+                                             item['unit'])
+            if source is not None and target is not None and source[0] == target[0]:
+                # A move within the building leaves its building-wide total unchanged
+                exceeded = [limit for limit in exceeded if limit['room'] is not None]
+            if exceeded:
+                raise limits.QuantityLimitError(limits.format_exceeded(exceeded))
+        conn.execute('UPDATE inventory SET storage_location_id = ? WHERE id = ?', (storage_location_id, inventory_id))
+        _adjust_area_totals(conn, storage_location_id, item['chemical_id'], item['quantity'], item['unit'])
+        _adjust_value_totals(conn, item, -1, -item['quantity'])
+        _adjust_value_totals(conn, dict(item, storage_location_id=storage_location_id), 1, item['quantity'])
+        _bump_cache_versions(conn, 'inventory', f"chemical:{item['chemical_id']}")
+
+def get_segregation_violations():
+    """Find every storage location holding incompatible hazard classes"""
+    with read_connection() as conn:
+        _load_segregation_matrix(conn)
+        rows = conn.execute('''
+            SELECT i.storage_location_id, s.location_name, s.building, s.room, s.cabinet, s.shelf,
+                   c.hazard_category_id, COUNT(*) as lot_count
+            FROM inventory i
+            JOIN chemicals c ON i.chemical_id = c.id
+            LEFT JOIN storage_locations s ON i.storage_location_id = s.id
+            WHERE i.storage_location_id IS NOT NULL AND c.hazard_category_id IS NOT NULL
+            GROUP BY i.storage_location_id, c.hazard_category_id
+        ''').fetchall()
+    
+    by_location = {}
+    for row in rows:
+        by_location.setdefault(row['storage_location_id'], []).append(row)
+    
+    violations = []
+    for location_id, groups in by_location.items():
+        for index, first in enumerate(groups):
+            for second in groups[index + 1:]:
+                if segregation.is_compatible(first['hazard_category_id'], second['hazard_category_id']):
+                    continue
+                violations.append({
+                    'storage_location_id': location_id,
+                    'location_name': first['location_name'],
+                    'building': first['building'],
+                    'room': first['room'],
+                    'cabinet': first['cabinet'],
+                    'shelf': first['shelf'],
+                    'hazard_a': segregation.category_name(first['hazard_category_id']),
+                    'hazard_b': segregation.category_name(second['hazard_category_id']),
+                    'lots_a': first['lot_count'],
+                    'lots_b': second['lot_count']
+                })
+    return violations
 
 def delete_inventory_item(inventory_id):
     """Delete an inventory item"""
-    conn = get_db_connection()
-    conn.execute('DELETE FROM inventory WHERE id = ?', (inventory_id,))
-    conn.commit()
-    conn.close()
+    with write_connection() as conn:
+        item = conn.execute('SELECT * FROM inventory WHERE id = ?', (inventory_id,)).fetchone()
+        if item:
+            _adjust_area_totals(conn, item['storage_location_id'], item['chemical_id'], -item['quantity'], item['unit'])
+            _adjust_value_totals(conn, item, -1, -item['quantity'])
+            _bump_cache_versions(conn, 'inventory', f"chemical:{item['chemical_id']}")
+        conn.execute('DELETE FROM expiry_alerts WHERE inventory_id = ?', (inventory_id,))
+        conn.execute('DELETE FROM inventory WHERE id = ?', (inventory_id,))
+
+def _rebuild_area_totals(conn):
+    """Recompute control-area totals from the inventory table using conn"""
+    rows = conn.execute('''
+        SELECT COALESCE(s.building, '') as building, COALESCE(s.room, '') as room,
+               c.hazard_category_id, i.unit, SUM(i.quantity) as quantity
+        FROM inventory i
+        JOIN chemicals c ON i.chemical_id = c.id
+        JOIN storage_locations s ON i.storage_location_id = s.id
+        WHERE c.hazard_category_id IS NOT NULL
+        GROUP BY s.building, s.room, c.hazard_category_id, i.unit
+    ''').fetchall()
+    totals = {}
+    for row in rows:
+        amount, base_unit = limits.normalize_quantity(row['quantity'], row['unit'])
+        if amount is None:
+            continue
+        key = (row['building'], row['room'], row['hazard_category_id'], base_unit)
+        totals[key] = totals.get(key, 0) + amount
+    conn.execute('DELETE FROM storage_area_totals')
+    conn.executemany('''
+        INSERT INTO storage_area_totals (building, room, hazard_category_id, unit, total_quantity)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(*key, total) for key, total in totals.items()])
+
+def rebuild_area_totals():
+    """Recompute control-area totals from the inventory table"""
+    with write_connection() as conn:
+        _rebuild_area_totals(conn)
+
+# Inventory value totals: table -> expression for the lot column it is keyed by
+VALUE_TOTALS = {
+    'inventory_value_by_location': ('storage_location_id', 'COALESCE(storage_location_id, 0)'),
+    'inventory_value_by_chemical': ('chemical_id', 'chemical_id'),
+    'inventory_value_by_expiry': ('expiry_date', "COALESCE(expiry_date, '')"),
+}
+
+def _adjust_value_totals(conn, lot, lots, quantity):
+    """Add lots (1, 0 or -1) and the value of a (possibly negative) quantity of a lot to the value totals"""
+    cost = lot['cost']
+    keys = (lot['storage_location_id'] or 0, lot['chemical_id'], lot['expiry_date'] or '')
+    for (table, (column, _)), key in zip(VALUE_TOTALS.items(), keys):
+        conn.execute(f'''
+            INSERT INTO {table} ({column}, lots, costed_lots, value) VALUES (?, ?, ?, ?)
+            ON CONFLICT ({column}) DO UPDATE SET
+                lots = lots + excluded.lots,
+                costed_lots = costed_lots + excluded.costed_lots,
+                value = value + excluded.value
+        ''', (key, lots, lots if cost is not None else 0, float(quantity or 0) * cost if cost is not None else 0))
+        if lots < 0:
+            conn.execute(f'DELETE FROM {table} WHERE {column} = ? AND lots <= 0', (key,))
+
+def _rebuild_value_totals(conn):
+    """Recompute the inventory value totals from the inventory table using conn"""
+    for table, (column, expression) in VALUE_TOTALS.items():
+        conn.execute(f'DELETE FROM {table}')
+        conn.execute(f'''
+            INSERT INTO {table} ({column}, lots, costed_lots, value)
+            SELECT {expression}, COUNT(*), COUNT(cost), COALESCE(SUM(quantity * cost), 0)
+            FROM inventory NOT INDEXED
+            GROUP BY 1
+        ''')
+
+def rebuild_value_totals():
+    """Recompute the inventory value totals from the inventory table"""
+    with write_connection() as conn:
+        _rebuild_value_totals(conn)
+        _bump_cache_versions(conn, 'inventory')
+
+def set_quantity_limit(building, room, hazard_category_id, unit, max_quantity):
+    """Create or update a quantity limit for a building or room"""
+    max_quantity, base_unit = limits.normalize_quantity(max_quantity, unit)
+    if base_unit is None:
+        raise ValueError(f'Unsupported unit: {unit}')
+    with write_connection() as conn:
+        conn.execute('''
+            INSERT INTO quantity_limits (building, room, hazard_category_id, unit, max_quantity)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (building, room, hazard_category_id, unit)
+            DO UPDATE SET max_quantity = excluded.max_quantity
+        ''', (building, room or limits.BUILDING_WIDE, hazard_category_id, base_unit, max_quantity))
+
+def delete_quantity_limit(limit_id):
+    """Delete a quantity limit"""
+    with write_connection() as conn:
+        conn.execute('DELETE FROM quantity_limits WHERE id = ?', (limit_id,))
+
+def get_quantity_limits():
+    """Get all configured quantity limits"""
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT l.*, h.name as hazard_name
+            FROM quantity_limits l
+            LEFT JOIN hazard_categories h ON l.hazard_category_id = h.id
+            ORDER BY l.building, l.room, h.name
+        ''').fetchall()
+    return rows
+
+def get_quantity_report():
+    """Get control-area totals for rooms and buildings alongside their limits"""
+    with read_connection() as conn:
+        rooms = conn.execute('''
+            SELECT t.building, t.room, t.hazard_category_id, h.name as hazard_name, t.unit,
+                   t.total_quantity, l.max_quantity
+            FROM storage_area_totals t
+            LEFT JOIN hazard_categories h ON t.hazard_category_id = h.id
+            LEFT JOIN quantity_limits l ON l.building = t.building AND l.room = t.room
+                 AND l.room != '' AND l.hazard_category_id = t.hazard_category_id AND l.unit = t.unit
+            ORDER BY t.building, t.room, h.name
+        ''').fetchall()
+        buildings = conn.execute('''
+            SELECT t.building, t.hazard_category_id, h.name as hazard_name, t.unit,
+                   SUM(t.total_quantity) as total_quantity, l.max_quantity
+            FROM storage_area_totals t
+            LEFT JOIN hazard_categories h ON t.hazard_category_id = h.id
+            LEFT JOIN quantity_limits l ON l.building = t.building AND l.room = ''
+                 AND l.hazard_category_id = t.hazard_category_id AND l.unit = t.unit
+            GROUP BY t.building, t.hazard_category_id, t.unit
+            ORDER BY t.building, h.name
+        ''').fetchall()
+    return {'rooms': [dict(r) for r in rooms], 'buildings': [dict(b) for b in buildings]}
+
+def get_unalerted_expiring_inventory(days):
+    """Get inventory items expired or expiring within days that have not been alerted yet"""
+    with read_connection() as conn:
+        items = conn.execute('''
+            SELECT i.id, i.chemical_id, i.quantity, i.unit, i.batch_number, i.expiry_date,
+                   c.name as chemical_name,
+                   CASE WHEN i.expiry_date < date('now') THEN 'expired' ELSE 'expiring' END as alert_type
+            FROM inventory i
+            JOIN chemicals c ON i.chemical_id = c.id
+            WHERE i.expiry_date <= date('now', ?)
+              AND NOT EXISTS (
+                  SELECT 1 FROM expiry_alerts a
+                  WHERE a.inventory_id = i.id
+                    AND a.alert_type = CASE WHEN i.expiry_date < date('now') THEN 'expired' ELSE 'expiring' END
+              )
+            ORDER BY i.expiry_date
+        ''', (f'+{int(days)} days',)).fetchall()
+    return items
+
+def record_expiry_alerts(items, admin_ids):
+    """Mark items as alerted and notify every admin
+    
+    Notifications for admins whose records live in a shard are written after
+    the alerts commit.
+    """
+    admin_paths = {admin_id: get_user_database(admin_id) for admin_id in admin_ids}
+    with write_connection() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO expiry_alerts (inventory_id, alert_type) VALUES (?, ?)',
+            [(item['id'], item['alert_type']) for item in items]
+        )
+        notifications = []
+        for item in items:
+            batch = f" (batch {item['batch_number']})" if item['batch_number'] else ''
+            if item['alert_type'] == 'expired':
+                title = 'Chemical Expired'
+                message = f"{item['chemical_name']}{batch} expired on {item['expiry_date']}"
+            else:
+                title = 'Chemical Expiring Soon'
+                message = f"{item['chemical_name']}{batch} expires on {item['expiry_date']}"
+            for admin_id in admin_ids:
+                notifications.append((admin_id, title, message, 'expiry', 'inventory', item['id']))
+        groups = _group_by_user_database(notifications, admin_paths)
+        _insert_notifications(conn, groups.pop(DATABASE_NAME, []))
+    for path, rows in groups.items():
+        with write_connection(path) as conn:
+            _insert_notifications(conn, rows)
+    return len(notifications)
 
 def search_chemicals(query):
     """Search chemicals by name, formula, or CAS number"""
-    conn = get_db_connection()
-    search_term = f'%{query}%'
-    chemicals = conn.execute('''
-        SELECT c.*, h.name as hazard_name, h.color_code
-        FROM chemicals c
-        LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
-        WHERE c.name LIKE ? OR c.chemical_formula LIKE ? OR c.cas_number LIKE ?
-        ORDER BY c.name
-    ''', (search_term, search_term, search_term)).fetchall()
-    conn.close()
+    cas_key = _search_cas_key(query)
+    with read_connection() as conn:
+        # A CAS number is an exact index lookup instead of a scan
+        if cas_key is not None:
+            return conn.execute('''
+                SELECT c.*, h.name as hazard_name, h.color_code
+                FROM chemicals c
+                LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
+                WHERE c.cas_key = ?
+            ''', (cas_key,)).fetchall()
+        search_term = f'%{query}%'
+        chemicals = conn.execute('''
+            SELECT c.*, h.name as hazard_name, h.color_code
+            FROM chemicals c
+            LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
+            WHERE c.name LIKE ? OR c.chemical_formula LIKE ? OR c.cas_number LIKE ?
+            ORDER BY c.name
+        ''', (search_term, search_term, search_term)).fetchall()
+    return chemicals
+
+def _set_synonyms(conn, chemical_id, synonyms):
+    """Store synonyms for a chemical, given as a list or a comma-separated string"""
+    if isinstance(synonyms, str):
+        synonyms = synonyms.split(',')
+    synonyms = [synonym.strip() for synonym in synonyms or [] if synonym and synonym.strip()]
+    conn.executemany('INSERT OR IGNORE INTO chemical_synonyms (chemical_id, synonym) VALUES (?, ?)',
+                     [(chemical_id, synonym) for synonym in synonyms])
+
+def get_synonyms(chemical_id):
+    """Get the synonyms of a chemical"""
+    with read_connection() as conn:
+        rows = conn.execute('SELECT synonym FROM chemical_synonyms WHERE chemical_id = ? ORDER BY id',
+                            (chemical_id,)).fetchall()
+    return [row['synonym'] for row in rows]
+
+# Elemental composition: chemical_elements holds the parsed formula of each
+# chemical and chemicals.formula_weight its computed weight, so element and
+# mass-range queries use indexes. Formulas that do not parse (mixtures,
+# polymers) get no elements and no formula weight.
+MOLECULAR_WEIGHT_TOLERANCE = 0.01
+
+def _index_formula(conn, chemical_id, chemical_formula, parsed=None):
+    """Store the composition and formula weight of one chemical"""
+    conn.execute('DELETE FROM chemical_elements WHERE chemical_id = ?', (chemical_id,))
+    try:
+        composition = parsed if parsed is not None else formula.parse(chemical_formula)
+    except formula.FormulaError:
+        composition = None
+    if not composition:
+        conn.execute('UPDATE chemicals SET formula_weight = NULL WHERE id = ?', (chemical_id,))
+        return False
+    conn.executemany('INSERT INTO chemical_elements (element, chemical_id, count) VALUES (?, ?, ?)',
+                     [(element, chemical_id, count) for element, count in composition.items()])
+    conn.execute('UPDATE chemicals SET formula_weight = ? WHERE id = ?', (formula.weight(composition), chemical_id))
+    return True
+
+def _reindex_formulas(conn):
+    """Rebuild chemical_elements and formula weights for the whole catalogue"""
+    conn.execute('DELETE FROM chemical_elements')
+    parsed = {}
+    elements = []
+    weights = []
+    unparsed = 0
+    for chemical in conn.execute('SELECT id, chemical_formula FROM chemicals').fetchall():
+        text = chemical['chemical_formula']
+        # Catalogues repeat formulas (isomers, grades), so each is parsed once
+        if text not in parsed:
+            try:
+                parsed[text] = formula.parse(text)
+            except formula.FormulaError:
+                parsed[text] = None
+        composition = parsed[text]
+        if composition is None:
+            unparsed += 1
+            weights.append((None, chemical['id']))
+            continue
+        elements.extend((element, chemical['id'], count) for element, count in composition.items())
+        weights.append((formula.weight(composition), chemical['id']))
+    conn.executemany('INSERT INTO chemical_elements (element, chemical_id, count) VALUES (?, ?, ?)', elements)
+    conn.executemany('UPDATE chemicals SET formula_weight = ? WHERE id = ?', weights)
+    return {'chemicals': len(weights), 'parsed': len(weights) - unparsed, 'unparsed': unparsed,
+            'elements': len(elements)}
+
+def reindex_formulas():
+    """Re-parse every chemical formula into chemical_elements"""
+    with write_connection() as conn:
+        result = _reindex_formulas(conn)
+        _bump_cache_versions(conn, 'chemicals')
+    return result
+
+def get_composition(chemical_id):
+    """Get {element: count} for a chemical"""
+    with read_connection() as conn:
+        rows = conn.execute('SELECT element, count FROM chemical_elements WHERE chemical_id = ? ORDER BY element',
+                            (chemical_id,)).fetchall()
+    return {row['element']: row['count'] for row in rows}
+
+def _composition_conditions(elements=(), min_weight=None, max_weight=None):
+    """Build WHERE conditions on chemicals c for element and formula weight filters"""
+    conditions = []
+    params = []
+    # One indexed probe per element, intersected through the chemical ID
+    for element in elements:
+        conditions.append('c.id IN (SELECT chemical_id FROM chemical_elements WHERE element = ?)')
+        params.append(element)
+    if min_weight is not None:
+        conditions.append('c.formula_weight >= ?')
+        params.append(float(min_weight))
+    if max_weight is not None:
+        conditions.append('c.formula_weight <= ?')
+        params.append(float(max_weight))
+    return conditions, params
+
+def search_by_composition(elements=(), min_weight=None, max_weight=None, limit=100):
+    """Get chemicals containing every given element, within a formula weight range"""
+    conditions, params = _composition_conditions(elements, min_weight, max_weight)
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    with read_connection() as conn:
+        chemicals = conn.execute(f'''
+            SELECT c.*, h.name as hazard_name, h.color_code
+            FROM chemicals c
+            LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
+            {where}
+            ORDER BY c.formula_weight, c.name
+            LIMIT ?
+        ''', (*params, int(limit))).fetchall()
     return chemicals
 
+def get_weight_mismatches(tolerance=MOLECULAR_WEIGHT_TOLERANCE):
+    """Get chemicals whose entered molecular weight differs from the formula weight by more than tolerance (relative)"""
+    with read_connection() as conn:
+        chemicals = conn.execute('''
+            SELECT id, name, chemical_formula, molecular_weight, formula_weight
+            FROM chemicals
+            WHERE molecular_weight IS NOT NULL AND formula_weight IS NOT NULL
+              AND ABS(molecular_weight - formula_weight) > formula_weight * ?
+            ORDER BY name
+        ''', (tolerance,)).fetchall()
+    return chemicals
+
+# Name indexes: suggest.index (typeahead) and similarity.index (near-duplicate
+# names) mirror the catalogue and are tagged with the 'chemicals' cache
+# version they were built from. A write applies its own change when an index
+# is exactly one version behind; any other gap (a write from another process)
+# makes the next lookup rebuild it from the database.
+NAME_INDEXES = (suggest.index, similarity.index)
+
+def get_catalogue_names():
+    """Get the 'chemicals' cache version and (chemical, synonyms) pairs for every chemical"""
+    with read_connection() as conn:
+        version = _get_cache_version(conn, 'chemicals')
+        chemicals = conn.execute('SELECT id, name, chemical_formula, cas_number FROM chemicals').fetchall()
+        synonyms = {}
+        for row in conn.execute('SELECT chemical_id, synonym FROM chemical_synonyms ORDER BY id'):
+            synonyms.setdefault(row['chemical_id'], []).append(row['synonym'])
+    return version, [(chemical, synonyms.get(chemical['id'], [])) for chemical in chemicals]
+
+def load_suggestions():
+    """Build the typeahead index from the chemicals and synonyms tables"""
+    version, chemicals = get_catalogue_names()
+    suggest.index.build(chemicals, version)
+    return suggest.index.stats()
+
+def load_name_index():
+    """Build the near-duplicate name index from the chemicals and synonyms tables"""
+    version, chemicals = get_catalogue_names()
+    similarity.index.build(chemicals, version)
+    return similarity.index.stats()
+
+def _update_name_indexes(chemical_id, version):
+    """Apply one chemical's change to the typeahead and near-duplicate indexes"""
+    indexes = [name_index for name_index in NAME_INDEXES if name_index.version is not None]
+    if not indexes:
+        return
+    with read_connection() as conn:
+        chemical = conn.execute('SELECT id, name, chemical_formula, cas_number FROM chemicals WHERE id = ?',
+                                (chemical_id,)).fetchone()
+        synonyms = [row['synonym'] for row in conn.execute(
+            'SELECT synonym FROM chemical_synonyms WHERE chemical_id = ? ORDER BY id', (chemical_id,))]
+    for name_index in indexes:
+        name_index.update(chemical_id, chemical, synonyms, version)
+
+def suggest_chemicals(prefix, limit=suggest.MAX_SUGGESTIONS):
+    """Get typeahead suggestions for a prefix, rebuilding the index if the catalogue changed"""
+    if suggest.index.version != get_cache_versions('chemicals')[0]:
+        load_suggestions()
+    return suggest.index.suggest(prefix, limit)
+
+def find_similar_chemicals(name, synonyms=(), exclude_id=None, limit=similarity.MAX_MATCHES, chemical_formula=None):
+    """Get chemicals whose name or synonyms are close to a name or its synonyms"""
+    if similarity.index.version != get_cache_versions('chemicals')[0]:
+        load_name_index()
+    if isinstance(synonyms, str):
+        synonyms = synonyms.split(',')
+    names = [name] + [synonym for synonym in synonyms or [] if synonym and synonym.strip()]
+    return similarity.index.similar(names, exclude_id, limit=limit, chemical_formula=chemical_formula)
+
+def find_duplicate_groups(threshold=similarity.SIMILARITY_THRESHOLD):
+    """Cluster the whole catalogue into candidate merge groups and store them"""
+    load_name_index()
+    groups = similarity.index.cluster(threshold)
+    with write_connection() as conn:
+        conn.execute('DELETE FROM duplicate_candidates')
+        conn.executemany('INSERT INTO duplicate_candidates (group_id, chemical_id, score) VALUES (?, ?, ?)',
+                         [(group_id, chemical_id, score)
+                          for group_id, group in enumerate(groups, 1)
+                          for chemical_id, score in group.items()])
+    return {'groups': len(groups), 'chemicals': sum(len(group) for group in groups)}
+
+def get_duplicate_groups():
+    """Get the stored candidate merge groups with chemical names and stock"""
+    with read_connection() as conn:
+        rows = conn.execute('''
+            SELECT d.group_id, d.score, d.detected_at, c.id, c.name, c.chemical_formula, c.cas_number,
+                   (SELECT COUNT(*) FROM inventory i WHERE i.chemical_id = c.id) as lot_count
+            FROM duplicate_candidates d
+            JOIN chemicals c ON c.id = d.chemical_id
+            ORDER BY d.group_id, c.name
+        ''').fetchall()
+    groups = {}
+    for row in rows:
+        group = groups.setdefault(row['group_id'], {'group_id': row['group_id'], 'detected_at': row['detected_at'],
+                                                    'chemicals': []})
+        group['chemicals'].append({key: row[key] for key in
+                                   ('id', 'name', 'chemical_formula', 'cas_number', 'lot_count', 'score')})
+    return [group for group in groups.values() if len(group['chemicals']) > 1]
+
 # User management functions
 def create_user(username, email, password_hash, full_name, role='student', student_id=None, department=None, phone_number=None):
     """Create a new user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO users (username, email, password_hash, full_name, role, student_id, department, phone_number)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (username, email, password_hash, full_name, role, student_id, department, phone_number))
-    user_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with write_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO users (username, email, password_hash, full_name, role, student_id, department, phone_number)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (username, email, password_hash, full_name, role, student_id, department, phone_number))
+        user_id = cursor.lastrowid
     return user_id
 
 def get_user_by_username(username):
     """Get user by username"""
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
+    with read_connection() as conn:
+        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
     return user
 
 def get_user_by_email(email):
     """Get user by email"""
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-    conn.close()
+    with read_connection() as conn:
+        user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+    return user
+
+def get_user_for_login(login):
+    """Get the user whose username or, failing that, email matches a login name"""
+    with read_connection() as conn:
+        user = conn.execute('''
+            SELECT * FROM users
+            WHERE username = ? OR email = ?
+            ORDER BY username = ? DESC
+            LIMIT 1
+        ''', (login, login, login)).fetchone()
     return user
 
 def get_user_by_id(user_id):
     """Get user by ID"""
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
+    with read_connection() as conn:
+        user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
     return user
 
-def update_last_login(user_id):
-    """Update user's last login timestamp"""
-    conn = get_db_connection()
-    conn.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+def update_last_login(user_id, password_hash=None, previous_hash=None):
+    """Update user's last login timestamp, storing an upgraded password hash if given
+    
+    The hash is only replaced if it is still previous_hash, so a password
+    changed since the login was checked is kept.
+    """
+    with write_connection() as conn:
+        conn.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (user_id,))
+        if password_hash:
+            conn.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                         (password_hash, user_id, previous_hash))
 
 def get_all_users():
     """Get all users"""
-    conn = get_db_connection()
-    users = conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
-    conn.close()
+    with read_connection() as conn:
+        users = conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
     return users
 
+def get_admin_ids():
+    """Get the IDs of all active admins"""
+    with read_connection() as conn:
+        rows = conn.execute("SELECT id FROM users WHERE role = 'admin' AND is_active = 1").fetchall()
+    return [row['id'] for row in rows]
+
 def update_user(user_id, data):
     """Update user information"""
-    conn = get_db_connection()
-    conn.execute('''
-        UPDATE users 
-        SET full_name = ?, department = ?, phone_number = ?, student_id = ?
-        WHERE id = ?
-    ''', (data.get('full_name'), data.get('department'), data.get('phone_number'), 
-          data.get('student_id'), user_id))
-    conn.commit()
-    conn.close()
+    with write_connection() as conn:
+        conn.execute('''
+            UPDATE users 
+            SET full_name = ?, department = ?, phone_number = ?, student_id = ?
+            WHERE id = ?
+        ''', (data.get('full_name'), data.get('department'), data.get('phone_number'), 
+              data.get('student_id'), user_id))
+
+# Sessions carry the user's auth_version; bumping it (and the 'auth' cache
+# version, which tells other processes to re-read versions) signs them out
+def _bump_auth_version(conn, user_id):
+    """Increment a user's auth_version so their existing sessions are rejected"""
+    conn.execute('UPDATE users SET auth_version = auth_version + 1 WHERE id = ?', (user_id,))
+    _bump_cache_versions(conn, 'auth')
+
+def get_auth_versions():
+    """Get the 'auth' cache version and the auth_version of every user whose sessions were ever revoked"""
+    with read_connection() as conn:
+        version = _get_cache_version(conn, 'auth')
+        rows = conn.execute('SELECT id, auth_version FROM users WHERE auth_version > 0').fetchall()
+    return version, {row['id']: row['auth_version'] for row in rows}
 
 def deactivate_user(user_id):
-    """Deactivate a user"""
-    conn = get_db_connection()
-    conn.execute('UPDATE users SET is_active = 0 WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    """Deactivate a user, signing out their sessions"""
+    with write_connection() as conn:
+        conn.execute('UPDATE users SET is_active = 0 WHERE id = ?', (user_id,))
+        _bump_auth_version(conn, user_id)
+
+def activate_user(user_id):
+    """Reactivate a user"""
+    with write_connection() as conn:
+        conn.execute('UPDATE users SET is_active = 1 WHERE id = ?', (user_id,))
+
+def set_user_role(user_id, role):
+    """Change a user's role, signing out their sessions"""
+    if role not in ('admin', 'student'):
+        raise ValueError(f'Unknown role "{role}"')
+    with write_connection() as conn:
+        conn.execute('UPDATE users SET role = ? WHERE id = ?', (role, user_id))
+        _bump_auth_version(conn, user_id)
 
 # Chemical request functions
 def create_request(student_id, chemical_id, quantity_requested, unit, purpose, required_date, expected_return_date):
-    """Create a new chemical request"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO chemical_requests 
-        (student_id, chemical_id, quantity_requested, unit, purpose, required_date, expected_return_date, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')
-    ''', (student_id, chemical_id, quantity_requested, unit, purpose, required_date, expected_return_date))
-    request_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    """Create a new chemical request in the student's shard"""
+    with write_connection(get_user_database(student_id)) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO chemical_requests 
+            (student_id, chemical_id, quantity_requested, unit, purpose, required_date, expected_return_date, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')
+        ''', (student_id, chemical_id, quantity_requested, unit, purpose, required_date, expected_return_date))
+        request_id = cursor.lastrowid
     return request_id
 
 def get_request_by_id(request_id):
     """Get a specific request by ID"""
-    conn = get_db_connection()
-    request = conn.execute('''
-        SELECT r.*, 
-               u.username, u.full_name, u.student_id as requester_student_id, u.department,
-               c.name as chemical_name, c.chemical_formula, c.cas_number,
-               a.username as approved_by_username
-        FROM chemical_requests r
-        JOIN users u ON r.student_id = u.id
-        JOIN chemicals c ON r.chemical_id = c.id
-        LEFT JOIN users a ON r.approved_by = a.id
-        WHERE r.id = ?
-    ''', (request_id,)).fetchone()
-    conn.close()
-    return request
-
-def get_requests_by_student(student_id):
-    """Get all requests by a specific student"""
-    conn = get_db_connection()
-    requests = conn.execute('''
-        SELECT r.*, 
-               c.name as chemical_name, c.chemical_formula,
-               a.username as approved_by_username
-        FROM chemical_requests r
-        JOIN chemicals c ON r.chemical_id = c.id
-        LEFT JOIN users a ON r.approved_by = a.id
-        WHERE r.student_id = ?
-        ORDER BY r.created_at DESC
-    ''', (student_id,)).fetchall()
-    conn.close()
-    return requests
-
-def get_all_requests(status=None):
-    """Get all requests, optionally filtered by status"""
-    conn = get_db_connection()
-    if status:
-        requests = conn.execute('''
+    with read_connection(get_record_database(request_id)) as conn:
+        request = conn.execute('''
             SELECT r.*, 
                    u.username, u.full_name, u.student_id as requester_student_id, u.department,
-                   c.name as chemical_name, c.chemical_formula,
+                   c.name as chemical_name, c.chemical_formula, c.cas_number,
                    a.username as approved_by_username
             FROM chemical_requests r
             JOIN users u ON r.student_id = u.id
             JOIN chemicals c ON r.chemical_id = c.id
             LEFT JOIN users a ON r.approved_by = a.id
-            WHERE r.status = ?
-            ORDER BY r.created_at DESC
-        ''', (status,)).fetchall()
-    else:
+            WHERE r.id = ?
+        ''', (request_id,)).fetchone()
+    return request
+
+def get_requests_by_student(student_id):
+    """Get all requests by a specific student"""
+    with read_connection(get_user_database(student_id)) as conn:
         requests = conn.execute('''
             SELECT r.*, 
-                   u.username, u.full_name, u.student_id as requester_student_id, u.department,
                    c.name as chemical_name, c.chemical_formula,
                    a.username as approved_by_username
             FROM chemical_requests r
-            JOIN users u ON r.student_id = u.id
             JOIN chemicals c ON r.chemical_id = c.id
             LEFT JOIN users a ON r.approved_by = a.id
+            WHERE r.student_id = ?
             ORDER BY r.created_at DESC
-        ''').fetchall()
-    conn.close()
+        ''', (student_id,)).fetchall()
     return requests
 
+def get_all_requests(status=None):
+    """Get all requests across every shard, optionally filtered by status"""
+    where = 'WHERE r.status = ?' if status else ''
+    return _fan_out(f'''
+        SELECT r.*, 
+               u.username, u.full_name, u.student_id as requester_student_id, u.department,
+               c.name as chemical_name, c.chemical_formula,
+               a.username as approved_by_username
+        FROM chemical_requests r
+        JOIN users u ON r.student_id = u.id
+        JOIN chemicals c ON r.chemical_id = c.id
+        LEFT JOIN users a ON r.approved_by = a.id
+        {where}
+        ORDER BY r.created_at DESC
+    ''', (status,) if status else (), order_by='created_at', descending=True)
+
 def approve_request(request_id, admin_id, admin_notes=None):
     """Approve a chemical request"""
-    conn = get_db_connection()
-    conn.execute('''
-        UPDATE chemical_requests 
-        SET status = 'approved', approved_by = ?, approval_date = CURRENT_TIMESTAMP, admin_notes = ?
-        WHERE id = ?
-    ''', (admin_id, admin_notes, request_id))
-    conn.commit()
-    conn.close()
+    with write_connection(get_record_database(request_id)) as conn:
+        conn.execute('''
+            UPDATE chemical_requests 
+            SET status = 'approved', approved_by = ?, approval_date = CURRENT_TIMESTAMP, admin_notes = ?
+            WHERE id = ?
+        ''', (admin_id, admin_notes, request_id))
 
 def reject_request(request_id, admin_id, rejection_reason):
     """Reject a chemical request"""
-    conn = get_db_connection()
-    conn.execute('''
-        UPDATE chemical_requests 
-        SET status = 'rejected', approved_by = ?, approval_date = CURRENT_TIMESTAMP, rejection_reason = ?
-        WHERE id = ?
-    ''', (admin_id, rejection_reason, request_id))
-    conn.commit()
-    conn.close()
+    with write_connection(get_record_database(request_id)) as conn:
+        conn.execute('''
+            UPDATE chemical_requests 
+            SET status = 'rejected', approved_by = ?, approval_date = CURRENT_TIMESTAMP, rejection_reason = ?
+            WHERE id = ?
+        ''', (admin_id, rejection_reason, request_id))
 
 def mark_as_borrowed(request_id, inventory_id, condition_at_borrow, notes=None):
     """Mark request as borrowed and create borrow history"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get request details
-    request = cursor.execute('SELECT * FROM chemical_requests WHERE id = ?', (request_id,)).fetchone()
-    
-    # Update request status
-    cursor.execute('UPDATE chemical_requests SET status = ? WHERE id = ?', ('borrowed', request_id))
-    
-    # Create borrow history
-    cursor.execute('''
-        INSERT INTO borrow_history 
-        (request_id, student_id, chemical_id, quantity_borrowed, unit, expected_return_date, 
-         condition_at_borrow, inventory_id, notes)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (request_id, request['student_id'], request['chemical_id'], request['quantity_requested'],
-          request['unit'], request['expected_return_date'], condition_at_borrow, inventory_id, notes))
-    
-    conn.commit()
-    conn.close()
+    with write_connection(get_record_database(request_id)) as conn:
+        cursor = conn.cursor()
+        
+        # Get request details
+        request = cursor.execute('SELECT * FROM chemical_requests WHERE id = ?', (request_id,)).fetchone()
+        
+        # Update request status
+        cursor.execute('UPDATE chemical_requests SET status = ? WHERE id = ?', ('borrowed', request_id))
+        
+        # Create borrow history
+        cursor.execute('''
+            INSERT INTO borrow_history 
+            (request_id, student_id, chemical_id, quantity_borrowed, unit, expected_return_date, 
+             condition_at_borrow, inventory_id, notes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (request_id, request['student_id'], request['chemical_id'], request['quantity_requested'],
+              request['unit'], request['expected_return_date'], condition_at_borrow, inventory_id, notes))
+        
+        # Count the borrow in the consumption rollups
+        borrow = cursor.execute('''
+            SELECT bh.borrow_date, bh.chemical_id, u.department, bh.unit, bh.quantity_borrowed
+            FROM borrow_history bh
+            LEFT JOIN users u ON bh.student_id = u.id
+            WHERE bh.id = ?
+        ''', (cursor.lastrowid,)).fetchone()
+        _add_consumption(conn, [(borrow['borrow_date'], borrow['chemical_id'], borrow['department'],
+                                 borrow['unit'], 1, borrow['quantity_borrowed'], 0)])
+        
 
 def mark_as_returned(request_id, condition_at_return, notes=None):
     """Mark borrowed item as returned"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Update request status
-    cursor.execute('''
-        UPDATE chemical_requests 
-        SET status = 'returned', actual_return_date = date('now')
-        WHERE id = ?
-    ''', (request_id,))
-    
-    # Update borrow history
-    cursor.execute('''
-        UPDATE borrow_history 
-        SET actual_return_date = CURRENT_TIMESTAMP, condition_at_return = ?, notes = ?
-        WHERE request_id = ?
-    ''', (condition_at_return, notes, request_id))
-    
-    conn.commit()
-    conn.close()
+    with write_connection(get_record_database(request_id)) as conn:
+        cursor = conn.cursor()
+        
+        # Update request status
+        cursor.execute('''
+            UPDATE chemical_requests 
+            SET status = 'returned', actual_return_date = date('now')
+            WHERE id = ?
+        ''', (request_id,))
+        
+        # Update borrow history, moving the return in the consumption rollups
+        # from the previous return date if the item was already marked returned
+        borrows = cursor.execute('''
+            SELECT bh.id, bh.chemical_id, u.department, bh.unit, bh.actual_return_date
+            FROM borrow_history bh
+            LEFT JOIN users u ON bh.student_id = u.id
+            WHERE bh.request_id = ?
+        ''', (request_id,)).fetchall()
+        cursor.execute('''
+            UPDATE borrow_history 
+            SET actual_return_date = CURRENT_TIMESTAMP, condition_at_return = ?, notes = ?
+            WHERE request_id = ?
+        ''', (condition_at_return, notes, request_id))
+        
+        returned_at = cursor.execute(
+            'SELECT actual_return_date FROM borrow_history WHERE request_id = ? LIMIT 1', (request_id,)
+        ).fetchone()
+        changes = []
+        for borrow in borrows:
+            key = (borrow['chemical_id'], borrow['department'], borrow['unit'])
+            if borrow['actual_return_date']:
+                changes.append((borrow['actual_return_date'], *key, 0, 0, -1))
+            changes.append((returned_at['actual_return_date'], *key, 0, 0, 1))
+        _add_consumption(conn, changes)
+        
 
 def get_borrowed_items(student_id=None):
     """Get currently borrowed items, optionally filtered by student"""
-    conn = get_db_connection()
     if student_id:
-        items = conn.execute('''
-            SELECT r.*, 
-                   c.name as chemical_name, c.chemical_formula,
-                   bh.borrow_date, bh.condition_at_borrow
-            FROM chemical_requests r
-            JOIN chemicals c ON r.chemical_id = c.id
-            LEFT JOIN borrow_history bh ON r.id = bh.request_id
-            WHERE r.student_id = ? AND r.status = 'borrowed'
-            ORDER BY r.required_date
-        ''', (student_id,)).fetchall()
+        with read_connection(get_user_database(student_id)) as conn:
+            items = conn.execute('''
+                SELECT r.*, 
+                       c.name as chemical_name, c.chemical_formula,
+                       bh.borrow_date, bh.condition_at_borrow
+                FROM chemical_requests r
+                JOIN chemicals c ON r.chemical_id = c.id
+                LEFT JOIN borrow_history bh ON r.id = bh.request_id
+                WHERE r.student_id = ? AND r.status = 'borrowed'
+                ORDER BY r.required_date
+            ''', (student_id,)).fetchall()
     else:
-        items = conn.execute('''
+        items = _fan_out('''
             SELECT r.*, 
                    u.username, u.full_name, u.student_id as requester_student_id,
                    c.name as chemical_name, c.chemical_formula,
@@ -662,24 +2397,111 @@ def get_borrowed_items(student_id=None):
             LEFT JOIN borrow_history bh ON r.id = bh.request_id
             WHERE r.status = 'borrowed'
             ORDER BY r.expected_return_date
-        ''').fetchall()
-    conn.close()
+        ''', order_by='expected_return_date')
     return items
 
+def get_overdue_count(student_id=None):
+    """Count borrowed items past their expected return date
+    
+    Counted from the dates rather than the sweep's overdue_since flag, so the
+    count is right even where the overdue job has not run yet.
+    """
+    if student_id:
+        with read_connection(get_user_database(student_id)) as conn:
+            result = conn.execute('''
+                SELECT COUNT(*) as count FROM chemical_requests
+                WHERE status = 'borrowed' AND expected_return_date < date('now') AND student_id = ?
+            ''', (student_id,)).fetchone()
+        return result['count']
+    rows = _fan_out('''
+        SELECT COUNT(*) as count FROM chemical_requests
+        WHERE status = 'borrowed' AND expected_return_date < date('now')
+    ''')
+    return sum(row['count'] for row in rows)
+
+def sweep_overdue_borrows(due_soon_days, escalate_after_days, admin_ids):
+    """Flag overdue borrows and send reminders for any new escalation level
+    
+    Levels: 1 = due within due_soon_days, 2 = overdue,
+    3 = overdue for escalate_after_days or more (admins are notified too).
+    Each shard is swept in its own transaction; admin notifications for another
+    shard are written after it commits.
+    """
+    admin_paths = {admin_id: get_user_database(admin_id) for admin_id in admin_ids}
+    result = {'newly_overdue': 0, 'reminded': 0, 'escalated': 0, 'notifications': 0}
+    other_shards = []
+    for path in get_database_paths():
+        flagged, due, notifications = _sweep_overdue(path, due_soon_days, escalate_after_days, admin_paths)
+        other_shards.extend(row for row in notifications if admin_paths.get(row[0], path) != path)
+        result['newly_overdue'] += flagged
+        result['reminded'] += len(due)
+        result['escalated'] += sum(1 for item in due if item['level'] == 3)
+        result['notifications'] += len(notifications)
+    create_notifications(other_shards)
+    return result
+
+def _sweep_overdue(path, due_soon_days, escalate_after_days, admin_paths):
+    """Sweep one database file, returning (newly flagged, reminded items, notifications)"""
+    with write_connection(path) as conn:
+        cursor = conn.cursor()
+        flagged = cursor.execute('''
+            UPDATE chemical_requests
+            SET overdue_since = date(expected_return_date, '+1 day')
+            WHERE status = 'borrowed' AND expected_return_date < date('now') AND overdue_since IS NULL
+        ''').rowcount
+        
+        due = cursor.execute('''
+            SELECT * FROM (
+                SELECT r.id, r.student_id, r.expected_return_date, r.reminder_level,
+                       r.quantity_requested, r.unit, c.name as chemical_name, u.full_name,
+                       CASE WHEN r.expected_return_date < date('now', ?) THEN 3
+                            WHEN r.expected_return_date < date('now') THEN 2
+                            ELSE 1 END as level
+                FROM chemical_requests r
+                JOIN chemicals c ON r.chemical_id = c.id
+                JOIN users u ON r.student_id = u.id
+                WHERE r.status = 'borrowed' AND r.expected_return_date <= date('now', ?)
+            )
+            WHERE level > reminder_level
+        ''', (f'-{int(escalate_after_days)} days', f'+{int(due_soon_days)} days')).fetchall()
+        
+        notifications = []
+        for item in due:
+            if item['level'] == 1:
+                title = 'Return Due Soon'
+                message = f"{item['chemical_name']} is due back on {item['expected_return_date']}"
+            elif item['level'] == 2:
+                title = 'Return Overdue'
+                message = f"{item['chemical_name']} was due back on {item['expected_return_date']}. Please return it as soon as possible"
+            else:
+                title = 'Return Seriously Overdue'
+                message = f"{item['chemical_name']} was due back on {item['expected_return_date']} and has been reported to the lab administrators"
+                for admin_id in admin_paths:
+                    notifications.append((admin_id, 'Overdue Borrow Escalated',
+                                          f"{item['full_name']} has not returned {item['quantity_requested']} {item['unit']} "
+                                          f"of {item['chemical_name']} (due {item['expected_return_date']})",
+                                          'overdue', 'request', item['id']))
+            notifications.append((item['student_id'], title, message, 'overdue', 'request', item['id']))
+        
+        _insert_notifications(conn, [row for row in notifications if admin_paths.get(row[0], path) == path])
+        cursor.executemany('UPDATE chemical_requests SET reminder_level = ? WHERE id = ?',
+                           [(item['level'], item['id']) for item in due])
+    return flagged, due, notifications
+
 def get_borrow_history(student_id=None):
     """Get complete borrow history"""
-    conn = get_db_connection()
     if student_id:
-        history = conn.execute('''
-            SELECT bh.*, 
-                   c.name as chemical_name, c.chemical_formula
-            FROM borrow_history bh
-            JOIN chemicals c ON bh.chemical_id = c.id
-            WHERE bh.student_id = ?
-            ORDER BY bh.borrow_date DESC
-        ''', (student_id,)).fetchall()
+        with read_connection(get_user_database(student_id)) as conn:
+            history = conn.execute('''
+                SELECT bh.*, 
+                       c.name as chemical_name, c.chemical_formula
+                FROM borrow_history bh
+                JOIN chemicals c ON bh.chemical_id = c.id
+                WHERE bh.student_id = ?
+                ORDER BY bh.borrow_date DESC
+            ''', (student_id,)).fetchall()
     else:
-        history = conn.execute('''
+        history = _fan_out('''
             SELECT bh.*, 
                    u.username, u.full_name, u.student_id as requester_student_id,
                    c.name as chemical_name, c.chemical_formula
@@ -687,68 +2509,395 @@ def get_borrow_history(student_id=None):
             JOIN users u ON bh.student_id = u.id
             JOIN chemicals c ON bh.chemical_id = c.id
             ORDER BY bh.borrow_date DESC
-        ''').fetchall()
-    conn.close()
+        ''', order_by='borrow_date', descending=True)
     return history
 
+def _add_consumption(conn, changes):
+    """Add (timestamp, chemical_id, department, unit, borrows, quantity, returns) changes to the daily and monthly rollups"""
+    for table, period_format in CONSUMPTION_ROLLUPS.items():
+        conn.executemany(f'''
+            INSERT INTO {table} (period, chemical_id, department, unit, borrows, quantity, returns)
+            VALUES (strftime('{period_format}', ?), ?, COALESCE(?, ''), ?, ?, ?, ?)
+            ON CONFLICT(period, chemical_id, department, unit) DO UPDATE SET
+                borrows = borrows + excluded.borrows,
+                quantity = quantity + excluded.quantity,
+                returns = returns + excluded.returns
+        ''', changes)
+
+def rebuild_consumption(conn, history_table='borrow_history'):
+    """Recompute the consumption rollups of one database file from its borrow history
+    
+    history_table may be a view such as archive's borrow_history_all. Runs on
+    an open connection and leaves committing to the caller. Departments are
+    the borrowers' current ones. Returns the number of daily rollup rows.
+    """
+    for table, period_format in CONSUMPTION_ROLLUPS.items():
+        conn.execute(f'DELETE FROM {table}')
+        conn.execute(f'''
+            INSERT INTO {table} (period, chemical_id, department, unit, borrows, quantity, returns)
+            SELECT strftime('{period_format}', bh.borrow_date), bh.chemical_id, COALESCE(u.department, ''), bh.unit,
+                   COUNT(*), SUM(bh.quantity_borrowed), 0
+            FROM {history_table} bh
+            LEFT JOIN users u ON bh.student_id = u.id
+            WHERE bh.borrow_date IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+        ''')
+        conn.execute(f'''
+            INSERT INTO {table} (period, chemical_id, department, unit, borrows, quantity, returns)
+            SELECT strftime('{period_format}', bh.actual_return_date), bh.chemical_id, COALESCE(u.department, ''),
+                   bh.unit, 0, 0, COUNT(*)
+            FROM {history_table} bh
+            LEFT JOIN users u ON bh.student_id = u.id
+            WHERE bh.actual_return_date IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT(period, chemical_id, department, unit) DO UPDATE SET returns = excluded.returns
+        ''')
+    return conn.execute('SELECT COUNT(*) FROM consumption_daily').fetchone()[0]
+
+def _consumption_segments(start, end, interval=None):
+    """Split a date range into (rollup table, first period, last period) pieces
+    
+    Whole calendar months are read from the monthly rollup and the days
+    before and after them from the daily one, so a query reads at most about
+    two months of daily rows however long the range is.
+    """
+    if interval == 'day':
+        return [('consumption_daily', start.isoformat(), end.isoformat())]
+    first_month = start if start.day == 1 else (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    last_month_end = end if (end + timedelta(days=1)).day == 1 else end.replace(day=1) - timedelta(days=1)
+    if first_month > last_month_end:
+        return [('consumption_daily', start.isoformat(), end.isoformat())]
+    segments = []
+    if start < first_month:
+        segments.append(('consumption_daily', start.isoformat(), (first_month - timedelta(days=1)).isoformat()))
+    segments.append(('consumption_monthly', first_month.strftime('%Y-%m'), last_month_end.strftime('%Y-%m')))
+    if last_month_end < end:
+        segments.append(('consumption_daily', (last_month_end + timedelta(days=1)).isoformat(), end.isoformat()))
+    return segments
+
+def get_consumption(start, end, chemical_id=None, department=None, unit=None, interval=None,
+                    group_by=('chemical', 'department')):
+    """Get borrow counts, quantities and returns between two dates (inclusive) from the rollups
+    
+    interval is None for totals over the range, 'month' or 'day'. group_by
+    picks 'chemical' and/or 'department'; quantities are always split by
+    unit. department '' selects borrowers without a department.
+    """
+    start, end = date.fromisoformat(str(start)), date.fromisoformat(str(end))
+    if start > end:
+        raise ValueError('start must not be after end')
+    if interval not in (None, 'day', 'month'):
+        raise ValueError(f'Unknown interval "{interval}"')
+    unknown = set(group_by) - {'chemical', 'department'}
+    if unknown:
+        raise ValueError(f'Cannot group by {", ".join(sorted(unknown))}')
+    
+    columns = ['chemical_id'] * ('chemical' in group_by) + ['department'] * ('department' in group_by) + ['unit']
+    conditions = ['period BETWEEN ? AND ?']
+    filters = []
+    for column, value in (('chemical_id', chemical_id), ('department', department), ('unit', unit)):
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            filters.append(value)
+    
+    totals = {}
+    for table, first, last in _consumption_segments(start, end, interval):
+        # Daily rows are labelled with their month when counting by month
+        period = 'substr(period, 1, 7)' if interval == 'month' and table == 'consumption_daily' else 'period'
+        keys = ([f'{period} AS period'] if interval else []) + columns
+        rows = _fan_out(f'''
+            SELECT {', '.join(keys)}, SUM(borrows) AS borrows, SUM(quantity) AS quantity, SUM(returns) AS returns
+            FROM {table}
+            WHERE {' AND '.join(conditions)}
+            GROUP BY {', '.join(str(i) for i in range(1, len(keys) + 1))}
+        ''', (first, last, *filters))
+        for row in rows:
+            key = tuple(row)[:len(keys)]
+            total = totals.setdefault(key, [0, 0.0, 0])
+            total[0] += row['borrows']
+            total[1] += row['quantity']
+            total[2] += row['returns']
+    
+    names = {}
+    if 'chemical' in group_by and totals:
+        ids = sorted({key[1 if interval else 0] for key in totals})
+        with read_connection() as conn:
+            for offset in range(0, len(ids), 500):
+                chunk = ids[offset:offset + 500]
+                rows = conn.execute(f'''
+                    SELECT id, name FROM chemicals WHERE id IN ({', '.join('?' * len(chunk))})
+                ''', chunk).fetchall()
+                names.update((row['id'], row['name']) for row in rows)
+    
+    results = []
+    for key, (borrows, quantity, returns) in totals.items():
+        item = dict(zip((['period'] if interval else []) + columns, key))
+        if 'chemical_id' in item:
+            item['chemical_name'] = names.get(item['chemical_id'])
+        if 'department' in item:
+            item['department'] = item['department'] or None
+        item.update(borrows=borrows, quantity=round(quantity, 6), returns=returns)
+        results.append(item)
+    results.sort(key=lambda item: (item.get('period', ''), item.get('chemical_name') or '',
+                                   item.get('department') or '', item['unit']))
+    return results
+
+def save_reorder_suggestions(rows):
+    """Replace all reorder suggestions with rows in the column order of reorder_suggestions"""
+    with write_connection() as conn:
+        conn.execute('DELETE FROM reorder_suggestions')
+        conn.executemany('''
+            INSERT INTO reorder_suggestions
+            (chemical_id, unit, available, daily_demand, seasonal_factor, safety_stock, reorder_point,
+             order_quantity, days_of_stock)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+def get_reorder_suggestions(limit=None):
+    """Get chemicals at or below their reorder point, those running out soonest first"""
+    with read_connection() as conn:
+        suggestions = conn.execute('''
+            SELECT r.*, c.name, c.cas_number, c.supplier
+            FROM reorder_suggestions r
+            JOIN chemicals c ON r.chemical_id = c.id
+            WHERE r.order_quantity > 0
+            ORDER BY r.days_of_stock, c.name
+            LIMIT ?
+        ''', (limit if limit is not None else -1,)).fetchall()
+    return suggestions
+
+def get_valuation_groups(expiry_buckets):
+    """Get lot counts and stock value from the value totals, grouped for each report dimension
+    
+    Returns {'location': rows, 'chemical': rows per hazard category and
+    supplier, 'expiry': rows per expiry bucket}. expiry_buckets is a list of
+    (bucket, date) pairs in date order: a lot falls in the first bucket whose
+    date its expiry date is before, else in 'later', or 'none' without one.
+    """
+    cases = ' '.join('WHEN t.expiry_date < ? THEN ?' for _ in expiry_buckets)
+    params = [value for bucket, before in expiry_buckets for value in (str(before), bucket)]
+    with read_connection() as conn:
+        groups = {
+            'location': conn.execute('''
+                SELECT NULLIF(t.storage_location_id, 0) as storage_location_id, s.location_name,
+                       t.lots, t.costed_lots, t.value
+                FROM inventory_value_by_location t
+                LEFT JOIN storage_locations s ON t.storage_location_id = s.id
+            ''').fetchall(),
+            'chemical': conn.execute('''
+                SELECT c.hazard_category_id, h.name as hazard_name, c.supplier,
+                       SUM(t.lots) as lots, SUM(t.costed_lots) as costed_lots, SUM(t.value) as value
+                FROM inventory_value_by_chemical t
+                JOIN chemicals c ON t.chemical_id = c.id
+                LEFT JOIN hazard_categories h ON c.hazard_category_id = h.id
+                GROUP BY c.hazard_category_id, c.supplier
+            ''').fetchall(),
+            'expiry': conn.execute(f'''
+                SELECT CASE WHEN t.expiry_date = '' THEN 'none' {cases} ELSE 'later' END as expiry_bucket,
+                       SUM(t.lots) as lots, SUM(t.costed_lots) as costed_lots, SUM(t.value) as value
+                FROM inventory_value_by_expiry t
+                GROUP BY 1
+            ''', params).fetchall()
+        }
+    return groups
+
+def get_borrow_cost_groups(start=None, end=None):
+    """Get borrow counts and cost per department, borrowed unit and lot unit from every database file
+    
+    Cost is the quantity borrowed times the cost of the lot it was taken
+    from, before converting between the two units. start and end bound the
+    borrow date (end exclusive).
+    """
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('bh.borrow_date >= ?')
+        params.append(str(start))
+    if end is not None:
+        conditions.append('bh.borrow_date < ?')
+        params.append(str(end))
+    return _fan_out(f'''
+        SELECT u.department, bh.unit as borrow_unit, i.unit as lot_unit, COUNT(*) as borrows,
+               COUNT(i.cost) as costed_borrows, SUM(bh.quantity_borrowed * i.cost) as cost
+        FROM borrow_history bh
+        LEFT JOIN inventory i ON bh.inventory_id = i.id
+        LEFT JOIN users u ON bh.student_id = u.id
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        GROUP BY 1, 2, 3
+    ''', params)
+
+def get_borrow_history_stamps():
+    """Get the lowest and highest borrow_history ID in every database file
+    
+    Borrows only add rows and archiving removes the oldest, so the stamps
+    change whenever the set of borrows does.
+    """
+    return tuple(tuple(row) for row in _fan_out('SELECT MIN(id), MAX(id) FROM borrow_history'))
+
 def get_available_quantity(chemical_id):
     """Get available quantity for a chemical (total - borrowed)"""
-    conn = get_db_connection()
-    result = conn.execute('''
-        SELECT 
-            COALESCE(SUM(i.quantity), 0) as total_quantity,
-            COALESCE(SUM(CASE WHEN r.status = 'borrowed' THEN r.quantity_requested ELSE 0 END), 0) as borrowed_quantity
-        FROM inventory i
-        LEFT JOIN chemical_requests r ON i.chemical_id = r.chemical_id
-        WHERE i.chemical_id = ?
-    ''', (chemical_id,)).fetchone()
-    conn.close()
-    return result
+    with read_connection() as conn:
+        total = conn.execute(
+            'SELECT COALESCE(SUM(quantity), 0) FROM inventory WHERE chemical_id = ?', (chemical_id,)
+        ).fetchone()[0]
+    borrowed = _fan_out('''
+        SELECT COALESCE(SUM(quantity_requested), 0) FROM chemical_requests
+        WHERE chemical_id = ? AND status = 'borrowed'
+    ''', (chemical_id,))
+    return {'total_quantity': total, 'borrowed_quantity': sum(row[0] for row in borrowed)}
 
 # Notification functions
 def create_notification(user_id, title, message, notification_type, related_entity_type=None, related_entity_id=None):
     """Create a notification for a user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO notifications (user_id, title, message, type, related_entity_type, related_entity_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, title, message, notification_type, related_entity_type, related_entity_id))
-    notification_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with write_connection(get_user_database(user_id)) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO notifications (user_id, title, message, type, related_entity_type, related_entity_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, title, message, notification_type, related_entity_type, related_entity_id))
+        notification_id = cursor.lastrowid
     return notification_id
 
+def _insert_notifications(conn, notifications, dedupe_key=None):
+    """Insert (user_id, title, message, type, entity_type, entity_id) rows in one batch
+    
+    With a dedupe_key, each user gets at most one notification under that key,
+    so inserting the same rows again adds nothing. Returns the rows inserted.
+    """
+    return conn.executemany('''
+        INSERT INTO notifications
+        (user_id, title, message, type, related_entity_type, related_entity_id, dedupe_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (dedupe_key) WHERE dedupe_key IS NOT NULL DO NOTHING
+    ''', [(*row, f'{dedupe_key}:{row[0]}' if dedupe_key else None) for row in notifications]).rowcount
+
+def create_notifications(notifications, dedupe_key=None):
+    """Create several notifications with one batched insert per shard, returning how many were new"""
+    created = 0
+    for path, rows in _group_by_user_database(notifications).items():
+        with write_connection(path) as conn:
+            created += _insert_notifications(conn, rows, dedupe_key)
+    return created
+
 def get_user_notifications(user_id, unread_only=False):
     """Get notifications for a user"""
-    conn = get_db_connection()
-    if unread_only:
-        notifications = conn.execute('''
-            SELECT * FROM notifications 
-            WHERE user_id = ? AND is_read = 0 
-            ORDER BY created_at DESC
-        ''', (user_id,)).fetchall()
-    else:
-        notifications = conn.execute('''
-            SELECT * FROM notifications 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC
-        ''', (user_id,)).fetchall()
-    conn.close()
+    with read_connection(get_user_database(user_id)) as conn:
+        if unread_only:
+            notifications = conn.execute('''
+                SELECT * FROM notifications 
+                WHERE user_id = ? AND is_read = 0 
+                ORDER BY created_at DESC
+            ''', (user_id,)).fetchall()
+        else:
+            notifications = conn.execute('''
+                SELECT * FROM notifications 
+                WHERE user_id = ? 
+                ORDER BY created_at DESC
+            ''', (user_id,)).fetchall()
     return notifications
 
 def mark_notification_as_read(notification_id):
     """Mark a notification as read"""
-    conn = get_db_connection()
-    conn.execute('UPDATE notifications SET is_read = 1 WHERE id = ?', (notification_id,))
-    conn.commit()
-    conn.close()
+    with write_connection(get_record_database(notification_id)) as conn:
+        conn.execute('UPDATE notifications SET is_read = 1 WHERE id = ?', (notification_id,))
+
+def get_notified_users(since):
+    """Get the users with notifications newer than since, with the newest IDs
+    
+    since maps each database file to the highest notification ID already
+    seen; files not in it are only read for their highest ID. Returns (user
+    IDs, {path: highest ID}) for the next call.
+    """
+    users = set()
+    latest = {}
+    for path in get_database_paths():
+        with read_connection(path) as conn:
+            if path not in since:
+                latest[path] = conn.execute('SELECT COALESCE(MAX(id), 0) FROM notifications').fetchone()[0]
+                continue
+            rows = conn.execute('''
+                SELECT user_id, MAX(id) AS last_id FROM notifications WHERE id > ? GROUP BY user_id
+            ''', (since[path],)).fetchall()
+        users.update(row['user_id'] for row in rows)
+        latest[path] = max([since[path]] + [row['last_id'] for row in rows])
+    return users, latest
 
 def get_unread_count(user_id):
     """Get count of unread notifications"""
-    conn = get_db_connection()
-    result = conn.execute('''
-        SELECT COUNT(*) as count FROM notifications WHERE user_id = ? AND is_read = 0
-    ''', (user_id,)).fetchone()
-    conn.close()
+    with read_connection(get_user_database(user_id)) as conn:
+        result = conn.execute('''
+            SELECT COUNT(*) as count FROM notifications WHERE user_id = ? AND is_read = 0
+        ''', (user_id,)).fetchone()
     return result['count'] if result else 0
+
+# Activity log functions
+def insert_activity_log(events):
+    """Insert (user_id, action, entity_type, entity_id, description, timestamp) rows in one batch"""
+    with write_connection() as conn:
+        conn.executemany('''
+            INSERT INTO activity_log (user_id, action, entity_type, entity_id, description, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', events)
+
+def record_job_run(stats, host=None):
+    """Add a scheduled job run, given the job's stats() after it, to the job_runs totals"""
+    with write_connection() as conn:
+        conn.execute('''
+            INSERT INTO job_runs (name, interval_seconds, runs, failures, last_run_at, last_duration_ms,
+                                  last_result, last_error, last_host)
+            VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                interval_seconds = excluded.interval_seconds, runs = runs + 1, failures = failures + excluded.failures,
+                last_run_at = excluded.last_run_at, last_duration_ms = excluded.last_duration_ms,
+                last_result = excluded.last_result, last_error = excluded.last_error, last_host = excluded.last_host
+        ''', (stats['name'], stats['interval_seconds'], 1 if stats['last_error'] else 0, stats['last_run_at'],
+              stats['last_duration_ms'], json.dumps(stats['last_result'], default=str), stats['last_error'], host))
+
+def get_job_runs():
+    """Get the run counts and last run of every scheduled job, from whichever process ran it"""
+    with read_connection() as conn:
+        rows = conn.execute('SELECT * FROM job_runs ORDER BY name').fetchall()
+    runs = []
+    for row in rows:
+        run = dict(row)
+        run['last_result'] = json.loads(run['last_result']) if run['last_result'] else None
+        runs.append(run)
+    return runs
+
+def activity_log_query(user_id=None, entity_type=None, entity_id=None, since=None, until=None, limit=100,
+                       table='activity_log'):
+    """Build the SQL and parameters of an activity log query on table (or archive's activity_log_all), newest first"""
+    conditions = []
+    params = []
+    if user_id is not None:
+        conditions.append('a.user_id = ?')
+        params.append(user_id)
+    if entity_type is not None:
+        conditions.append('a.entity_type = ?')
+        params.append(entity_type)
+    if entity_id is not None:
+        conditions.append('a.entity_id = ?')
+        params.append(entity_id)
+    if since is not None:
+        conditions.append('a.timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('a.timestamp < ?')
+        params.append(until)
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    sql = f'''
+        SELECT a.*, u.username
+        FROM {table} a
+        LEFT JOIN users u ON a.user_id = u.id
+        {where}
+        ORDER BY a.timestamp DESC, a.id DESC
+        LIMIT ?
+    '''
+    return sql, (*params, limit)
+
+def get_activity_log(user_id=None, entity_type=None, entity_id=None, since=None, until=None, limit=100):
+    """Get activity log entries filtered by user, entity and time range, newest first"""
+    sql, params = activity_log_query(user_id, entity_type, entity_id, since, until, limit)
+    with read_connection() as conn:
+        entries = conn.execute(sql, params).fetchall()
+    return entries
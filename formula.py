@@ -0,0 +1,151 @@
+"""
+Chemical formula parsing for the Chemical Management System
+
+Turns a formula string into its elemental composition and formula weight:
+
+    parse('CuSO4·5H2O')        -> {'Cu': 1, 'S': 1, 'O': 9, 'H': 10}
+    parse('[Cu(NH3)4]2+')      -> {'Cu': 1, 'N': 4, 'H': 12}
+    weight(parse('C2H5OH'))    -> 46.069
+
+Groups may use (), [] or {} with a multiplier, hydrates and adducts are
+joined with a dot (·, •, . or *) and may start with a coefficient, and a
+trailing charge (2+, ^3-, -) is ignored. Dashes and bond symbols inside
+condensed formulas (CH3-CH2-OH) are ignored too.
+"""
+
+import re
+
+# Standard atomic weights (IUPAC conventional values); elements without
+# stable isotopes use the mass number of their longest-lived isotope.
+# D is deuterium, which catalogues write as its own symbol.
+ATOMIC_WEIGHTS = {
+    'H': 1.008, 'D': 2.014, 'He': 4.0026, 'Li': 6.94, 'Be': 9.0122, 'B': 10.81,
+    'C': 12.011, 'N': 14.007, 'O': 15.999, 'F': 18.998, 'Ne': 20.180,
+    'Na': 22.990, 'Mg': 24.305, 'Al': 26.982, 'Si': 28.085, 'P': 30.974,
+    'S': 32.06, 'Cl': 35.45, 'Ar': 39.948, 'K': 39.098, 'Ca': 40.078,
+    'Sc': 44.956, 'Ti': 47.867, 'V': 50.942, 'Cr': 51.996, 'Mn': 54.938,
+    'Fe': 55.845, 'Co': 58.933, 'Ni': 58.693, 'Cu': 63.546, 'Zn': 65.38,
+    'Ga': 69.723, 'Ge': 72.630, 'As': 74.922, 'Se': 78.971, 'Br': 79.904,
+    'Kr': 83.798, 'Rb': 85.468, 'Sr': 87.62, 'Y': 88.906, 'Zr': 91.224,
+    'Nb': 92.906, 'Mo': 95.95, 'Tc': 98, 'Ru': 101.07, 'Rh': 102.91,
+    'Pd': 106.42, 'Ag': 107.87, 'Cd': 112.41, 'In': 114.82, 'Sn': 118.71,
+    'Sb': 121.76, 'Te': 127.60, 'I': 126.90, 'Xe': 131.29, 'Cs': 132.91,
+    'Ba': 137.33, 'La': 138.91, 'Ce': 140.12, 'Pr': 140.91, 'Nd': 144.24,
+    'Pm': 145, 'Sm': 150.36, 'Eu': 151.96, 'Gd': 157.25, 'Tb': 158.93,
+    'Dy': 162.50, 'Ho': 164.93, 'Er': 167.26, 'Tm': 168.93, 'Yb': 173.05,
+    'Lu': 174.97, 'Hf': 178.49, 'Ta': 180.95, 'W': 183.84, 'Re': 186.21,
+    'Os': 190.23, 'Ir': 192.22, 'Pt': 195.08, 'Au': 196.97, 'Hg': 200.59,
+    'Tl': 204.38, 'Pb': 207.2, 'Bi': 208.98, 'Po': 209, 'At': 210,
+    'Rn': 222, 'Fr': 223, 'Ra': 226, 'Ac': 227, 'Th': 232.04, 'Pa': 231.04,
+    'U': 238.03, 'Np': 237, 'Pu': 244, 'Am': 243, 'Cm': 247, 'Bk': 247,
+    'Cf': 251, 'Es': 252, 'Fm': 257, 'Md': 258, 'No': 259, 'Lr': 262,
+    'Rf': 267, 'Db': 270, 'Sg': 269, 'Bh': 270, 'Hs': 270, 'Mt': 278,
+    'Ds': 281, 'Rg': 281, 'Cn': 285, 'Nh': 286, 'Fl': 289, 'Mc': 289,
+    'Lv': 293, 'Ts': 293, 'Og': 294
+}
+
+_OPEN = {'(': ')', '[': ']', '{': '}'}
+# Hydrate and adduct separators; a dot after a lone 0 is a decimal point (0.5H2O)
+_DOTS = re.compile(r'\s*(?:[·•*]|(?<!(?<!\d)0)\.)\s*(?=[\d.]*\s*[A-Z(\[{])')
+# A trailing charge: SO4^2-, [Fe(CN)6]3-, NH4+, Fe3+
+_CHARGE = re.compile(r'(\^\{?|\s+)?(\d*)([+\-])\}?$')
+_ELEMENT = re.compile(r'[A-Z][a-z]?')
+_TOKEN = re.compile(r'([A-Z][a-z]?)|(\d+(?:\.\d+)?)|([(\[{])|([)\]}])|([\s\-=≡]+)')
+
+
+class FormulaError(ValueError):
+    """Raised when a formula cannot be parsed"""
+
+
+def _parse_part(text, formula):
+    """Parse one dot-separated part, returning its composition"""
+    stack = [{}]
+    closers = []
+    # Elements and closing brackets take the count that follows them
+    last = None
+    position = 0
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise FormulaError(f'Unexpected "{text[position]}" in formula "{formula}"')
+        position = match.end()
+        element, number, opening, closing, _ = match.groups()
+        if element:
+            if element not in ATOMIC_WEIGHTS:
+                raise FormulaError(f'Unknown element "{element}" in formula "{formula}"')
+            stack[-1][element] = stack[-1].get(element, 0) + 1
+            last = ('element', element)
+        elif number:
+            if last is None:
+                raise FormulaError(f'Misplaced count "{number}" in formula "{formula}"')
+            count = float(number)
+            if last[0] == 'element':
+                stack[-1][last[1]] += count - 1
+            else:
+                for element, group_count in last[1].items():
+                    stack[-1][element] += group_count * (count - 1)
+            last = None
+        elif opening:
+            stack.append({})
+            closers.append(_OPEN[opening])
+            last = None
+        elif closing:
+            if not closers or closers.pop() != closing:
+                raise FormulaError(f'Unbalanced "{closing}" in formula "{formula}"')
+            group = stack.pop()
+            for element, count in group.items():
+                stack[-1][element] = stack[-1].get(element, 0) + count
+            last = ('group', group)
+        else:
+            last = None
+    if closers:
+        raise FormulaError(f'Unclosed bracket in formula "{formula}"')
+    return stack[0]
+
+
+def _strip_charge(text):
+    """Remove a trailing charge, keeping digits that are really a count (NH4+)"""
+    match = _CHARGE.search(text)
+    if match is None:
+        return text
+    body = text[:match.start()]
+    # Digits are the charge after ^, a space or a bracket, or on a single
+    # element ion (Fe3+); otherwise they are the last element's count
+    if match.group(1) or body.endswith((')', ']', '}')) or _ELEMENT.fullmatch(body):
+        return body
+    return body + match.group(2)
+
+
+def parse(formula):
+    """Parse a formula into {element: count}"""
+    text = _strip_charge(str(formula or '').strip()).strip()
+    if not text:
+        raise FormulaError('Formula is empty')
+    composition = {}
+    for part in _DOTS.split(text):
+        coefficient = re.match(r'\d+(?:\.\d+)?', part)
+        multiplier = 1.0
+        if coefficient:
+            multiplier = float(coefficient.group())
+            part = part[coefficient.end():]
+        for element, count in _parse_part(part, formula).items():
+            composition[element] = composition.get(element, 0) + count * multiplier
+    composition = {element: count for element, count in composition.items() if count}
+    if not composition:
+        raise FormulaError(f'No elements in formula "{formula}"')
+    return {element: int(count) if count == int(count) else count for element, count in composition.items()}
+
+
+def weight(composition):
+    """Get the formula weight (g/mol) of a composition"""
+    return round(sum(ATOMIC_WEIGHTS[element] * count for element, count in composition.items()), 3)
+
+
+def element_symbols(text):
+    """Split a list like "cl, Na" into element symbols, keeping unknown ones as typed"""
+    symbols = []
+    for item in re.split(r'[\s,;]+', str(text or '')):
+        if item:
+            symbol = item.capitalize()
+            symbols.append(symbol if symbol in ATOMIC_WEIGHTS else item)
+    return symbols
@@ -0,0 +1,116 @@
+"""
+Fragment caching for expensive template blocks
+
+Templates wrap a block in a call to cached_fragment() with a name and the
+version stamps it depends on:
+
+    {% call cached_fragment('chemical-detail', chemical.id, versions) %}
+        ...
+    {% endcall %}
+
+The block is rendered once per distinct (name, parts) key and kept in a
+bounded in-process LRU. database.py bumps the version stamps inside the write
+that changes the data, so a new version simply misses the cache and stale
+fragments age out. Pass rows as Lazy() so a cache hit skips the query too.
+"""
+
+import threading
+from collections import OrderedDict
+from jinja2 import FileSystemBytecodeCache
+
+MAX_ENTRIES = 512
+MAX_BYTES = 64 * 1024 * 1024
+
+
+class Lazy:
+    """Sequence that runs its loader only when a template first uses it"""
+
+    def __init__(self, loader, *args):
+        self._loader = loader
+        self._args = args
+        self._rows = None
+
+    def _load(self):
+        if self._rows is None:
+            self._rows = self._loader(*self._args)
+        return self._rows
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __bool__(self):
+        return bool(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+
+class FragmentCache:
+    """Bounded LRU of rendered fragments"""
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, name, *parts, caller):
+        """Return the cached fragment for (name, parts), rendering the call block on a miss"""
+        key = (name,) + parts
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+        fragment = caller()
+        self._store(key, fragment)
+        return fragment
+
+    def _store(self, key, fragment):
+        size = len(fragment)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= len(previous)
+            self._entries[key] = fragment
+            self.size_bytes += size
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+
+    def clear(self):
+        """Drop every cached fragment"""
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        """Get entry count, size and hit rate"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size_mb': round(self.size_bytes / (1024 * 1024), 3),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+cache = FragmentCache()
+
+
+def init_app(app):
+    """Expose cached_fragment to templates and cache compiled template bytecode"""
+    app.jinja_env.globals['cached_fragment'] = cache.render
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
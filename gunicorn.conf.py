@@ -0,0 +1,36 @@
+"""
+gunicorn settings for the Chemical Management System
+
+    SECRET_KEY=... gunicorn -c gunicorn.conf.py wsgi:app
+    python jobs.py    # background jobs, in one process per site
+
+WEB_CONCURRENCY sets the number of worker processes (default: one per CPU) and
+WEB_THREADS the request threads in each (default 4). Send HUP to the master
+to replace the workers gracefully; since the app is preloaded, deploying new
+code takes USR2 (start a new master) followed by TERM to the old one.
+"""
+
+import os
+from config import THREADS, WORKERS
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = WORKERS
+threads = THREADS
+worker_class = 'gthread'
+# Import the app and build its name indexes once in the master; workers get
+# them copy-on-write when they fork instead of each building their own
+preload_app = True
+# Time given to requests in flight when workers stop on HUP, USR2 or TERM
+graceful_timeout = 30
+timeout = 60
+keepalive = 5
+# Restart workers now and then so their caches and heap stay bounded
+max_requests = 10000
+max_requests_jitter = 1000
+accesslog = '-'
+
+
+def pre_fork(server, worker):
+    """Close the master's SQLite connections, which a forked worker must not inherit"""
+    import database as db
+    db.close_connections()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Bulk chemical import for the Chemical Management System
+
+Reads a CSV file with a header row. The only required column is name. The
+optional columns are chemical_formula, cas_number, molecular_weight,
+description, supplier, hazard_category (a category name) and synonyms
+(comma-separated).
+
+    python import_chemicals.py catalogue.csv            # import valid rows
+    python import_chemicals.py catalogue.csv --dry-run  # only report problems
+
+CAS numbers are validated and normalized as the file is read. A row is
+skipped when its CAS number is invalid, repeats an earlier row, or is already
+in the catalogue, and when its name or a synonym is close to a chemical in
+the catalogue or earlier in the file with the same composition (pass
+--allow-similar to import those). Close names whose formulas cannot be
+compared are imported and listed as possible duplicates.
+The file is committed in batches, so a large import does not hold the write
+lock for long.
+"""
+
+import argparse
+import csv
+import cas
+import database as db
+import similarity
+
+BATCH_SIZE = 5000
+# Problems listed in the report; the rest are only counted
+MAX_REPORTED = 50
+
+
+def _batches(reader, size):
+    batch = []
+    for row in reader:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_file(path, dry_run=False, batch_size=BATCH_SIZE, allow_similar=False):
+    """Validate and import a CSV file, returning counts and the problems found"""
+    hazards = {hazard['name'].casefold(): hazard['id'] for hazard in db.get_all_hazard_categories()}
+    seen = {}
+    problems = []
+    counts = {'rows': 0, 'added': 0, 'invalid': 0, 'duplicate': 0, 'registered': 0, 'similar': 0, 'flagged': 0}
+    # Names from the catalogue plus rows accepted so far, which are indexed
+    # under minus their line number
+    names = similarity.NameIndex()
+    if not allow_similar:
+        names.build(db.get_catalogue_names()[1])
+
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        start = 0
+        for batch in _batches(reader, batch_size):
+            keys, errors, duplicates = cas.validate_many([row.get('cas_number') for row in batch], seen, start)
+            # Header is line 1, so the row at index i is on line i + 2
+            problems.extend((index + 2, message) for index, message in errors)
+            problems.extend((index + 2, f'CAS number repeats line {first + 2}') for index, first in duplicates)
+            registered = db.get_registered_cas_keys(key for key in keys if key is not None)
+
+            rows = []
+            for index, (row, key) in enumerate(zip(batch, keys), start):
+                if key is None and (row.get('cas_number') or '').strip():
+                    continue
+                if key in registered:
+                    counts['registered'] += 1
+                    problems.append((index + 2, f'CAS number {cas.format_key(key)} is already in the catalogue'))
+                    continue
+                name = (row.get('name') or '').strip()
+                if not name:
+                    counts['invalid'] += 1
+                    problems.append((index + 2, 'name is required'))
+                    continue
+                try:
+                    molecular_weight = float(row['molecular_weight']) if row.get('molecular_weight') else None
+                except ValueError:
+                    counts['invalid'] += 1
+                    problems.append((index + 2, f"molecular weight \"{row['molecular_weight']}\" is not a number"))
+                    continue
+                synonyms = [synonym.strip() for synonym in (row.get('synonyms') or '').split(',') if synonym.strip()]
+                if not allow_similar:
+                    matches = names.similar([name] + synonyms, chemical_formula=row.get('chemical_formula'))
+                    if matches:
+                        # Skip certain duplicates; only flag names the formulas cannot confirm
+                        confirmed = [match for match in matches if match['same_composition']]
+                        match = (confirmed or matches)[0]
+                        where = f"line {-match['id']}" if match['id'] < 0 else f"#{match['id']}"
+                        message = f"{name} is similar to {match['name']} ({where}, {match['score']:.0%})"
+                        if confirmed:
+                            counts['similar'] += 1
+                            problems.append((index + 2, message))
+                            continue
+                        counts['flagged'] += 1
+                        problems.append((index + 2, message + ', imported'))
+                    names.update(-(index + 2), {'id': -(index + 2), 'name': name,
+                                                'chemical_formula': row.get('chemical_formula')}, synonyms)
+                hazard = (row.get('hazard_category') or '').strip()
+                rows.append({
+                    'name': name,
+                    'chemical_formula': row.get('chemical_formula') or None,
+                    'cas_number': cas.format_key(key) if key is not None else None,
+                    'cas_key': key,
+                    'molecular_weight': molecular_weight,
+                    'description': row.get('description') or None,
+                    'supplier': row.get('supplier') or None,
+                    'hazard_category_id': hazards.get(hazard.casefold()) if hazard else None,
+                    'synonyms': synonyms
+                })
+
+            counts['rows'] += len(batch)
+            counts['invalid'] += len(errors)
+            counts['duplicate'] += len(duplicates)
+            if not dry_run and rows:
+                counts['added'] += db.import_chemicals(rows)
+            start += len(batch)
+
+    problems.sort()
+    return counts, problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import chemicals from a CSV file')
+    parser.add_argument('path', help='CSV file with a header row')
+    parser.add_argument('--dry-run', action='store_true', help='validate the file without importing it')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows committed per transaction')
+    parser.add_argument('--allow-similar', action='store_true', help='import rows whose names are close to existing ones')
+    args = parser.parse_args()
+
+    counts, problems = import_file(args.path, args.dry_run, args.batch_size, args.allow_similar)
+    for line, message in problems[:MAX_REPORTED]:
+        print(f'line {line}: {message}')
+    if len(problems) > MAX_REPORTED:
+        print(f'... and {len(problems) - MAX_REPORTED} more')
+    print(f"{counts['rows']} rows: {counts['added']} added, {counts['invalid']} invalid, "
+          f"{counts['duplicate']} repeated in the file, {counts['registered']} already in the catalogue, "
+          f"{counts['similar']} similar to an existing name, {counts['flagged']} imported but flagged as similar")
@@ -4,7 +4,7 @@ Database initialization script for the Chemical Management System
 Run this script to create and initialize the database with sample users
 """
 
-from database import init_database, create_user, get_user_by_username
+from database import migrate, create_user, get_user_by_username
 from werkzeug.security import generate_password_hash
 
 def add_sample_users():
@@ -87,8 +87,8 @@ if __name__ == '__main__':
     print("="*60)
     print("Initializing Chemical Management System Database")
     print("="*60)
-    init_database()
-    print("✓ Database tables created successfully!")
+    result = migrate()
+    print(f"✓ Database schema at version {result['version']}")
     
     add_sample_users()
     
@@ -9,8 +9,8 @@ import database as db
 def init_default_users():
     """Create default admin and sample student accounts"""
     
-    # Ensure database is initialized
-    db.init_database()
+    # Create the database or bring its schema up to date
+    db.migrate()
     
     print("\n" + "="*60)
     print("Initializing Default Users")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Background jobs for the Chemical Management System
+
+Run inside the web process (started by app.py) or as a separate process:
+
+    python jobs.py            # run the scheduler in the foreground
+    python jobs.py expiry     # run a single job once and exit
+"""
+
+import os
+import socket
+import sys
+import time
+import database as db
+import archive
+import backup
+import reorder
+import ratelimit
+import taskqueue
+from scheduler import Scheduler
+
+# Items expiring within this many days are reported as "expiring soon"
+EXPIRY_WARNING_DAYS = 30
+EXPIRY_SCAN_INTERVAL = 60 * 60
+
+# Students are reminded this many days before a borrow is due, and admins are
+# alerted once it is this many days overdue
+DUE_SOON_DAYS = 2
+OVERDUE_ESCALATION_DAYS = 7
+OVERDUE_SWEEP_INTERVAL = 60 * 60
+
+ARCHIVE_INTERVAL = 24 * 60 * 60
+DUPLICATE_SCAN_INTERVAL = 24 * 60 * 60
+BACKUP_INTERVAL = 24 * 60 * 60
+REORDER_INTERVAL = 24 * 60 * 60
+RATE_LIMIT_PRUNE_INTERVAL = 60 * 60
+TASK_PRUNE_INTERVAL = 24 * 60 * 60
+
+
+def record_run(stats):
+    """Record a job run in the job_runs table, where the web processes read it"""
+    db.record_job_run(stats, f'{socket.gethostname()}:{os.getpid()}')
+
+
+scheduler = Scheduler(on_run=record_run)
+
+
+def scan_expiring_inventory(days=EXPIRY_WARNING_DAYS):
+    """Notify admins about inventory that has expired or will expire within days"""
+    items = db.get_unalerted_expiring_inventory(days)
+    if not items:
+        return {'items': 0, 'notifications': 0}
+    notifications = db.record_expiry_alerts(items, db.get_admin_ids())
+    return {
+        'items': len(items),
+        'expired': sum(1 for item in items if item['alert_type'] == 'expired'),
+        'expiring': sum(1 for item in items if item['alert_type'] == 'expiring'),
+        'notifications': notifications
+    }
+
+
+def sweep_overdue_borrows(due_soon_days=DUE_SOON_DAYS, escalate_after_days=OVERDUE_ESCALATION_DAYS):
+    """Flag overdue borrows and send escalating reminders"""
+    return db.sweep_overdue_borrows(due_soon_days, escalate_after_days, db.get_admin_ids())
+
+
+def archive_history():
+    """Move closed history records past the retention cutoff into yearly archives"""
+    return archive.archive_history()
+
+
+def find_duplicate_chemicals():
+    """Cluster the catalogue into groups of chemicals with near-duplicate names"""
+    return db.find_duplicate_groups()
+
+
+def forecast_reorders():
+    """Forecast demand and recompute reorder points for the whole catalogue"""
+    return reorder.compute_reorder_suggestions()
+
+
+def snapshot_database():
+    """Take a verified snapshot of the database and prune old ones"""
+    return backup.snapshot()
+
+
+def prune_rate_limits():
+    """Drop rate limit buckets that have been idle long enough to be full"""
+    return ratelimit.limiter.prune()
+
+
+def prune_tasks():
+    """Delete finished background tasks past their retention"""
+    return taskqueue.prune()
+
+
+def register_jobs(target=scheduler):
+    """Register the default jobs on a scheduler"""
+    target.add_job('expiry', scan_expiring_inventory, EXPIRY_SCAN_INTERVAL)
+    target.add_job('overdue', sweep_overdue_borrows, OVERDUE_SWEEP_INTERVAL)
+    target.add_job('archive', archive_history, ARCHIVE_INTERVAL, run_at_start=False)
+    target.add_job('backup', snapshot_database, BACKUP_INTERVAL, run_at_start=False)
+    target.add_job('duplicates', find_duplicate_chemicals, DUPLICATE_SCAN_INTERVAL, run_at_start=False)
+    target.add_job('reorder', forecast_reorders, REORDER_INTERVAL, run_at_start=False)
+    target.add_job('rate-limits', prune_rate_limits, RATE_LIMIT_PRUNE_INTERVAL, run_at_start=False)
+    target.add_job('tasks', prune_tasks, TASK_PRUNE_INTERVAL, run_at_start=False)
+    return target
+
+
+def job_names():
+    """Get the names of the default jobs, registered or not"""
+    return list(register_jobs(Scheduler()).jobs)
+
+
+def start_scheduler():
+    """Register the default jobs and start the in-process scheduler"""
+    if not scheduler.jobs:
+        register_jobs(scheduler)
+    scheduler.start()
+    return scheduler
+
+
+if __name__ == '__main__':
+    register_jobs(scheduler)
+    if len(sys.argv) > 1:
+        for name in sys.argv[1:]:
+            print(scheduler.run_job(name))
+    else:
+        print("Running background jobs. Press Ctrl+C to stop.")
+        scheduler.start()
+        try:
+            while scheduler.is_running():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            scheduler.stop()
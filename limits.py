@@ -0,0 +1,63 @@
+"""
+Regulatory quantity limits for the Chemical Management System
+
+Fire codes cap the total quantity of a hazard class per building or per room.
+Quantities are normalised to litres (liquids) or kilograms (solids) so totals
+can be kept per (building, room, hazard category, unit) and checked without
+re-summing the inventory.
+"""
+
+# Base unit and factor for each unit accepted on inventory items
+UNIT_CONVERSIONS = {
+    'l': ('L', 1.0),
+    'ml': ('L', 0.001),
+    'kg': ('kg', 1.0),
+    'g': ('kg', 0.001),
+    'mg': ('kg', 0.000001),
+}
+
+# Room value used for limits and totals that apply to a whole building
+BUILDING_WIDE = ''
+
+
+class QuantityLimitError(ValueError):
+    """Raised when a receipt would push a control area over its limit"""
+
+
+def normalize_quantity(quantity, unit):
+    """Convert a quantity to its base unit, returning (quantity, base_unit)"""
+    if quantity is None or not unit:
+        return None, None
+    conversion = UNIT_CONVERSIONS.get(unit.strip().lower())
+    if not conversion:
+        return None, None
+    base_unit, factor = conversion
+    return float(quantity) * factor, base_unit
+
+
+def find_exceeded(limits, room_total, building_total, added):
+    """Return the limits that would be exceeded after adding a quantity"""
+    exceeded = []
+    for limit in limits:
+        current = building_total if limit['room'] == BUILDING_WIDE else room_total
+        if current + added > limit['max_quantity']:
+            exceeded.append({
+                'building': limit['building'],
+                'room': limit['room'] or None,
+                'hazard_category_id': limit['hazard_category_id'],
+                'unit': limit['unit'],
+                'max_quantity': limit['max_quantity'],
+                'current_quantity': current,
+                'projected_quantity': current + added
+            })
+    return exceeded
+
+
+def format_exceeded(exceeded):
+    """Build an error message for exceeded limits"""
+    parts = []
+    for item in exceeded:
+        area = item['building'] if item['room'] is None else f"{item['building']}, {item['room']}"
+        parts.append(f"{area}: {item['projected_quantity']:g} {item['unit']} "
+                     f"exceeds limit of {item['max_quantity']:g} {item['unit']}")
+    return 'Quantity limit exceeded - ' + '; '.join(parts)
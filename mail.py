@@ -0,0 +1,45 @@
+"""
+E-mail delivery for the Chemical Management System
+
+Messages are sent by the 'email' task in tasks.py, so a slow or unavailable
+mail server delays only the queue, and failed deliveries are retried. Set
+SMTP_HOST to enable e-mail; without it notifications are only shown in the
+app. For development, aiosmtpd (pip install aiosmtpd; the smtpd module it
+replaces was removed in Python 3.12) prints each message instead of
+delivering it:
+
+    python -m aiosmtpd -n -l localhost:1025
+    SMTP_HOST=localhost SMTP_PORT=1025 python worker.py
+"""
+
+import os
+import smtplib
+from email.message import EmailMessage
+
+SMTP_HOST = os.environ.get('SMTP_HOST')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 25))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS') == '1'
+SMTP_TIMEOUT = 30
+MAIL_FROM = os.environ.get('MAIL_FROM', 'chemlab@localhost')
+
+
+def enabled():
+    """Check whether a mail server is configured"""
+    return bool(SMTP_HOST)
+
+
+def send(to, subject, body):
+    """Send a plain-text message; raises smtplib.SMTPException or OSError if it is not accepted"""
+    message = EmailMessage()
+    message['From'] = MAIL_FROM
+    message['To'] = to
+    message['Subject'] = subject
+    message.set_content(body)
+    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT) as smtp:
+        if SMTP_STARTTLS:
+            smtp.starttls()
+        if SMTP_USERNAME:
+            smtp.login(SMTP_USERNAME, SMTP_PASSWORD)
+        smtp.send_message(message)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Apply schema migrations to the Chemical Management System database
+
+Brings the main database to the latest schema version (PRAGMA user_version)
+and finishes pending backfills. The app does this at startup too; run it
+before restarting on a new release so the new workers start without waiting.
+
+    python migrate.py            # migrate to the latest version
+    python migrate.py status     # show the version and backfill progress
+"""
+
+import sys
+import database as db
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['status']:
+        status = db.get_migration_status()
+        print(f"Schema version {status['version']} of {status['latest']}")
+        for migration in status['pending']:
+            print(f"  pending: {migration['version']} {migration['description']}")
+        for backfill in status['backfills']:
+            state = f"done {backfill['completed_at']}" if backfill['completed_at'] else f"at rowid {backfill['last_rowid']}"
+            print(f"  backfill {backfill['name']} ({backfill['table']}): {state}")
+    else:
+        result = db.migrate()
+        print(f"Schema version {result['version']}; migrated: {result['migrated'] or 'nothing'}")
+        for name, rows in result['backfilled'].items():
+            print(f'  backfilled {name}: {rows} rows')
@@ -0,0 +1,179 @@
+"""
+Password hashing for the Chemical Management System
+
+Checking a password against its scrypt hash takes around a tenth of a
+second of CPU, so a burst of logins at the start of a lab would hold every request
+thread. Hashes are checked and created in a pool of HASH_WORKERS processes
+instead. At most MAX_PENDING jobs are queued for the pool; a request that
+cannot get a slot within QUEUE_TIMEOUT seconds gets HashQueueFullError rather
+than piling more work onto a saturated server.
+
+A hash made with other parameters than PASSWORD_METHOD is re-hashed in the
+same job as a successful check, so the caller can store the upgraded hash.
+The pool keeps timings of recent jobs and login outcomes for stats().
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Hashing method and parameters for new hashes; older hashes are upgraded on login
+PASSWORD_METHOD = 'scrypt:32768:8:1'
+HASH_WORKERS = os.cpu_count() or 1
+MAX_PENDING = HASH_WORKERS * 4
+QUEUE_TIMEOUT = 10
+# Recent jobs kept for timing percentiles, and the window for login rates
+SAMPLE_SIZE = 1000
+RATE_WINDOW = 60
+
+
+class HashQueueFullError(RuntimeError):
+    """Raised when every hashing slot stays busy for QUEUE_TIMEOUT seconds"""
+
+
+def needs_rehash(password_hash):
+    """Check whether a hash was made with other parameters than PASSWORD_METHOD"""
+    return password_hash.split('$', 1)[0] != PASSWORD_METHOD
+
+
+def _check(password_hash, password):
+    """Check a password in a worker process, returning (valid, upgraded hash or None, seconds)"""
+    started = time.perf_counter()
+    valid = check_password_hash(password_hash, password)
+    upgraded = generate_password_hash(password, PASSWORD_METHOD) if valid and needs_rehash(password_hash) else None
+    return valid, upgraded, time.perf_counter() - started
+
+
+def _hash(password):
+    """Hash a password in a worker process, returning (hash, seconds)"""
+    started = time.perf_counter()
+    return generate_password_hash(password, PASSWORD_METHOD), time.perf_counter() - started
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 1)
+
+
+class HashPool:
+    """Bounded process pool for password hashing, with timing and login metrics"""
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._hash_times = deque(maxlen=SAMPLE_SIZE)
+        self._wait_times = deque(maxlen=SAMPLE_SIZE)
+        self._logins = deque()
+        self.pending = 0
+        self.counts = {'checks': 0, 'hashes': 0, 'rehashes': 0, 'busy': 0, 'logins': 0, 'failed_logins': 0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers)
+            return self._executor
+
+    def _run(self, function, *args):
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=QUEUE_TIMEOUT):
+            with self._lock:
+                self.counts['busy'] += 1
+            raise HashQueueFullError('The server is busy, please try again in a moment.')
+        try:
+            with self._lock:
+                self.pending += 1
+            try:
+                result = self._get_executor().submit(function, *args).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    self._executor = None
+                result = function(*args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+        with self._lock:
+            self._hash_times.append(result[-1])
+            self._wait_times.append(time.perf_counter() - started)
+        return result
+
+    def verify(self, password_hash, password):
+        """Check a password against its hash, returning (valid, upgraded hash or None)"""
+        valid, upgraded, _ = self._run(_check, password_hash, password or '')
+        with self._lock:
+            self.counts['checks'] += 1
+            self.counts['rehashes'] += upgraded is not None
+        return valid, upgraded
+
+    def hash(self, password):
+        """Hash a new password with PASSWORD_METHOD"""
+        password_hash, _ = self._run(_hash, password)
+        with self._lock:
+            self.counts['hashes'] += 1
+        return password_hash
+
+    def record_login(self, success):
+        """Count a login attempt for the rate metrics"""
+        now = time.monotonic()
+        with self._lock:
+            self.counts['logins' if success else 'failed_logins'] += 1
+            self._logins.append((now, success))
+            while self._logins and self._logins[0][0] < now - RATE_WINDOW:
+                self._logins.popleft()
+
+    def shutdown(self):
+        """Stop the worker processes, so none outlives the server holding its listening socket"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        """Get pool size, queue depth, hashing times and login rates"""
+        now = time.monotonic()
+        with self._lock:
+            recent = [success for at, success in self._logins if at >= now - RATE_WINDOW]
+            hash_times, wait_times = list(self._hash_times), list(self._wait_times)
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'method': PASSWORD_METHOD,
+                **self.counts,
+                'logins_per_minute': round(sum(recent) * 60 / RATE_WINDOW, 1),
+                'failed_logins_per_minute': round((len(recent) - sum(recent)) * 60 / RATE_WINDOW, 1),
+                'hash_ms_p50': _percentile(hash_times, 0.5),
+                'hash_ms_p95': _percentile(hash_times, 0.95),
+                'wait_ms_p50': _percentile(wait_times, 0.5),
+                'wait_ms_p95': _percentile(wait_times, 0.95)
+            }
+
+
+pool = HashPool()
+
+
+def configure(workers):
+    """Replace the pool with one of a different size, before it is first used"""
+    global pool
+    if workers != pool.workers:
+        pool = HashPool(workers, workers * 4)
+    return pool
+
+
+def verify_password(password_hash, password):
+    """Check a password against its hash in the pool, returning (valid, upgraded hash or None)"""
+    return pool.verify(password_hash, password)
+
+
+def hash_password(password):
+    """Hash a new password in the pool"""
+    return pool.hash(password)
@@ -0,0 +1,166 @@
+"""
+Token-bucket admission control for the Chemical Management System
+
+Each user (or client address, when signed out) has a bucket per endpoint
+class in LIMITS: 'search' for the search and typeahead endpoints, 'write'
+for every API call that changes data. A request takes one token; buckets
+refill at a steady rate up to their burst size. A request that would have
+to wait up to MAX_DELAY for a token waits (throttled); one that would wait
+longer gets 429 Too Many Requests with a Retry-After header (rejected).
+
+Buckets live in their own SQLite file, shared by every worker process, and
+each check is a single UPSERT in autocommit mode, so admission never queues
+behind the main database writer it is protecting. Throttled and rejected
+requests are counted in the same file; allowed ones per process.
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+import database as db
+
+# Endpoint class -> (burst size, tokens per second)
+LIMITS = {
+    'search': (20, 5.0),
+    'write': (20, 2.0),
+}
+SEARCH_ENDPOINTS = {'main.api_search', 'main.api_suggest', 'main.api_similar_chemicals', 'main.api_search_composition'}
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+# Longest a request is held back waiting for a token instead of being rejected
+MAX_DELAY = 0.5
+# Buckets idle this long are full again and can be dropped
+IDLE_SECONDS = 60 * 60
+RATE_LIMIT_DATABASE = os.path.join(os.path.dirname(db.DATABASE_NAME), 'rate_limits.db')
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+        bucket TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        allowed INTEGER NOT NULL DEFAULT 1
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS rate_limit_counts (
+        endpoint_class TEXT NOT NULL,
+        outcome TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (endpoint_class, outcome)
+    ) WITHOUT ROWID
+    '''
+]
+
+# Refill the bucket for the time since its last request, then take a token
+# if one is available within MAX_DELAY; every expression reads the old row
+TAKE_TOKEN = '''
+    INSERT INTO rate_limit_buckets (bucket, tokens, updated_at, allowed) VALUES (:bucket, :burst - 1, :now, 1)
+    ON CONFLICT (bucket) DO UPDATE SET
+        allowed = MIN(:burst, tokens + (:now - updated_at) * :rate) >= 1 - :rate * :max_delay,
+        tokens = MIN(:burst, tokens + (:now - updated_at) * :rate)
+                 - (MIN(:burst, tokens + (:now - updated_at) * :rate) >= 1 - :rate * :max_delay),
+        updated_at = :now
+    RETURNING allowed, tokens
+'''
+
+
+class RateLimited(Exception):
+    """Raised when a request finds its bucket empty"""
+
+    def __init__(self, endpoint_class, retry_after):
+        self.endpoint_class = endpoint_class
+        self.retry_after = retry_after
+        super().__init__(f'Too many {endpoint_class} requests, retry in {retry_after} s')
+
+
+class RateLimiter:
+    """Token buckets in a SQLite file shared between processes"""
+
+    def __init__(self, path=RATE_LIMIT_DATABASE, limits=LIMITS, max_delay=MAX_DELAY):
+        self.path = path
+        self.limits = limits
+        self.max_delay = max_delay
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.allowed = {endpoint_class: 0 for endpoint_class in limits}
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=db.BUSY_TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            # Buckets are soon refilled anyway, so losing the last writes in a crash is harmless
+            conn.execute('PRAGMA synchronous = OFF')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+        return conn
+
+    def _count(self, conn, endpoint_class, outcome):
+        conn.execute('''
+            INSERT INTO rate_limit_counts (endpoint_class, outcome, count) VALUES (?, ?, 1)
+            ON CONFLICT (endpoint_class, outcome) DO UPDATE SET count = count + 1
+        ''', (endpoint_class, outcome))
+
+    def acquire(self, endpoint_class, client):
+        """Take a token for a client, waiting up to max_delay for one; raises RateLimited if there is none"""
+        delay = self.take(endpoint_class, client)
+        if delay:
+            time.sleep(delay)
+
+    def take(self, endpoint_class, client):
+        """Take a token for a client and get the seconds to wait before using it; raises RateLimited if there is none"""
+        burst, rate = self.limits[endpoint_class]
+        conn = self._connection()
+        allowed, tokens = conn.execute(TAKE_TOKEN, {
+            'bucket': f'{endpoint_class}:{client}', 'burst': burst, 'rate': rate,
+            'now': time.time(), 'max_delay': self.max_delay
+        }).fetchone()
+        if not allowed:
+            self._count(conn, endpoint_class, 'rejected')
+            raise RateLimited(endpoint_class, max(1, math.ceil((1 - tokens) / rate)))
+        with self._lock:
+            self.allowed[endpoint_class] += 1
+        if tokens < 0:
+            # The token was taken ahead of the refill; wait until it is due
+            self._count(conn, endpoint_class, 'throttled')
+            return -tokens / rate
+        return 0
+
+    def prune(self, idle_seconds=IDLE_SECONDS):
+        """Drop buckets idle long enough to be full again"""
+        cursor = self._connection().execute('DELETE FROM rate_limit_buckets WHERE updated_at < ?',
+                                            (time.time() - idle_seconds,))
+        return {'pruned': cursor.rowcount}
+
+    def stats(self):
+        """Get limits, throttled and rejected counts from every process and this process's allowed counts"""
+        rows = self._connection().execute('SELECT endpoint_class, outcome, count FROM rate_limit_counts').fetchall()
+        counts = {}
+        for endpoint_class, outcome, count in rows:
+            counts.setdefault(endpoint_class, {})[outcome] = count
+        with self._lock:
+            allowed = dict(self.allowed)
+        return {
+            endpoint_class: {
+                'burst': burst,
+                'per_second': rate,
+                'allowed': allowed.get(endpoint_class, 0),
+                'throttled': counts.get(endpoint_class, {}).get('throttled', 0),
+                'rejected': counts.get(endpoint_class, {}).get('rejected', 0)
+            } for endpoint_class, (burst, rate) in self.limits.items()
+        }
+
+
+limiter = RateLimiter()
+
+
+def endpoint_class(endpoint, method, path):
+    """Get the LIMITS class of a request, or None if it is not limited"""
+    if endpoint in SEARCH_ENDPOINTS:
+        return 'search'
+    if method in WRITE_METHODS and path.startswith('/api/'):
+        return 'write'
+    return None
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+Rebuild the elemental-composition index of the Chemical Management System
+
+Re-parses every chemical_formula into the chemical_elements table and
+recomputes formula weights. Chemical writes keep the index current; run this
+after changing the formula parser or editing formulas directly in the
+database.
+"""
+
+import database as db
+
+if __name__ == '__main__':
+    result = db.reindex_formulas()
+    print(f"{result['chemicals']} chemicals: {result['parsed']} parsed, {result['unparsed']} unparsed, "
+          f"{result['elements']} element rows")
+    mismatches = db.get_weight_mismatches()
+    if mismatches:
+        print(f'{len(mismatches)} molecular weights differ from their formula by more than '
+              f'{db.MOLECULAR_WEIGHT_TOLERANCE:.0%}:')
+        for chemical in mismatches:
+            print(f"  #{chemical['id']} {chemical['name']} ({chemical['chemical_formula']}): "
+                  f"{chemical['molecular_weight']} entered, {chemical['formula_weight']} computed")
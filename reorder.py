@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Demand forecasts and reorder points for the Chemical Management System
+
+Loads the consumption rollups into NumPy arrays with one row per chemical and
+base unit (litres or kilograms), then computes for the whole catalogue at
+once:
+
+- short and long moving averages of daily demand,
+- a seasonal factor from up to five years of monthly totals, comparing the
+  coming month with the month the moving averages are centred on,
+- safety stock from the day-to-day variability of demand over the lead time,
+- the reorder point, and for chemicals whose available stock is at or below
+  it, the quantity that brings stock up to cover the lead time and the
+  review period.
+
+Results replace the reorder_suggestions table. The 'reorder' background job
+runs this nightly; it can also be run by hand:
+
+    python reorder.py
+"""
+
+import time
+from datetime import date, timedelta
+import numpy as np
+import database as db
+import limits
+
+# Days between placing an order and the stock arriving
+LEAD_TIME_DAYS = 14
+# Days of demand an order covers beyond the lead time
+REVIEW_DAYS = 30
+SHORT_AVERAGE_DAYS = 28
+LONG_AVERAGE_DAYS = 91
+SEASONAL_MONTHS = 60
+# Seasonal factors need two years of history and demand in at least half of
+# the months compared, and stay within a range
+MIN_SEASONAL_MONTHS = 24
+MIN_DEMAND_SHARE = 0.5
+SEASONAL_FACTOR_RANGE = (0.5, 2.0)
+# Standard normal quantile for a 95% chance of not running out during the lead time
+SERVICE_FACTOR = 1.645
+
+BASE_UNITS = sorted({base_unit for base_unit, _ in limits.UNIT_CONVERSIONS.values()})
+
+
+def _unit_sql(column='unit'):
+    """Get SQL expressions for the base unit index and conversion factor of a unit column"""
+    unit = f'lower(trim({column}))'
+    codes = ' '.join(f"WHEN '{name}' THEN {BASE_UNITS.index(base_unit)}"
+                     for name, (base_unit, _) in limits.UNIT_CONVERSIONS.items())
+    factors = ' '.join(f"WHEN '{name}' THEN {factor!r}" for name, (_, factor) in limits.UNIT_CONVERSIONS.items())
+    return f'CASE {unit} {codes} END', f'CASE {unit} {factors} END'
+
+
+def _month_index(day):
+    return day.year * 12 + day.month - 1
+
+
+def _fetch(sql, params=(), paths=None):
+    """Run a query returning (chemical_id, unit code, column, quantity) on each database file as one array"""
+    rows = []
+    for path in paths or db.get_database_paths():
+        with db.read_connection(path) as conn:
+            rows.extend(conn.execute(sql, params).fetchall())
+    return np.array(rows, dtype=float).reshape(-1, 4)
+
+
+def _series_keys(rows):
+    return rows[:, 0].astype(np.int64) * len(BASE_UNITS) + rows[:, 1].astype(np.int64)
+
+
+def seasonal_months(today, lead_time=LEAD_TIME_DAYS):
+    """Get (target, base) months of the year: the middle of the lead time and of the long moving average"""
+    return (today + timedelta(days=lead_time // 2)).month, (today - timedelta(days=LONG_AVERAGE_DAYS // 2)).month
+
+
+def history_months(today, months_of_year):
+    """Get the month indexes of the last SEASONAL_MONTHS complete months that fall in months_of_year"""
+    current = _month_index(today)
+    return np.array([index for index in range(current - SEASONAL_MONTHS, current) if index % 12 + 1 in months_of_year],
+                    dtype=np.int64)
+
+
+def load_series(today, months):
+    """Load demand before today into arrays
+
+    Returns (keys, daily, monthly): keys identify each row as
+    chemical_id * len(BASE_UNITS) + base unit index, daily holds the last
+    LONG_AVERAGE_DAYS days, oldest first, and monthly the totals of the given
+    month indexes, all in base units.
+    """
+    code, factor = _unit_sql()
+    first_day = today - timedelta(days=LONG_AVERAGE_DAYS)
+    daily_rows = _fetch(f'''
+        SELECT chemical_id, {code} AS code, julianday(period) - julianday(?), SUM(quantity * {factor})
+        FROM consumption_daily
+        WHERE period >= ? AND period < ? AND {code} IS NOT NULL
+        GROUP BY period, chemical_id, code
+    ''', (first_day.isoformat(), first_day.isoformat(), today.isoformat()))
+    periods = [f'{index // 12:04d}-{index % 12 + 1:02d}' for index in months.tolist()]
+    monthly_rows = _fetch(f'''
+        SELECT chemical_id, {code} AS code,
+               CAST(substr(period, 1, 4) AS INTEGER) * 12 + CAST(substr(period, 6, 2) AS INTEGER) - 1,
+               SUM(quantity * {factor})
+        FROM consumption_monthly
+        WHERE period IN ({', '.join('?' * len(periods))}) AND {code} IS NOT NULL
+        GROUP BY period, chemical_id, code
+    ''', periods)
+
+    daily_keys, monthly_keys = _series_keys(daily_rows), _series_keys(monthly_rows)
+    keys = np.unique(np.concatenate([daily_keys, monthly_keys]))
+    daily = np.zeros((len(keys), LONG_AVERAGE_DAYS))
+    monthly = np.zeros((len(keys), len(months)))
+    # add.at sums rows for the same series from different shards
+    np.add.at(daily, (np.searchsorted(keys, daily_keys), daily_rows[:, 2].astype(np.int64)), daily_rows[:, 3])
+    np.add.at(monthly, (np.searchsorted(keys, monthly_keys),
+                        np.searchsorted(months, monthly_rows[:, 2].astype(np.int64))), monthly_rows[:, 3])
+    return keys, daily, monthly
+
+
+def load_available(keys):
+    """Get the stock on hand minus quantities out on loan for each series key, in base units"""
+    code, factor = _unit_sql()
+    stock = _fetch(f'''
+        SELECT chemical_id, {code} AS code, 0, SUM(quantity * {factor})
+        FROM inventory
+        WHERE {code} IS NOT NULL
+        GROUP BY chemical_id, code
+    ''', paths=[db.DATABASE_NAME])
+    borrowed = _fetch(f'''
+        SELECT chemical_id, {code} AS code, 0, SUM(quantity_requested * {factor})
+        FROM chemical_requests
+        WHERE status = 'borrowed' AND {code} IS NOT NULL
+        GROUP BY chemical_id, code
+    ''')
+    available = np.zeros(len(keys))
+    for rows, sign in ((stock, 1), (borrowed, -1)):
+        row_keys = _series_keys(rows)
+        positions = np.minimum(np.searchsorted(keys, row_keys), max(len(keys) - 1, 0))
+        found = (keys[positions] == row_keys) if len(keys) else np.zeros(len(row_keys), dtype=bool)
+        np.add.at(available, positions[found], sign * rows[found, 3])
+    return np.maximum(available, 0)
+
+
+def seasonal_factor(monthly, months, current_month, target_month, base_month):
+    """Get each series' daily demand in target_month relative to base_month
+
+    monthly holds the totals of the given month indexes. History starts after
+    the first of them with demand, which may be a partial month. Series with
+    less than MIN_SEASONAL_MONTHS months of history, or with demand in fewer
+    than MIN_DEMAND_SHARE of their months, get a factor of 1.
+    """
+    if not len(months):
+        return np.ones(len(monthly))
+    starts = (months - 1970 * 12).astype('datetime64[M]')
+    days = ((starts + 1).astype('datetime64[D]') - starts.astype('datetime64[D]')).astype(float)
+    # Compare months by daily demand, so February is not a quiet month
+    rates = monthly / days
+    has_demand = monthly > 0
+    columns = monthly.shape[1]
+    first = np.where(has_demand.any(axis=1), has_demand.argmax(axis=1), columns - 1)
+    active = np.arange(columns) > first[:, None]
+    months_of_year = months % 12 + 1
+    in_target = active & (months_of_year == target_month)
+    in_base = active & (months_of_year == base_month)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = ((np.where(in_target, rates, 0).sum(axis=1) / in_target.sum(axis=1)) /
+                  (np.where(in_base, rates, 0).sum(axis=1) / in_base.sum(axis=1)))
+        share = (has_demand & active).sum(axis=1) / active.sum(axis=1)
+    usable = ((current_month - months[first] >= MIN_SEASONAL_MONTHS) & (share >= MIN_DEMAND_SHARE) &
+              np.isfinite(factor) & (factor > 0))
+    return np.where(usable, np.clip(factor, *SEASONAL_FACTOR_RANGE), 1.0)
+
+
+def forecast(daily, season, available, lead_time=LEAD_TIME_DAYS, review_days=REVIEW_DAYS):
+    """Compute demand, safety stock, reorder points and order quantities for every series
+
+    The moving averages of daily demand are scaled by the seasonal factor.
+    """
+    short_average = daily[:, -SHORT_AVERAGE_DAYS:].mean(axis=1)
+    long_average = daily.mean(axis=1)
+    deviation = daily.std(axis=1, ddof=1)
+    # The higher average lets a recent surge raise the reorder point before
+    # the long average catches up
+    demand = np.maximum(short_average, long_average) * season
+    safety_stock = SERVICE_FACTOR * deviation * season * np.sqrt(lead_time)
+    reorder_point = demand * lead_time + safety_stock
+    order_quantity = np.where(available <= reorder_point,
+                              np.maximum(reorder_point + demand * review_days - available, 0), 0)
+    with np.errstate(divide='ignore'):
+        days_of_stock = np.where(demand > 0, available / demand, np.inf)
+    return {
+        'daily_demand': demand,
+        'seasonal_factor': season,
+        'safety_stock': safety_stock,
+        'reorder_point': reorder_point,
+        'order_quantity': order_quantity,
+        'days_of_stock': days_of_stock,
+    }
+
+
+def compute_reorder_suggestions(today=None):
+    """Recompute reorder_suggestions for every chemical with recent demand"""
+    started = time.perf_counter()
+    today = today or date.today()
+    target_month, base_month = seasonal_months(today)
+    months = history_months(today, {target_month, base_month})
+    keys, daily, monthly = load_series(today, months)
+    available = load_available(keys)
+    season = seasonal_factor(monthly, months, _month_index(today), target_month, base_month)
+    result = forecast(daily, season, available)
+
+    kept = result['daily_demand'] > 0
+    columns = [
+        (keys[kept] // len(BASE_UNITS)).tolist(),
+        [BASE_UNITS[code] for code in (keys[kept] % len(BASE_UNITS)).tolist()],
+        np.round(available[kept], 6).tolist(),
+        *(np.round(result[name][kept], 6).tolist()
+          for name in ('daily_demand', 'seasonal_factor', 'safety_stock', 'reorder_point', 'order_quantity')),
+        np.round(result['days_of_stock'][kept], 1).tolist(),
+    ]
+    db.save_reorder_suggestions(zip(*columns))
+    return {
+        'series': len(keys),
+        'forecast': int(kept.sum()),
+        'reorder': int((result['order_quantity'][kept] > 0).sum()),
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+
+if __name__ == '__main__':
+    result = compute_reorder_suggestions()
+    print(f"{result['forecast']} chemicals forecast from {result['series']} series in {result['seconds']}s, "
+          f"{result['reorder']} at or below their reorder point")
+    for item in db.get_reorder_suggestions(limit=20):
+        print(f"  {item['name']}: {item['available']:g} {item['unit']} available, reorder point "
+              f"{item['reorder_point']:g}, order {item['order_quantity']:g} ({item['days_of_stock']:g} days left)")
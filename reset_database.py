@@ -5,6 +5,7 @@ WARNING: This will delete all existing data!
 """
 
 import os
+import shutil
 import database as db
 from werkzeug.security import generate_password_hash
 
@@ -15,11 +16,21 @@ def reset_database():
     if os.path.exists(db.DATABASE_NAME):
         print(f"Deleting existing database: {db.DATABASE_NAME}")
         os.remove(db.DATABASE_NAME)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db.DATABASE_NAME + suffix):
+                os.remove(db.DATABASE_NAME + suffix)
         print("✓ Old database deleted")
     
+    # Delete department shard files
+    shard_dir = os.path.join(os.path.dirname(db.DATABASE_NAME), db.SHARD_DIR)
+    if os.path.isdir(shard_dir):
+        print(f"Deleting shard files in: {shard_dir}")
+        shutil.rmtree(shard_dir)
+        print("✓ Old shards deleted")
+    
     # Initialize new database
     print("\nInitializing new database...")
-    db.init_database()
+    db.migrate()
     print("✓ Database tables created")
     
     # Add sample users
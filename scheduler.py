@@ -0,0 +1,131 @@
+"""
+Lightweight periodic job scheduler for the Chemical Management System
+
+Jobs run on a single background thread. Each job records when it last ran,
+how long it took and the row counts it returned, and the scheduler passes
+these to its on_run callback after every run, so they can be kept where
+admins can inspect them through the API.
+"""
+
+import threading
+import time
+import traceback
+from datetime import datetime
+
+
+class Job:
+    """A function run every interval seconds"""
+
+    def __init__(self, name, func, interval, run_at_start=True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = time.monotonic() if run_at_start else time.monotonic() + interval
+        self.runs = 0
+        self.failures = 0
+        self.last_run_at = None
+        self.last_duration_ms = None
+        self.last_result = None
+        self.last_error = None
+
+    def run(self):
+        """Run the job once and record its statistics"""
+        started = time.perf_counter()
+        self.last_run_at = datetime.now().isoformat(timespec='seconds')
+        try:
+            self.last_result = self.func()
+            self.last_error = None
+        except Exception:
+            self.failures += 1
+            self.last_error = traceback.format_exc(limit=3)
+        finally:
+            self.runs += 1
+            self.last_duration_ms = round((time.perf_counter() - started) * 1000, 2)
+            self.next_run = time.monotonic() + self.interval
+        return self.last_result
+
+    def stats(self):
+        """Get the job's run statistics"""
+        return {
+            'name': self.name,
+            'interval_seconds': self.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_run_at': self.last_run_at,
+            'last_duration_ms': self.last_duration_ms,
+            'last_result': self.last_result,
+            'last_error': self.last_error
+        }
+
+
+class Scheduler:
+    """Runs registered jobs on a background thread"""
+
+    def __init__(self, tick=1.0, on_run=None):
+        self.tick = tick
+        self.on_run = on_run
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_job(self, name, func, interval, run_at_start=True):
+        """Register a function to run every interval seconds"""
+        with self._lock:
+            self.jobs[name] = Job(name, func, interval, run_at_start)
+
+    def run_job(self, name):
+        """Run a job immediately, returning its result"""
+        job = self.jobs.get(name)
+        if job is None:
+            raise KeyError(f'Unknown job: {name}')
+        with self._lock:
+            self._run(job)
+        return job.stats()
+
+    def run_pending(self):
+        """Run every job that is due"""
+        now = time.monotonic()
+        for job in list(self.jobs.values()):
+            if job.next_run <= now and not self._stop.is_set():
+                with self._lock:
+                    self._run(job)
+
+    def start(self):
+        """Start the scheduler thread if it is not already running"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the scheduler thread"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def is_running(self):
+        """Check whether the scheduler thread is alive"""
+        return bool(self._thread and self._thread.is_alive())
+
+    def get_stats(self):
+        """Get statistics for every registered job"""
+        return {
+            'running': self.is_running(),
+            'jobs': [job.stats() for job in self.jobs.values()]
+        }
+
+    def _run(self, job):
+        job.run()
+        if self.on_run is not None:
+            try:
+                self.on_run(job.stats())
+            except Exception:
+                # Failing to record a run must not stop the scheduler
+                traceback.print_exc()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.run_pending()
+            self._stop.wait(self.tick)
@@ -0,0 +1,83 @@
+"""
+Hazard-class segregation rules for the Chemical Management System
+
+The compatibility matrix is built once from the hazard_categories table and
+kept in memory, so checking a placement is a set lookup per category already
+stored at the target location.
+"""
+
+# Pairs of hazard categories (by name) that must not share a storage location
+INCOMPATIBLE_PAIRS = [
+    ('Flammable', 'Oxidizing'),
+    ('Flammable', 'Explosive'),
+    ('Flammable', 'Corrosive'),
+    ('Oxidizing', 'Explosive'),
+    ('Oxidizing', 'Toxic'),
+    ('Explosive', 'Corrosive'),
+]
+
+
+class SegregationError(ValueError):
+    """Raised when a placement would co-locate incompatible hazard classes"""
+
+
+_matrix = None
+_names = {}
+
+
+def build_matrix(categories):
+    """Build the compatibility matrix from hazard category rows"""
+    global _matrix, _names
+    ids_by_name = {c['name']: c['id'] for c in categories}
+    matrix = {c['id']: set() for c in categories}
+    for first, second in INCOMPATIBLE_PAIRS:
+        a, b = ids_by_name.get(first), ids_by_name.get(second)
+        if a is None or b is None:
+            continue
+        matrix[a].add(b)
+        matrix[b].add(a)
+    _matrix = {category_id: frozenset(ids) for category_id, ids in matrix.items()}
+    _names = {c['id']: c['name'] for c in categories}
+    return _matrix
+
+
+def is_loaded():
+    """Check whether the matrix has been built"""
+    return _matrix is not None
+
+
+def invalidate():
+    """Drop the cached matrix so it is rebuilt on next use"""
+    global _matrix
+    _matrix = None
+
+
+def is_compatible(category_a, category_b):
+    """Check whether two hazard categories may share a location"""
+    if category_a is None or category_b is None:
+        return True
+    return category_b not in _matrix.get(category_a, ())
+
+
+def find_conflicts(category_id, present_categories):
+    """Return the categories in present_categories that clash with category_id"""
+    if category_id is None:
+        return []
+    incompatible = _matrix.get(category_id, frozenset())
+    return [c for c in present_categories if c in incompatible]
+
+
+def category_name(category_id):
+    """Get the display name for a hazard category id"""
+    return _names.get(category_id, str(category_id))
+
+
+def check_placement(category_id, present_categories, location_id=None):
+    """Raise SegregationError if category_id clashes with present_categories"""
+    conflicts = find_conflicts(category_id, present_categories)
+    if conflicts:
+        clash = ', '.join(sorted(category_name(c) for c in conflicts))
+        where = f'location {location_id}' if location_id is not None else 'this location'
+        raise SegregationError(
+            f'{category_name(category_id)} chemicals cannot be stored with {clash} chemicals at {where}'
+        )
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Department shards for the Chemical Management System
+
+With CHEMICAL_SHARDING=1 each department's requests, borrow history and
+notifications live in their own file under shards/. This script lists the
+shards and moves records created before sharding was enabled out of the main
+database into their owners' shards.
+
+    CHEMICAL_SHARDING=1 python shards.py list      # record counts per shard
+    CHEMICAL_SHARDING=1 python shards.py migrate   # move existing records into shards
+
+Stop the server before migrating. Moved records get IDs in their shard's
+range, and notifications and activity log entries that point at a moved
+request are updated to match.
+"""
+
+import argparse
+import database as db
+
+
+def _column_list(conn, table, replacements):
+    """Get the column list of a table with some columns replaced by expressions"""
+    return ', '.join(replacements.get(row['name'], row['name'])
+                     for row in conn.execute(f'PRAGMA main.table_info({table})'))
+
+
+def _migrate_shard(conn, shard_id, path, user_ids):
+    """Copy the records of user_ids into one shard, then remove them from the main database"""
+    base = shard_id * db.SHARD_ID_SPAN
+    conn.execute('DELETE FROM temp.moving_users')
+    conn.executemany('INSERT INTO temp.moving_users (id) VALUES (?)', [(user_id,) for user_id in user_ids])
+    moved_requests = 'SELECT id FROM main.chemical_requests WHERE student_id IN (SELECT id FROM temp.moving_users)'
+    conn.commit()
+
+    # Copy first and commit the shard on its own, so an interrupted run can be
+    # repeated: rows already copied are skipped by INSERT OR IGNORE
+    conn.execute('ATTACH DATABASE ? AS shard', (path,))
+    try:
+        columns = {
+            'chemical_requests': {'id': f'id + {base}'},
+            'borrow_history': {'id': f'id + {base}', 'request_id': f'request_id + {base}'},
+            'notifications': {
+                'id': f'id + {base}',
+                'related_entity_id': f"""CASE WHEN related_entity_type = 'request' AND related_entity_id IN ({moved_requests})
+                                              THEN related_entity_id + {base} ELSE related_entity_id END"""
+            },
+        }
+        owner = {'chemical_requests': 'student_id', 'borrow_history': 'student_id', 'notifications': 'user_id'}
+        counts = {}
+        for table in db.SHARDED_TABLES:
+            target = _column_list(conn, table, {})
+            source = _column_list(conn, table, columns[table])
+            counts[table] = conn.execute(f'''
+                INSERT OR IGNORE INTO shard.{table} ({target})
+                SELECT {source} FROM main.{table}
+                WHERE {owner[table]} IN (SELECT id FROM temp.moving_users)
+            ''').rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute('DETACH DATABASE shard')
+
+    # Point references that stay in the main database at the new request IDs
+    for table, type_column, id_column in (('notifications', 'related_entity_type', 'related_entity_id'),
+                                          ('activity_log', 'entity_type', 'entity_id')):
+        conn.execute(f'''
+            UPDATE main.{table} SET {id_column} = {id_column} + {base}
+            WHERE {type_column} = 'request' AND {id_column} IN ({moved_requests})
+        ''')
+    for table in reversed(db.SHARDED_TABLES):
+        conn.execute(f'DELETE FROM main.{table} WHERE {owner[table]} IN (SELECT id FROM temp.moving_users)')
+    conn.commit()
+    return counts
+
+
+def migrate():
+    """Move records of users with a department from the main database into their shards"""
+    if not db.SHARDING_ENABLED:
+        raise RuntimeError('Sharding is disabled; set CHEMICAL_SHARDING=1 first')
+    for user in db.get_all_users():
+        db.get_user_database(user['id'])
+
+    conn = db.get_db_connection()
+    try:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS moving_users (id INTEGER PRIMARY KEY)')
+        shards = {}
+        for row in conn.execute('''
+            SELECT s.id, s.path, us.user_id FROM user_shards us
+            JOIN shards s ON s.id = us.shard_id
+        '''):
+            shards.setdefault((row['id'], row['path']), []).append(row['user_id'])
+        result = {}
+        for (shard_id, path), user_ids in sorted(shards.items()):
+            result[path] = _migrate_shard(conn, shard_id, path, user_ids)
+    finally:
+        conn.close()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List department shards and migrate records into them')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='show record counts for the main database and every shard')
+    subparsers.add_parser('migrate', help='move existing department records into their shards')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for shard in db.get_shard_stats():
+            print(f"{shard['path']}  [{shard['department'] or 'main'}]  {shard['size_mb']} MB")
+            for table in db.SHARDED_TABLES:
+                print(f'  {table}: {shard[table]}')
+    elif args.command == 'migrate':
+        for path, counts in migrate().items():
+            print(f'{path}:')
+            for table, moved in counts.items():
+                print(f'  {table}: {moved}')
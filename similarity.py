@@ -0,0 +1,270 @@
+"""
+Near-duplicate chemical names for the Chemical Management System
+
+Names and synonyms are normalized (case, punctuation, grade and purity words,
+word order) and compared by the Jaccard similarity of their character
+trigrams, so "Ethanol" and "ethanol absolute" match. Spelling variants that
+share no letters, such as "Ethyl alcohol", are caught through synonyms. Names
+never match when their locants, oxidation states, isomer prefixes, anion
+suffixes or alkyl stems differ (1-Propanol and 2-Propanol, Sodium sulfite and
+Sodium sulfate, Methyl acetate and Ethyl acetate), or when both chemicals have
+formulas that parse to different compositions. Only matches whose formulas
+parse to the same composition are certain duplicates; the rest are advisory.
+
+An inverted index maps each name's rarest trigrams to its chemical (prefix
+filtering): two names reaching the threshold must share one of them, so a
+lookup reads a few short postings lists and scores only those candidates.
+Clustering the catalogue reuses the same lookup per chemical, which blocks
+candidate pairs on shared rare trigrams instead of comparing every pair of
+names.
+"""
+
+import math
+import re
+import threading
+import formula
+
+SIMILARITY_THRESHOLD = 0.6
+MAX_MATCHES = 5
+
+# Words that describe a grade, purity or form rather than the substance
+NAME_STOPWORDS = {
+    'absolute', 'anhydrous', 'reagent', 'grade', 'acs', 'ar', 'gr', 'analytical', 'analysis',
+    'lab', 'laboratory', 'technical', 'tech', 'pure', 'purified', 'extra', 'hplc', 'spectroscopic',
+    'usp', 'bp', 'ep', 'ph', 'eur', 'for', 'synthesis', 'solid', 'powder', 'crystals', 'crystalline',
+    'min', 'approx', 'solution'
+}
+# Words that tell isomers and oxidation states apart
+QUALIFIERS = {
+    'i', 'ii', 'iii', 'iv', 'v', 'vi', 'vii', 'viii', 'cis', 'trans', 'ortho', 'meta', 'para',
+    'o', 'm', 'p', 'n', 'sec', 'tert', 't', 'iso', 'neo', 'l', 'd', 'r', 's', 'e', 'z', 'alpha', 'beta'
+}
+# Anion suffixes (sulfide, sulfite, sulfate) and alkyl stems (methanol, ethyl)
+_ANION_SUFFIX = re.compile(r'(ide|ite|ate)$')
+_ALKYL_STEM = re.compile(r'(meth|eth|prop|but|pent|hex|hept|oct|non|dec)(?=yl|an|en|yn|ox)')
+_NON_WORD = re.compile(r'[^\w]+')
+_PURITY = re.compile(r'\d+(?:[.,]\d+)?\s*%')
+
+
+class SimilarChemicalError(ValueError):
+    """Raised when a new chemical's name is close to one already in the catalogue"""
+
+    def __init__(self, matches):
+        self.matches = matches
+        names = ', '.join(f"{match['name']} ({match['score']:.0%})" for match in matches)
+        super().__init__(f'Similar chemicals already exist: {names}')
+
+
+def normalize_name(name):
+    """Reduce a name to sorted, lower-case words without grade or purity terms"""
+    text = _PURITY.sub(' ', str(name or '').casefold())
+    words = [word for word in _NON_WORD.sub(' ', text).split() if word not in NAME_STOPWORDS]
+    return ' '.join(sorted(words))
+
+
+def qualifiers(name):
+    """Get the numbers, isomer or oxidation-state words, anion suffixes and alkyl stems in a name"""
+    found = set()
+    for word in normalize_name(name).split():
+        if word.isdigit() or word in QUALIFIERS:
+            found.add(word)
+            continue
+        suffix = _ANION_SUFFIX.search(word)
+        if suffix and not word.endswith('hydrate'):
+            found.add('-' + suffix.group(1))
+        found.update(stem + '-' for stem in _ALKYL_STEM.findall(word))
+    return frozenset(found)
+
+
+def composition_key(chemical_formula):
+    """Get a comparable composition for a formula, or None if it does not parse"""
+    try:
+        return frozenset(formula.parse(chemical_formula).items())
+    except formula.FormulaError:
+        return None
+
+
+def trigrams(name):
+    """Get the set of character trigrams of a normalized name"""
+    text = f' {normalize_name(name)} '
+    if len(text) < 3 or not text.strip():
+        return frozenset()
+    return frozenset(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def jaccard(first, second):
+    """Jaccard similarity of two trigram sets"""
+    if not first or not second:
+        return 0.0
+    shared = len(first & second)
+    return shared / (len(first) + len(second) - shared)
+
+
+class NameIndex:
+    """Trigram index over chemical names and synonyms
+
+    Trigrams are ordered rarest first (by their frequency when the index was
+    built), and each name is indexed only under the first trigrams in that
+    order: two names reaching the threshold always share one of those.
+    Postings keep each name's size and the trigram's position in it, so
+    lookups skip names whose length or remaining trigrams rule out a match.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self.version = None
+        self._postings = {}
+        self._entries = {}
+        self._ranks = {}
+        self._lock = threading.RLock()
+
+    def build(self, chemicals, version=None):
+        """Replace the index with (chemical, synonyms) pairs"""
+        chemicals = list(chemicals)
+        frequencies = {}
+        for chemical, synonyms in chemicals:
+            for text in [chemical['name'], *synonyms]:
+                for gram in trigrams(text):
+                    frequencies[gram] = frequencies.get(gram, 0) + 1
+        with self._lock:
+            self._ranks = {gram: rank for rank, gram in enumerate(sorted(frequencies, key=frequencies.get))}
+            self._postings = {}
+            self._entries = {}
+            for chemical, synonyms in chemicals:
+                self._add(chemical, synonyms)
+            self.version = version
+
+    def update(self, chemical_id, chemical=None, synonyms=(), version=None):
+        """Re-index one chemical, or remove it when chemical is None
+
+        With a version, the change is applied only if the index is at the
+        version just before it; otherwise it is marked out of date and False
+        is returned.
+        """
+        with self._lock:
+            if version is not None and (self.version is None or self.version != version - 1):
+                self.version = None
+                return False
+            self._remove(chemical_id)
+            if chemical is not None:
+                self._add(chemical, synonyms)
+            self.version = version
+            return True
+
+    def similar(self, names, exclude=None, threshold=None, limit=MAX_MATCHES, chemical_formula=None, composition=None):
+        """Get chemicals with a name or synonym similar to any of names
+
+        threshold may only be raised above the index's own. Chemicals whose
+        formula parses to a different composition than chemical_formula are
+        not matched. Returns up to limit {'id', 'name', 'match', 'score',
+        'same_composition'} dicts, best first; same_composition is True only
+        when both formulas parse and agree.
+        """
+        threshold = max(self.threshold, threshold or 0)
+        if composition is None and chemical_formula:
+            composition = composition_key(chemical_formula)
+        best = {}
+        with self._lock:
+            for name in names:
+                query = trigrams(name)
+                if not query:
+                    continue
+                query_qualifiers = qualifiers(name)
+                size = len(query)
+                # Names this much shorter or longer cannot reach the threshold
+                min_size, max_size = threshold * size, size / threshold
+                overlap_ratio = threshold / (1 + threshold)
+                candidates = set()
+                for position, gram in enumerate(self._prefix(query)):
+                    for key, (other_size, other_position) in self._postings.get(gram, {}).items():
+                        if not min_size <= other_size <= max_size:
+                            continue
+                        # Trigrams from the first shared one on bound the overlap
+                        remaining, other_remaining = size - position, other_size - other_position
+                        reachable = remaining if remaining < other_remaining else other_remaining
+                        if reachable >= overlap_ratio * (size + other_size):
+                            candidates.add(key)
+                for chemical_id, entry in candidates:
+                    if chemical_id == exclude:
+                        continue
+                    display_name, other_composition, entries = self._entries[chemical_id]
+                    if composition is not None and other_composition is not None and composition != other_composition:
+                        continue
+                    text, grams, text_qualifiers, _ = entries[entry]
+                    if text_qualifiers != query_qualifiers:
+                        continue
+                    score = jaccard(query, grams)
+                    if score >= threshold and score > best.get(chemical_id, (0, None))[0]:
+                        same = composition is not None and composition == other_composition
+                        best[chemical_id] = (score, text, display_name, same)
+        matches = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))[:limit]
+        return [{'id': chemical_id, 'name': display_name, 'match': text, 'score': round(score, 3),
+                 'same_composition': same}
+                for chemical_id, (score, text, display_name, same) in matches]
+
+    def cluster(self, threshold=None):
+        """Group chemicals into candidate merge groups
+
+        Returns a list of {chemical_id: best score} dicts, largest group first.
+        """
+        parent = {}
+        scores = {}
+
+        def find(chemical_id):
+            while parent.get(chemical_id, chemical_id) != chemical_id:
+                parent[chemical_id] = parent.get(parent[chemical_id], parent[chemical_id])
+                chemical_id = parent[chemical_id]
+            return chemical_id
+
+        with self._lock:
+            for chemical_id, (_, composition, entries) in list(self._entries.items()):
+                names = [entry[0] for entry in entries]
+                for match in self.similar(names, chemical_id, threshold, len(self._entries), composition=composition):
+                    other = match['id']
+                    scores[chemical_id] = max(scores.get(chemical_id, 0), match['score'])
+                    scores[other] = max(scores.get(other, 0), match['score'])
+                    root, other_root = find(chemical_id), find(other)
+                    if root != other_root:
+                        parent[max(root, other_root)] = min(root, other_root)
+
+        groups = {}
+        for chemical_id in scores:
+            groups.setdefault(find(chemical_id), {})[chemical_id] = scores[chemical_id]
+        return sorted(groups.values(), key=lambda group: (-len(group), min(group)))
+
+    def stats(self):
+        """Get index size"""
+        with self._lock:
+            return {'chemicals': len(self._entries), 'trigrams': len(self._ranks), 'version': self.version}
+
+    def _prefix(self, grams):
+        """Get the rarest trigrams that any name reaching the threshold must share one of"""
+        # Trigrams first seen after the build rank as the rarest
+        ordered = sorted(grams, key=lambda gram: (self._ranks.get(gram, -1), gram))
+        return ordered[:len(grams) - math.ceil(self.threshold * len(grams)) + 1]
+
+    def _add(self, chemical, synonyms):
+        chemical_id = chemical['id']
+        entries = []
+        for text in [chemical['name'], *synonyms]:
+            grams = trigrams(text)
+            if grams:
+                prefix = self._prefix(grams)
+                for position, gram in enumerate(prefix):
+                    self._postings.setdefault(gram, {})[(chemical_id, len(entries))] = (len(grams), position)
+                entries.append((text, grams, qualifiers(text), prefix))
+        chemical_formula = chemical['chemical_formula'] if 'chemical_formula' in chemical.keys() else None
+        self._entries[chemical_id] = (chemical['name'], composition_key(chemical_formula), entries)
+
+    def _remove(self, chemical_id):
+        _, _, entries = self._entries.pop(chemical_id, (None, None, []))
+        for entry, (_, _, _, prefix) in enumerate(entries):
+            for gram in prefix:
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.pop((chemical_id, entry), None)
+                    if not postings:
+                        del self._postings[gram]
+
+
+index = NameIndex()
@@ -17,7 +17,8 @@ function showAlert(message, type = 'success') {
 // Search functionality
 function initSearch() {
     const searchInput = document.getElementById('searchInput');
-    if (searchInput) {
+    // Search boxes inside a filter form are submitted to the server instead
+    if (searchInput && !searchInput.form) {
         searchInput.addEventListener('input', debounce(function(e) {
             const query = e.target.value.toLowerCase();
             const rows = document.querySelectorAll('tbody tr');
@@ -27,9 +28,43 @@ function initSearch() {
                 row.style.display = text.includes(query) ? '' : 'none';
             });
         }, 300));
+    } else if (searchInput) {
+        initSuggestions(searchInput);
     }
 }
 
+// Typeahead: offer chemicals matching the typed prefix from /api/suggest
+function initSuggestions(input) {
+    const list = document.createElement('datalist');
+    list.id = input.id + 'Suggestions';
+    input.after(list);
+    input.setAttribute('list', list.id);
+    input.setAttribute('autocomplete', 'off');
+
+    input.addEventListener('input', debounce(function() {
+        const query = input.value.trim();
+        if (!query) {
+            list.innerHTML = '';
+            return;
+        }
+        // Keep the current suggestions when the request is rate limited
+        fetch(`/api/suggest?q=${encodeURIComponent(query)}`)
+            .then(response => response.ok ? response.json() : Promise.reject(response))
+            .then(suggestions => {
+                list.innerHTML = '';
+                suggestions.forEach(item => {
+                    const option = document.createElement('option');
+                    option.value = item.name;
+                    if (item.match !== item.name) {
+                        option.label = `${item.name} (${item.match})`;
+                    }
+                    list.appendChild(option);
+                });
+            })
+            .catch(() => {});
+    }, 150));
+}
+
 // Debounce function
 function debounce(func, wait) {
     let timeout;
@@ -109,18 +144,34 @@ function handleChemicalForm(event, isEdit = false) {
     const method = isEdit ? 'PUT' : 'POST';
     const chemicalId = form.dataset.chemicalId;
     const url = isEdit ? `/api/chemicals/${chemicalId}` : '/api/chemicals';
-    
+    saveChemical(url, method, data, isEdit, chemicalId);
+}
+
+// Send a chemical to the API, asking before adding a near-duplicate name
+function saveChemical(url, method, payload, isEdit, chemicalId) {
     fetch(url, {
         method: method,
         headers: {
             'Content-Type': 'application/json'
         },
-        body: JSON.stringify(data)
+        body: JSON.stringify(payload)
     })
     .then(response => response.json())
     .then(data => {
-        if (data.success) {
-            showAlert(data.message, 'success');
+        if (!data.success && data.similar) {
+            // Same composition under a close name: let the admin confirm it is a different chemical
+            const names = data.similar.map(match => `- ${match.name} (matched "${match.match}")`).join('\n');
+            if (confirm(`Similar chemicals already exist:\n${names}\n\nAdd "${payload.name}" anyway?`)) {
+                saveChemical(url, method, {...payload, allow_similar: true}, isEdit, chemicalId);
+            }
+        } else if (data.success) {
+            if (data.similar && data.similar.length) {
+                // Close names without a matching formula are only a warning
+                const names = data.similar.map(match => match.name).join(', ');
+                showAlert(`${data.message}. Check it is not a duplicate of: ${names}`, 'warning');
+            } else {
+                showAlert(data.message, 'success');
+            }
             setTimeout(() => {
                 if (isEdit) {
                     window.location.href = `/chemical/${chemicalId}`;
@@ -295,33 +346,48 @@ function highlightActiveNav() {
     });
 }
 
-// Sort table
-function sortTable(columnIndex) {
-    const table = document.querySelector('table');
-    const tbody = table.querySelector('tbody');
-    const rows = Array.from(tbody.querySelectorAll('tr'));
-    
-    const sortedRows = rows.sort((a, b) => {
-        const aValue = a.cells[columnIndex].textContent.trim();
-        const bValue = b.cells[columnIndex].textContent.trim();
-        
-        // Try to compare as numbers first
-        const aNum = parseFloat(aValue);
-        const bNum = parseFloat(bValue);
-        
-        if (!isNaN(aNum) && !isNaN(bNum)) {
-            return aNum - bNum;
+// Sort table on the server: reload with the column as the sort key,
+// flipping the direction when it is already sorted by that column
+function sortTable(column) {
+    const params = new URLSearchParams(window.location.search);
+    const ascending = params.get('sort') === column && (params.get('dir') || 'asc') === 'asc';
+    params.set('sort', column);
+    params.set('dir', ascending ? 'desc' : 'asc');
+    params.delete('page');
+    window.location.search = params.toString();
+}
+
+// Keep the notification badge current from the async server's event stream;
+// servers without the stream answer 404, and the page keeps its rendered count
+function watchUnreadCount() {
+    const bell = document.getElementById('notificationBell');
+    if (!bell || !window.EventSource) {
+        return;
+    }
+    const source = new EventSource(bell.dataset.stream);
+    source.addEventListener('unread', function(e) {
+        const count = parseInt(e.data, 10);
+        let badge = bell.querySelector('.badge');
+        if (count > 0 && !badge) {
+            badge = document.createElement('span');
+            badge.className = 'badge badge-danger';
+            badge.style.cssText = 'font-size: 0.7rem; padding: 0.2rem 0.5rem;';
+            bell.appendChild(badge);
+        }
+        if (badge) {
+            badge.textContent = count;
+            badge.style.display = count > 0 ? '' : 'none';
         }
-        
-        // Otherwise compare as strings
-        return aValue.localeCompare(bValue);
     });
-    
-    // Remove existing rows
-    rows.forEach(row => row.remove());
-    
-    // Append sorted rows
-    sortedRows.forEach(row => tbody.appendChild(row));
+    source.onerror = function() {
+        // Reconnect only while the stream was working; a refused stream stays closed
+        if (source.readyState === EventSource.CLOSED || !source.opened) {
+            source.close();
+        }
+    };
+    source.onopen = function() {
+        source.opened = true;
+    };
 }
 
 // Initialize on page load
@@ -329,11 +395,12 @@ document.addEventListener('DOMContentLoaded', function() {
     initSearch();
     checkExpiryDates();
     highlightActiveNav();
+    watchUnreadCount();
     
     // Add click handlers to sortable headers
-    document.querySelectorAll('th[data-sortable]').forEach((header, index) => {
+    document.querySelectorAll('th[data-sortable]').forEach(header => {
         header.style.cursor = 'pointer';
-        header.addEventListener('click', () => sortTable(index));
+        header.addEventListener('click', () => sortTable(header.dataset.sort));
     });
 });
 
@@ -0,0 +1,202 @@
+"""
+Typeahead suggestions for the Chemical Management System
+
+A prefix trie over chemical names, synonyms, formulas and CAS numbers. Every
+node keeps its best TOP_K matches, so a lookup walks the prefix and returns
+that list without visiting the subtree. Adding a chemical updates the nodes
+along each of its terms; removing one marks them stale, and they are rebuilt
+from their children the next time they are read. Popular prefixes are
+answered from an LRU cache that is cleared on every change.
+"""
+
+import heapq
+import re
+import threading
+from bisect import insort
+from functools import lru_cache
+
+TOP_K = 20
+MAX_SUGGESTIONS = 10
+CACHE_SIZE = 4096
+# Terms are indexed up to this many characters
+MAX_PREFIX_LENGTH = 32
+
+# Lower ranks are suggested first
+FIELD_RANKS = {
+    'name': 0,
+    'synonym': 1,
+    'word': 2,
+    'formula': 3,
+    'cas': 4
+}
+
+
+def normalize(text):
+    """Fold case and collapse whitespace for matching"""
+    return ' '.join(str(text).casefold().split())
+
+
+def chemical_terms(chemical, synonyms=()):
+    """Get the (field, text) terms indexed for a chemical row"""
+    terms = []
+    if chemical['name']:
+        terms.append(('name', chemical['name']))
+    for synonym in synonyms:
+        terms.append(('synonym', synonym))
+    # Later words of names and synonyms, so "acid" finds "Hydrochloric Acid"
+    for field, text in list(terms):
+        for word in re.split(r'[\s,()\-]+', text)[1:]:
+            if len(word) > 1:
+                terms.append(('word', word))
+    if chemical['chemical_formula']:
+        terms.append(('formula', chemical['chemical_formula']))
+    if chemical['cas_number']:
+        terms.append(('cas', chemical['cas_number']))
+    return terms
+
+
+class _Node:
+    __slots__ = ('children', 'entries', 'top', 'stale')
+
+    def __init__(self):
+        self.children = {}
+        self.entries = []
+        self.top = []
+        self.stale = False
+
+
+class PrefixIndex:
+    """Prefix trie returning the best-ranked chemicals for a typed prefix"""
+
+    def __init__(self, top_k=TOP_K, cache_size=CACHE_SIZE):
+        self.top_k = top_k
+        self.version = None
+        # Part of every cache key, so a lookup racing an update cannot cache stale results
+        self._generation = 0
+        self._root = _Node()
+        self._terms = {}
+        self._names = {}
+        self._lock = threading.RLock()
+        self._cached = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def build(self, chemicals, version=None):
+        """Replace the index with (chemical, synonyms) pairs"""
+        with self._lock:
+            self._root = _Node()
+            self._terms = {}
+            self._names = {}
+            # Insert every term first, then fill each node's top list once, bottom up
+            self._root.stale = True
+            for chemical, synonyms in chemicals:
+                self._add(chemical, synonyms, stale=True)
+            self._best(self._root)
+            self.version = version
+            self._generation += 1
+            self._cached.cache_clear()
+
+    def update(self, chemical_id, chemical=None, synonyms=(), version=None):
+        """Re-index one chemical, or remove it when chemical is None
+
+        With a version, the change is applied only if the index is at the
+        version just before it; otherwise a write was missed, so the index is
+        marked out of date and False is returned.
+        """
+        with self._lock:
+            if version is not None and (self.version is None or self.version != version - 1):
+                self.version = None
+                return False
+            self._remove(chemical_id)
+            if chemical is not None:
+                self._add(chemical, synonyms)
+            self.version = version
+            self._generation += 1
+            self._cached.cache_clear()
+            return True
+
+    def suggest(self, prefix, limit=MAX_SUGGESTIONS):
+        """Get up to limit {'id', 'name', 'match', 'field'} suggestions for a prefix"""
+        key = normalize(prefix)[:MAX_PREFIX_LENGTH]
+        if not key:
+            return []
+        limit = max(1, min(int(limit), MAX_SUGGESTIONS))
+        return [dict(item) for item in self._cached(key, limit, self._generation)]
+
+    def cache_info(self):
+        """Get LRU hit and miss counts"""
+        info = self._cached.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'max_size': info.maxsize}
+
+    def stats(self):
+        """Get index size and cache statistics"""
+        return {'chemicals': len(self._names), 'version': self.version, 'cache': self.cache_info()}
+
+    def _lookup(self, key, limit, generation):
+        with self._lock:
+            node = self._root
+            for char in key:
+                node = node.children.get(char)
+                if node is None:
+                    return ()
+            results = []
+            seen = set()
+            for _, _, text, field, chemical_id in self._best(node):
+                if chemical_id in seen:
+                    continue
+                seen.add(chemical_id)
+                results.append((('id', chemical_id), ('name', self._names[chemical_id]),
+                                ('match', text), ('field', field)))
+                if len(results) == limit:
+                    break
+            return tuple(results)
+
+    def _best(self, node):
+        """Get a node's top entries, rebuilding them from its children if stale"""
+        if node.stale:
+            candidates = list(node.entries)
+            for child in node.children.values():
+                candidates.extend(self._best(child))
+            node.top = heapq.nsmallest(self.top_k, candidates)
+            node.stale = False
+        return node.top
+
+    def _add(self, chemical, synonyms, stale=False):
+        chemical_id = chemical['id']
+        self._names[chemical_id] = chemical['name']
+        entries = []
+        for field, text in chemical_terms(chemical, synonyms):
+            key = normalize(text)[:MAX_PREFIX_LENGTH]
+            if not key:
+                continue
+            entry = (FIELD_RANKS[field], len(key), text, field, chemical_id)
+            node = self._root
+            for char in key:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = _Node()
+                    child.stale = stale or node.stale
+                node = child
+                if not node.stale and (len(node.top) < self.top_k or entry < node.top[-1]):
+                    insort(node.top, entry)
+                    del node.top[self.top_k:]
+            node.entries.append(entry)
+            entries.append((key, entry))
+        self._terms[chemical_id] = entries
+
+    def _remove(self, chemical_id):
+        self._names.pop(chemical_id, None)
+        for key, entry in self._terms.pop(chemical_id, []):
+            path = [self._root]
+            for char in key:
+                path.append(path[-1].children[char])
+            path[-1].entries.remove(entry)
+            for node in path[1:]:
+                node.stale = True
+            # Drop branches that no longer lead to any term
+            for depth in range(len(key), 0, -1):
+                node = path[depth]
+                if node.entries or node.children:
+                    break
+                del path[depth - 1].children[key[depth - 1]]
+
+
+index = PrefixIndex()
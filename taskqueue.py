@@ -0,0 +1,290 @@
+"""
+Durable background task queue for the Chemical Management System
+
+Requests call enqueue(), which adds a row to task_queue in the main database
+and returns at once; worker processes (python worker.py) run the tasks. A
+worker claims the ready task of highest priority in one write transaction,
+marking it running with a lease of the task's lease seconds. A task that
+succeeds is marked done with its result. One that raises is queued again
+after an exponential backoff, until it has failed max_attempts times; then it
+is dead-lettered (status 'dead') with its last error, and stays until an admin
+retries it or it is pruned.
+
+A worker that dies mid-task leaves its lease to run out, after which the
+task is claimed again (and counts as an attempt). Delivery is therefore at
+least once: tasks must be safe to run twice, and must finish well within
+their lease. A task can key what it writes on current_task()['id'] (and pass
+a dedupe_key to enqueue) so a second run adds nothing. A worker that finishes
+after losing its lease has its outcome ignored, since the attempt number it
+claimed no longer matches.
+
+Tasks are functions registered with @task(name); payloads and results are
+stored as JSON, and the payload is passed as keyword arguments.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import database as db
+
+# Task name -> Task, filled by @task in tasks.py
+TASKS = {}
+# The claimed row of the task each worker thread is running
+_running = threading.local()
+
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+MAX_ATTEMPTS = 5
+LEASE_SECONDS = 60
+# First retry delay, doubled for each further attempt up to MAX_RETRY_DELAY
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 60 * 60
+# Seconds an idle worker waits before looking for ready tasks again
+POLL_INTERVAL = 0.5
+# Finished tasks are kept this long for inspection
+DONE_RETENTION_DAYS = 7
+DEAD_RETENTION_DAYS = 30
+
+# Claim the ready task of highest priority, oldest first
+CLAIM_TASK = '''
+    UPDATE task_queue SET status = 'running', attempts = attempts + 1, lease_until = :now + :lease, worker = :worker
+    WHERE id = (
+        SELECT id FROM task_queue WHERE status = 'queued' AND run_after <= :now
+        ORDER BY priority DESC, run_after, id LIMIT 1
+    )
+    RETURNING *
+'''
+
+
+class UnknownTaskError(KeyError):
+    """Raised when enqueuing or running a task that is not registered"""
+
+
+class Task:
+    """A registered task function with its queueing defaults"""
+
+    def __init__(self, name, function, priority=PRIORITY_NORMAL, max_attempts=MAX_ATTEMPTS, lease=LEASE_SECONDS):
+        self.name = name
+        self.function = function
+        self.priority = priority
+        self.max_attempts = max_attempts
+        self.lease = lease
+
+
+def task(name, priority=PRIORITY_NORMAL, max_attempts=MAX_ATTEMPTS, lease=LEASE_SECONDS):
+    """Register a function as the task called name"""
+    def decorator(function):
+        TASKS[name] = Task(name, function, priority, max_attempts, lease)
+        return function
+    return decorator
+
+
+def _get_task(name):
+    registered = TASKS.get(name)
+    if registered is None:
+        raise UnknownTaskError(f'Unknown task: {name}')
+    return registered
+
+
+def enqueue(name, payload=None, priority=None, delay=0, dedupe_key=None):
+    """Queue a task to run after delay seconds, returning its ID
+
+    A task already queued with the same dedupe_key is not queued again; its
+    ID is returned instead.
+    """
+    registered = _get_task(name)
+    now = time.time()
+    with db.write_connection() as conn:
+        cursor = conn.execute('''
+            INSERT INTO task_queue (task, payload, priority, max_attempts, run_after, created_at, dedupe_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (dedupe_key) WHERE dedupe_key IS NOT NULL DO NOTHING
+        ''', (name, json.dumps(payload or {}), registered.priority if priority is None else priority,
+              registered.max_attempts, now + delay, now, dedupe_key))
+        if cursor.rowcount == 0:
+            return conn.execute('SELECT id FROM task_queue WHERE dedupe_key = ?', (dedupe_key,)).fetchone()[0]
+        return cursor.lastrowid
+
+
+def current_task():
+    """Get the claimed row of the task running on this thread, or None outside a worker"""
+    return getattr(_running, 'claimed', None)
+
+
+def _requeue_expired(conn, now):
+    """Queue again (or dead-letter) the running tasks whose lease has run out"""
+    return conn.execute('''
+        UPDATE task_queue SET
+            status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,
+            finished_at = CASE WHEN attempts >= max_attempts THEN :now END,
+            last_error = 'Lease expired on worker ' || worker,
+            run_after = :now, lease_until = NULL
+        WHERE status = 'running' AND lease_until < :now
+    ''', {'now': now}).rowcount
+
+
+def claim(worker):
+    """Claim the next ready task for a worker, or get None if there is none
+
+    Looks with a read first, so idle workers do not take the write lock.
+    """
+    now = time.time()
+    with db.read_connection() as conn:
+        ready = conn.execute('''
+            SELECT EXISTS (SELECT 1 FROM task_queue WHERE status = 'queued' AND run_after <= :now),
+                   EXISTS (SELECT 1 FROM task_queue WHERE status = 'running' AND lease_until < :now)
+        ''', {'now': now}).fetchone()
+    if not any(ready):
+        return None
+    with db.write_connection() as conn:
+        if ready[1]:
+            _requeue_expired(conn, now)
+        row = conn.execute(CLAIM_TASK, {'now': now, 'lease': LEASE_SECONDS, 'worker': worker}).fetchone()
+        if row is None:
+            return None
+        claimed = dict(row)
+        registered = TASKS.get(claimed['task'])
+        if registered is not None and registered.lease != LEASE_SECONDS:
+            # Give the task its own lease; the claim and this update commit together
+            claimed['lease_until'] = now + registered.lease
+            conn.execute('UPDATE task_queue SET lease_until = ? WHERE id = ?', (claimed['lease_until'], claimed['id']))
+        return claimed
+
+
+def complete(claimed, result=None):
+    """Mark a claimed task done; returns False if its lease was lost to another worker"""
+    with db.write_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE task_queue SET status = 'done', result = ?, finished_at = ?, lease_until = NULL
+            WHERE id = ? AND status = 'running' AND attempts = ?
+        ''', (json.dumps(result, default=str), time.time(), claimed['id'], claimed['attempts']))
+        return cursor.rowcount == 1
+
+
+def fail(claimed, error, retry=True):
+    """Queue a failed task again after a backoff, or dead-letter it after its last attempt
+
+    Returns the new status, or None if the lease was lost to another worker.
+    """
+    now = time.time()
+    dead = not retry or claimed['attempts'] >= claimed['max_attempts']
+    delay = min(RETRY_DELAY * 2 ** (claimed['attempts'] - 1), MAX_RETRY_DELAY)
+    with db.write_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE task_queue SET status = ?, last_error = ?, run_after = ?, finished_at = ?, lease_until = NULL
+            WHERE id = ? AND status = 'running' AND attempts = ?
+        ''', ('dead' if dead else 'queued', error, now + delay, now if dead else None,
+              claimed['id'], claimed['attempts']))
+        if cursor.rowcount != 1:
+            return None
+    return 'dead' if dead else 'queued'
+
+
+def retry(task_id):
+    """Queue a dead-lettered task again with a fresh set of attempts; returns whether it was dead"""
+    with db.write_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE task_queue SET status = 'queued', attempts = 0, run_after = ?, finished_at = NULL
+            WHERE id = ? AND status = 'dead'
+        ''', (time.time(), task_id))
+        return cursor.rowcount == 1
+
+
+def prune(done_days=DONE_RETENTION_DAYS, dead_days=DEAD_RETENTION_DAYS):
+    """Delete done and dead tasks that finished longer ago than their retention"""
+    now = time.time()
+    with db.write_connection() as conn:
+        done = conn.execute("DELETE FROM task_queue WHERE status = 'done' AND finished_at < ?",
+                            (now - done_days * 86400,)).rowcount
+        dead = conn.execute("DELETE FROM task_queue WHERE status = 'dead' AND finished_at < ?",
+                            (now - dead_days * 86400,)).rowcount
+    return {'done': done, 'dead': dead}
+
+
+def get_stats():
+    """Get task counts by task and status, and how long the oldest ready task has waited"""
+    now = time.time()
+    with db.read_connection() as conn:
+        rows = conn.execute('SELECT task, status, COUNT(*) AS count FROM task_queue GROUP BY task, status').fetchall()
+        oldest = conn.execute('''
+            SELECT MIN(run_after) FROM task_queue WHERE status = 'queued' AND run_after <= ?
+        ''', (now,)).fetchone()[0]
+    counts = {}
+    for row in rows:
+        counts.setdefault(row['task'], {'queued': 0, 'running': 0, 'done': 0, 'dead': 0})[row['status']] = row['count']
+    return {
+        'tasks': counts,
+        'oldest_ready_seconds': round(now - oldest, 1) if oldest is not None else None
+    }
+
+
+def get_tasks(status=None, limit=50):
+    """Get the most recent tasks, optionally with one status (e.g. the dead letters)"""
+    with db.read_connection() as conn:
+        if status:
+            rows = conn.execute('SELECT * FROM task_queue WHERE status = ? ORDER BY id DESC LIMIT ?',
+                                (status, limit)).fetchall()
+        else:
+            rows = conn.execute('SELECT * FROM task_queue ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+class Worker:
+    """Claims and runs queued tasks until stopped"""
+
+    def __init__(self, name=None, poll_interval=POLL_INTERVAL):
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.poll_interval = poll_interval
+        self.counts = {'done': 0, 'retried': 0, 'dead': 0, 'lost': 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """Run one ready task; returns False if there was none"""
+        claimed = claim(self.name)
+        if claimed is None:
+            return False
+        _running.claimed = claimed
+        try:
+            registered = _get_task(claimed['task'])
+            result = registered.function(**json.loads(claimed['payload']))
+        except UnknownTaskError as e:
+            outcome = fail(claimed, str(e), retry=False)
+        except Exception:
+            outcome = fail(claimed, traceback.format_exc(limit=5))
+        else:
+            outcome = 'done' if complete(claimed, result) else None
+        finally:
+            _running.claimed = None
+        self.counts[{'done': 'done', 'queued': 'retried', 'dead': 'dead', None: 'lost'}[outcome]] += 1
+        return True
+
+    def run(self):
+        """Run tasks until stop() is called, polling while the queue is empty"""
+        while not self._stop.is_set():
+            try:
+                worked = self.run_once()
+            except Exception:
+                # The database was locked or unavailable; try again after a poll interval
+                traceback.print_exc()
+                worked = False
+            if not worked:
+                self._stop.wait(self.poll_interval)
+
+    def start(self):
+        """Run tasks on a background thread, e.g. in the development server"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='task-worker', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop after the task in progress"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
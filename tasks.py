@@ -0,0 +1,88 @@
+"""
+Background tasks for the Chemical Management System
+
+Request handlers queue these with the helpers below instead of doing the
+work inline; worker.py runs them (see taskqueue.py for retries and dead
+letters). Each task is registered under its name with its priority: user
+notifications first, then e-mail, then admin-requested jobs and rebuilds.
+"""
+
+import backfill_consumption
+import database as db
+import jobs
+import mail
+import taskqueue
+
+# Scheduled jobs and rollup rebuilds can take minutes on a large database
+LONG_TASK_LEASE = 60 * 60
+
+
+@taskqueue.task('notify', priority=taskqueue.PRIORITY_HIGH)
+def deliver_notifications(user_ids, title, message, notification_type, related_entity_type=None,
+                          related_entity_id=None):
+    """Create a notification for each user (every active admin if user_ids is None) and queue its e-mail
+
+    Both are keyed on the task ID, so a retry after a partial failure only
+    adds what the earlier attempt did not.
+    """
+    if user_ids is None:
+        user_ids = db.get_admin_ids()
+    claimed = taskqueue.current_task()
+    key = f"notify-{claimed['id']}" if claimed else None
+    count = db.create_notifications([(user_id, title, message, notification_type, related_entity_type,
+                                      related_entity_id) for user_id in user_ids], key)
+    if mail.enabled():
+        for user_id in user_ids:
+            taskqueue.enqueue('email', {'user_id': user_id, 'subject': title, 'body': message},
+                              dedupe_key=f'{key}:email:{user_id}' if key else None)
+    return {'notifications': count}
+
+
+@taskqueue.task('email', max_attempts=8)
+def send_email(user_id, subject, body):
+    """E-mail a user, if they are active and have an address"""
+    user = db.get_user_by_id(user_id)
+    if not user or not user['is_active'] or not user['email']:
+        return {'sent': 0}
+    mail.send(user['email'], subject, body)
+    return {'sent': 1}
+
+
+@taskqueue.task('run-job', priority=taskqueue.PRIORITY_LOW, max_attempts=1, lease=LONG_TASK_LEASE)
+def run_job(name):
+    """Run a scheduled job now; its failure dead-letters the task rather than retrying it"""
+    if not jobs.scheduler.jobs:
+        jobs.register_jobs(jobs.scheduler)
+    stats = jobs.scheduler.run_job(name)
+    if stats['last_error']:
+        raise RuntimeError(stats['last_error'])
+    return stats['last_result']
+
+
+@taskqueue.task('rebuild-rollups', priority=taskqueue.PRIORITY_LOW, max_attempts=3, lease=LONG_TASK_LEASE)
+def rebuild_rollups():
+    """Recompute the consumption rollups of every database file from borrow history"""
+    return backfill_consumption.backfill()
+
+
+def notify(user_ids, title, message, notification_type, related_entity_type=None, related_entity_id=None):
+    """Queue notifications for users, returning the task ID"""
+    return taskqueue.enqueue('notify', {
+        'user_ids': list(user_ids), 'title': title, 'message': message, 'notification_type': notification_type,
+        'related_entity_type': related_entity_type, 'related_entity_id': related_entity_id
+    })
+
+
+def notify_admins(title, message, notification_type, related_entity_type=None, related_entity_id=None):
+    """Queue a notification for every admin who is active when it is delivered"""
+    return taskqueue.enqueue('notify', {
+        'user_ids': None, 'title': title, 'message': message, 'notification_type': notification_type,
+        'related_entity_type': related_entity_type, 'related_entity_id': related_entity_id
+    })
+
+
+def run_job_later(name):
+    """Queue a scheduled job to run on a worker, returning the task ID; raises KeyError for unknown jobs"""
+    if name not in jobs.job_names():
+        raise KeyError(f'Unknown job: {name}')
+    return taskqueue.enqueue('run-job', {'name': name})
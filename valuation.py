@@ -0,0 +1,184 @@
+"""
+Inventory valuation and cost reports for the Chemical Management System
+
+A lot's value is its quantity times inventory.cost, the cost per unit of the
+lot. Inventory writes keep running lot counts and values per storage
+location, chemical and expiry date (the inventory_value_by_* tables), so the
+stock valuation is a few grouped queries over those small tables rather than
+a pass over every lot: per-chemical totals are grouped by hazard category and
+supplier in SQL, and NumPy sums those groups into the totals for each. The
+value of expired lots is the value lost to expired stock. Department costs
+charge each borrow the quantity taken times the cost of its lot, converting
+between units of the same kind (mL borrowed from a lot costed per L).
+
+Reports are cached in-process. The stock valuation is keyed by the
+'inventory' and 'chemicals' cache versions, which every inventory and
+chemical write bumps, and by the date; department costs also by the range
+of borrow_history IDs in each database file.
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+import numpy as np
+import database as db
+import limits
+
+# (bucket, days): lots expiring before today plus days fall in the first
+# matching bucket, later ones in 'later' and lots without a date in 'none'
+EXPIRY_BUCKETS = (
+    ('expired', 0),
+    ('30_days', 30),
+    ('90_days', 90),
+    ('1_year', 365),
+)
+# Report dimension -> (get_valuation_groups rows, key column, name column)
+DIMENSIONS = {
+    'location': ('location', 'storage_location_id', 'location_name'),
+    'hazard': ('chemical', 'hazard_category_id', 'hazard_name'),
+    'supplier': ('chemical', 'supplier', 'supplier'),
+    'expiry': ('expiry', 'expiry_bucket', 'expiry_bucket'),
+}
+CACHE_SIZE = 64
+
+
+class ReportCache:
+    """Bounded LRU of computed reports, each stored with the stamp it was computed at"""
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, stamp, compute):
+        """Return the report for key, calling compute() if there is none for this stamp"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        report = compute()
+        with self._lock:
+            self._entries[key] = (stamp, report)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return report
+
+    def clear(self):
+        """Drop every cached report"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Get entry count and hit rate"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+cache = ReportCache()
+
+
+def expiry_buckets(today):
+    """Get the (bucket, first date after it) pairs for get_valuation_groups"""
+    return [(bucket, (today + timedelta(days=days)).isoformat()) for bucket, days in EXPIRY_BUCKETS]
+
+
+def _totals(keys, names, lots, costed_lots, values):
+    """Sum lots and value per distinct key, largest value first"""
+    codes = {}
+    inverse = np.fromiter((codes.setdefault(key, len(codes)) for key in keys), dtype=np.int64, count=len(keys))
+    lot_totals = np.bincount(inverse, lots, len(codes))
+    costed_totals = np.bincount(inverse, costed_lots, len(codes))
+    value_totals = np.bincount(inverse, values, len(codes))
+    labels = dict(zip(keys, names))
+    groups = [{
+        'key': key,
+        'name': labels[key],
+        'lots': int(lot_totals[code]),
+        'unvalued_lots': int(lot_totals[code] - costed_totals[code]),
+        'value': round(float(value_totals[code]), 2)
+    } for key, code in codes.items()]
+    groups.sort(key=lambda group: (-group['value'], str(group['name'])))
+    return groups
+
+
+def summarize(groups):
+    """Turn get_valuation_groups rows into totals overall and per dimension"""
+    arrays = {name: tuple(np.array([row[column] or 0 for row in rows], dtype=float)
+                          for column in ('lots', 'costed_lots', 'value'))
+              for name, rows in groups.items()}
+    lots, costed_lots, values = arrays['chemical']
+    report = {
+        'total': {
+            'lots': int(lots.sum()),
+            'unvalued_lots': int(lots.sum() - costed_lots.sum()),
+            'value': round(float(values.sum()), 2)
+        }
+    }
+    for dimension, (name, key_column, name_column) in DIMENSIONS.items():
+        rows = groups[name]
+        report[f'by_{dimension}'] = _totals([row[key_column] for row in rows], [row[name_column] for row in rows],
+                                            *arrays[name])
+    expired = next((group for group in report['by_expiry'] if group['key'] == 'expired'), None)
+    report['expired'] = {key: expired[key] if expired else 0 for key in ('lots', 'unvalued_lots', 'value')}
+    return report
+
+
+def get_valuation(today=None):
+    """Get the value of all stock, cached until the next inventory or chemical write"""
+    today = today or date.today()
+    stamp = (tuple(db.get_cache_versions('inventory', 'chemicals')), today)
+    return cache.get('valuation', stamp, lambda: summarize(db.get_valuation_groups(expiry_buckets(today))))
+
+
+def _unit_factor(borrow_unit, lot_unit):
+    """Get the factor converting a quantity in borrow_unit to lot_unit, or None if they differ in kind"""
+    borrow, lot = (str(unit or '').strip().lower() for unit in (borrow_unit, lot_unit))
+    if borrow == lot:
+        return 1.0
+    borrow_base, borrow_factor = limits.UNIT_CONVERSIONS.get(borrow, (None, None))
+    lot_base, lot_factor = limits.UNIT_CONVERSIONS.get(lot, (None, None))
+    if borrow_base is None or borrow_base != lot_base:
+        return None
+    return borrow_factor / lot_factor
+
+
+def department_costs(rows):
+    """Turn get_borrow_cost_groups rows into cost per department, highest first"""
+    departments = {}
+    for row in rows:
+        department = departments.setdefault(row['department'] or None,
+                                            {'department': row['department'] or None, 'borrows': 0,
+                                             'unvalued_borrows': 0, 'cost': 0.0})
+        department['borrows'] += row['borrows']
+        factor = _unit_factor(row['borrow_unit'], row['lot_unit'])
+        if factor is None or not row['costed_borrows']:
+            department['unvalued_borrows'] += row['borrows']
+            continue
+        department['unvalued_borrows'] += row['borrows'] - row['costed_borrows']
+        department['cost'] += row['cost'] * factor
+    for department in departments.values():
+        department['cost'] = round(department['cost'], 2)
+    return sorted(departments.values(), key=lambda item: (-item['cost'], item['department'] or ''))
+
+
+def get_department_costs(start=None, end=None):
+    """Get the cost of borrows per department between two dates (inclusive), cached until stock or borrows change"""
+    start = date.fromisoformat(str(start)) if start else None
+    end = date.fromisoformat(str(end)) if end else None
+    if start and end and start > end:
+        raise ValueError('start must not be after end')
+    stamp = (tuple(db.get_cache_versions('inventory')), db.get_borrow_history_stamps())
+    return cache.get(('department_costs', start, end), stamp, lambda: department_costs(
+        db.get_borrow_cost_groups(start, end + timedelta(days=1) if end else None)))
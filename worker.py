@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Background task workers for the Chemical Management System
+
+Runs the tasks queued by the web app (tasks.py) in worker processes until
+stopped with Ctrl+C or SIGTERM, which let each process finish its current
+task. A process that exits unexpectedly is replaced.
+
+    python worker.py                         # TASK_WORKERS processes (default one per CPU)
+    python worker.py -n 4                    # four processes
+    python worker.py status                  # task counts by status
+    python worker.py dead                    # dead-lettered tasks with their last error
+    python worker.py retry 42                # queue dead task 42 again
+    python worker.py enqueue rebuild-rollups # queue a task, with an optional JSON payload
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import time
+import database as db
+import taskqueue
+import tasks  # registers the tasks
+
+TASK_WORKERS = int(os.environ.get('TASK_WORKERS', os.cpu_count() or 1))
+# Seconds between checks that every worker process is still running
+SUPERVISE_INTERVAL = 1
+
+
+def _run_worker():
+    """Run tasks in this process until SIGTERM or SIGINT"""
+    worker = taskqueue.Worker()
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+    worker.run()
+
+
+def run(processes=TASK_WORKERS):
+    """Start worker processes and keep them running until SIGTERM or SIGINT"""
+    db.migrate()
+    # Each process opens its own connections
+    db.close_connections()
+    stopping = []
+    workers = []
+
+    def start():
+        process = multiprocessing.Process(target=_run_worker, name='task-worker')
+        process.start()
+        return process
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    for _ in range(processes):
+        workers.append(start())
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f'Running {processes} task workers. Press Ctrl+C to stop.')
+    while not stopping:
+        for index, process in enumerate(workers):
+            if not process.is_alive():
+                print(f'Task worker {process.pid} exited with code {process.exitcode}; starting another')
+                workers[index] = start()
+        time.sleep(SUPERVISE_INTERVAL)
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        process.join()
+
+
+def print_status():
+    """Print task counts by task and status"""
+    stats = taskqueue.get_stats()
+    print(f"Oldest ready task waiting: {stats['oldest_ready_seconds'] or 0} s")
+    for name, counts in sorted(stats['tasks'].items()):
+        print(f"  {name}: " + ', '.join(f'{count} {status}' for status, count in counts.items()))
+
+
+def print_dead():
+    """Print the dead-lettered tasks with the last line of their error"""
+    for row in taskqueue.get_tasks('dead'):
+        error = (row['last_error'] or '').strip().splitlines()
+        print(f"{row['id']} {row['task']} after {row['attempts']} attempts: {error[-1] if error else ''}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', nargs='?', choices=['status', 'dead', 'retry', 'enqueue'])
+    parser.add_argument('arguments', nargs='*')
+    parser.add_argument('-n', '--processes', type=int, default=TASK_WORKERS)
+    args = parser.parse_args()
+    if args.command == 'status':
+        print_status()
+    elif args.command == 'dead':
+        print_dead()
+    elif args.command == 'retry':
+        for task_id in args.arguments:
+            print(f"{task_id}: {'queued' if taskqueue.retry(int(task_id)) else 'not dead-lettered'}")
+    elif args.command == 'enqueue':
+        name, *payload = args.arguments
+        print(taskqueue.enqueue(name, json.loads(payload[0]) if payload else None))
+    else:
+        run(args.processes)
@@ -0,0 +1,10 @@
+"""
+WSGI entry point for production servers
+
+    SECRET_KEY=... gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from app import create_app
+from config import ProductionConfig
+
+app = create_app(ProductionConfig)